@@ -0,0 +1,99 @@
+import os
+import sys
+import argparse
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_compile import bench, get_models, select
+from stil.layers import memory_format, prepare_task
+from stil.optim import ProjectedSGD
+
+
+def get_projectors(model, rank):
+    '''Random GPM-like projections of rank `rank` (fraction) for every projected layer'''
+    projectors = []
+    for m in model.modules():
+        if hasattr(m, 'set_projection'):
+            dim = m.weight[0].numel()
+            U, _ = torch.linalg.qr(torch.randn(dim, max(1, int(rank * dim))))
+            projectors.append((m.weight, torch.mm(U, U.t())))
+    return projectors
+
+
+def run(args, name, build, shape, channels_last):
+    torch.manual_seed(args.seed)
+    fmt = memory_format(channels_last)
+    model = build()
+    prepare_task(model, args.task_id)
+    model = model.to(memory_format=fmt)
+    optimizer = ProjectedSGD(model.parameters(), lr=0.01, momentum=0.9,
+                             projectors=get_projectors(model, args.rank))
+    criterion = nn.CrossEntropyLoss()
+    x = torch.randn(args.batch_size, *shape).to(memory_format=fmt)
+    y = torch.randint(0, 10, (args.batch_size,))
+
+    def train_step():
+        optimizer.zero_grad()
+        loss = criterion(select(model(x), args.task_id), y)
+        loss.backward()
+        optimizer.step()
+
+    def eval_step():
+        with torch.no_grad():
+            select(model(x), args.task_id)
+
+    model.train()
+    train = bench(train_step, args.steps, args.warmup)
+    model.eval()
+    evaluate = bench(eval_step, args.steps, args.warmup)
+    return train, evaluate
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print('oneDNN: {} | batch size: {} | threads: {}'.format(
+        torch.backends.mkldnn.is_available(), args.batch_size, torch.get_num_threads()))
+    print('-' * 78)
+    print('{:10s} | {:>12s} {:>12s} | {:>12s} {:>12s}'.format(
+        'model', 'train NCHW', 'NHWC', 'eval NCHW', 'NHWC'))
+    print('-' * 78)
+    for name, build, shape in get_models(args.n_tasks):
+        # channels-last only applies to 4D activations
+        if len(shape) != 3 or (args.models and name not in args.models):
+            continue
+        train_nchw, eval_nchw = run(args, name, build, shape, False)
+        train_nhwc, eval_nhwc = run(args, name, build, shape, True)
+        print('{:10s} | {:9.1f}/s {:9.1f}/s | {:9.1f}/s {:9.1f}/s'.format(
+            name, train_nchw, train_nhwc, eval_nchw, eval_nhwc))
+        print('{:10s} | {:>12s} {:11.2f}x | {:>12s} {:11.2f}x'.format(
+            '', '', train_nhwc / train_nchw, '', eval_nhwc / eval_nchw))
+    print('-' * 78)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Steps/s of the STIL conv models, NCHW vs channels-last (CPU)')
+    parser.add_argument('--models', nargs='*', default=[],
+                        help='subset of AlexNet LeNet ResNet18 (default: all)')
+    parser.add_argument('--batch_size', type=int, default=64, metavar='N',
+                        help='batch size (default: 64)')
+    parser.add_argument('--steps', type=int, default=20, metavar='S',
+                        help='timed steps per measurement (default: 20)')
+    parser.add_argument('--warmup', type=int, default=3, metavar='W',
+                        help='untimed steps (default: 3)')
+    parser.add_argument('--rank', type=float, default=0.5, metavar='R',
+                        help='rank of the gradient projections, as a fraction of the layer dimension (default: 0.5)')
+    parser.add_argument('--n_tasks', type=int, default=5, metavar='T',
+                        help='number of task heads (default: 5)')
+    parser.add_argument('--task_id', type=int, default=0, metavar='T',
+                        help='task selected for the BNs and heads (default: 0)')
+    parser.add_argument('--threads', type=int, default=0, metavar='N',
+                        help='torch threads, 0 to keep the default (default: 0)')
+    parser.add_argument('--seed', type=int, default=37, metavar='S',
+                        help='random seed (default: 37)')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stil.layers import compile_model, prepare_task, set_projections, trainable
+from stil.optim import ProjectedSGD
+
+
+def get_models(n_tasks):
+    '''Model builders and input shapes of the STIL architectures'''
+    import main_cifar100
+    import main_cifar100_sup
+    import main_five_datasets
+    import main_pmini
+    taskcla = [(t, 10) for t in range(n_tasks)]
+    return [
+        ('AlexNet', lambda: main_cifar100.AlexNet(taskcla), (3, 32, 32)),
+        ('LeNet', lambda: main_cifar100_sup.LeNet(taskcla), (3, 32, 32)),
+        ('ResNet18', lambda: main_five_datasets.ResNet18(taskcla, 20), (3, 32, 32)),
+        ('MLPNet', lambda: main_pmini.MLPNet(100, 10, taskcla), (28*28,)),
+    ]
+
+
+def select(output, task_id):
+    # multi-head models return the outputs of every head
+    return output[task_id] if isinstance(output, list) else output
+
+
+def bench(step, n_steps, n_warmup):
+    for _ in range(n_warmup):
+        step()
+    clock0 = time.time()
+    for _ in range(n_steps):
+        step()
+    return n_steps / (time.time() - clock0)
+
+
+def projection_bases(layers, rank):
+    '''Random orthonormal GPM bases of the layers, rank a fraction of their input size'''
+    bases = []
+    for layer in layers:
+        n = layer.weight[0].numel()
+        bases.append(torch.linalg.qr(torch.randn(n, max(1, int(rank * n))))[0])
+    return bases
+
+
+def run(args, name, build, shape, compiled):
+    torch.manual_seed(args.seed)
+    model = build()
+    prepare_task(model, args.task_id)
+    compile_model(model, compiled, args.backend)
+    # the projected training of train_projected: ProjectedSGD on the GPM
+    # projectors, the weights projected on the first batch of the task
+    layers = [m for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+    bases = projection_bases(layers, args.rank)
+    projectors = [(layer.weight, torch.mm(basis, basis.t())) for layer, basis in zip(layers, bases)
+                  if hasattr(layer, 'set_projection')]
+    optimizer = ProjectedSGD(trainable(model), lr=0.01, momentum=0.9, projectors=projectors)
+    criterion = nn.CrossEntropyLoss()
+    x = torch.randn(args.batch_size, *shape)
+    y = torch.randint(0, 10, (args.batch_size,))
+
+    def train_step():
+        optimizer.zero_grad()
+        loss = criterion(select(model(x), args.task_id), y)
+        loss.backward()
+        optimizer.step()
+
+    def eval_step():
+        with torch.no_grad():
+            select(model(x), args.task_id)
+
+    model.train()
+    # task boundary: the first warmup step runs the projected forward eagerly
+    set_projections(model, bases)
+    train = bench(train_step, args.steps, args.warmup)
+    model.eval()
+    evaluate = bench(eval_step, args.steps, args.warmup)
+    return train, evaluate
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print('Backend: {} | batch size: {} | threads: {}'.format(
+        args.backend, args.batch_size, torch.get_num_threads()))
+    print('-' * 78)
+    print('{:10s} | {:>12s} {:>12s} | {:>12s} {:>12s}'.format(
+        'model', 'train eager', 'compiled', 'eval eager', 'compiled'))
+    print('-' * 78)
+    for name, build, shape in get_models(args.n_tasks):
+        if args.models and name not in args.models:
+            continue
+        train_eager, eval_eager = run(args, name, build, shape, False)
+        train_comp, eval_comp = run(args, name, build, shape, True)
+        print('{:10s} | {:9.1f}/s {:9.1f}/s | {:9.1f}/s {:9.1f}/s'.format(
+            name, train_eager, train_comp, eval_eager, eval_comp))
+        print('{:10s} | {:>12s} {:11.2f}x | {:>12s} {:11.2f}x'.format(
+            '', '', train_comp / train_eager, '', eval_comp / eval_eager))
+    print('-' * 78)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Steps/s of the STIL models, eager vs torch.compile (CPU)')
+    parser.add_argument('--models', nargs='*', default=[],
+                        help='subset of AlexNet LeNet ResNet18 MLPNet (default: all)')
+    parser.add_argument('--batch_size', type=int, default=64, metavar='N',
+                        help='batch size (default: 64)')
+    parser.add_argument('--steps', type=int, default=20, metavar='S',
+                        help='timed steps per measurement (default: 20)')
+    parser.add_argument('--warmup', type=int, default=3, metavar='W',
+                        help='untimed steps, including compilation (default: 3)')
+    parser.add_argument('--backend', type=str, default='inductor',
+                        help='torch.compile backend (default: inductor)')
+    parser.add_argument('--rank', type=float, default=0.25, metavar='R',
+                        help='rank of the random GPM bases, as a fraction of the layer input size (default: 0.25)')
+    parser.add_argument('--n_tasks', type=int, default=5, metavar='T',
+                        help='number of task heads (default: 5)')
+    parser.add_argument('--task_id', type=int, default=0, metavar='T',
+                        help='task selected for the BNs and heads (default: 0)')
+    parser.add_argument('--threads', type=int, default=0, metavar='N',
+                        help='torch threads, 0 to keep the default (default: 0)')
+    parser.add_argument('--seed', type=int, default=37, metavar='S',
+                        help='random seed (default: 37)')
+    args = parser.parse_args()
+    if not hasattr(torch, 'compile'):
+        parser.error('torch.compile needs torch >= 2.0 (found {})'.format(torch.__version__))
+    main(args)
@@ -0,0 +1,399 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import inspect
+import argparse
+import platform
+import functools
+import subprocess
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_compile import get_models
+from stil.gpm import update_GPM
+from stil.layers import prepare_task, trainable
+from stil.optim import ProjectedSGD
+from stil.transfer import TransferLoss
+from stil.sampling import ClassSampler
+from stil.similarity import Distribution
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# script module, representation function and classes per task of every model of get_models
+SCRIPTS = {
+    'AlexNet': ('main_cifar100', 'get_representation_matrix', 10),
+    'LeNet': ('main_cifar100_sup', 'get_representation_matrix', 5),
+    'ResNet18': ('main_five_datasets', 'get_representation_matrix_ResNet18', 10),
+    'MLPNet': ('main_pmini', 'get_representation_matrix', 10),
+}
+# (dim, samples) of the representation matrices of AlexNet, conv1 to fc2
+GPM_SIZES = ['48x20184', '576x16900', '512x2500', '1024x125', '4096x125']
+N_TASKS = 3
+
+
+def synthetic(shape, n, n_classes=10):
+    '''Random inputs with every class in turn'''
+    return torch.randn(n, *shape), torch.arange(n) % n_classes
+
+
+def orthonormal(dim, rank):
+    return np.linalg.qr(np.random.randn(dim, rank))[0]
+
+
+@functools.lru_cache(maxsize=None)
+def pipeline(name, n_samples):
+    '''A model of get_models trained for nothing on N_TASKS synthetic tasks
+
+    The GPM bases of every task are built with the representation function
+    and update_GPM of the script, so the shapes of the projections and of the
+    knowledge transfer bases are the real ones.
+    '''
+    import importlib
+    module_name, repr_name, n_classes = SCRIPTS[name]
+    module = importlib.import_module(module_name)
+    build, shape = [(b, s) for n, b, s in get_models(N_TASKS) if n == name][0]
+    torch.manual_seed(0)
+    np.random.seed(0)
+    model = build()
+    x, y = synthetic(shape if len(shape) == 3 else (1, 28, 28), n_samples, n_classes)
+    represent = getattr(module, repr_name)
+    sampler = ClassSampler(0)
+    feature_list, proj, every_task_base = [], {}, {}
+    distribution = [[[] for _ in range(32)] for _ in range(N_TASKS)]
+    with redirect_stdout(io.StringIO()):
+        for t in range(N_TASKS):
+            prepare_task(model, t)
+            mat_list = represent(t, model, 'cpu', x, y, distribution, sampler)
+            proj[t], every_task_base[t] = {}, {}
+            feature_list = update_GPM(t, model, mat_list, [0.97] * len(mat_list), feature_list,
+                                      proj, every_task_base, n_workers=1)
+    feature_mat = [torch.Tensor(np.dot(f, f.transpose())) for f in feature_list]
+    return SimpleNamespace(module=module, model=model, x=x, y=y, represent=represent, sampler=sampler,
+                           distribution=distribution, feature_mat=feature_mat,
+                           every_task_base=every_task_base,
+                           sim_tasks=[np.arange(N_TASKS - 1)] * len(feature_list))
+
+
+def train_args(args):
+    return SimpleNamespace(batch_size_train=args.batch_size, channels_last=False,
+                           precision='fp32')
+
+
+def transfer_loss(p):
+    layers = p.module.transfer_layers(p.every_task_base, p.sim_tasks, p.model, N_TASKS - 1)
+    return TransferLoss(layers, 'cpu')
+
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+def register_models(names):
+    for name in names:
+        @benchmark('representation.' + name)
+        def representation(args, name=name):
+            '''Forward pass and im2col of get_representation_matrix'''
+            p = pipeline(name, args.n_samples)
+            p.model.eval()
+            return lambda: p.represent(N_TASKS - 1, p.model, 'cpu', p.x, p.y,
+                                       [[[] for _ in range(32)] for _ in range(N_TASKS)], p.sampler)
+
+        @benchmark('distribution.' + name)
+        def distribution(args, name=name):
+            '''Forward pass and distributions of get_representation_matrix, without the matrices'''
+            p = pipeline(name, args.n_samples)
+            p.model.eval()
+            return lambda: p.represent(N_TASKS - 1, p.model, 'cpu', p.x, p.y,
+                                       [[[] for _ in range(32)] for _ in range(N_TASKS)], p.sampler,
+                                       matrices=False)
+
+        @benchmark('contrast_cls.' + name)
+        def transfer(args, name=name):
+            '''Knowledge transfer loss of one step and its backward'''
+            p = pipeline(name, args.n_samples)
+            prepare_task(p.model, N_TASKS - 1)
+            loss = transfer_loss(p)
+
+            def step():
+                loss().backward()
+            return step
+
+        @benchmark('projection.' + name)
+        def projection(args, name=name):
+            '''Gradient projection of the optimizer step of train_projected'''
+            p = pipeline(name, args.n_samples)
+            prepare_task(p.model, N_TASKS - 1)
+            projectors, frozen = p.module.get_projectors(p.model, p.feature_mat, N_TASKS - 1)
+            optimizer = ProjectedSGD(trainable(p.model), lr=0.01, momentum=0.9,
+                                     projectors=projectors, frozen=frozen)
+            for param in trainable(p.model):
+                param.grad = torch.randn_like(param)
+            return optimizer.project
+
+        @benchmark('epoch.' + name)
+        def epoch(args, name=name):
+            '''One training epoch of the first task (train)'''
+            p = pipeline(name, args.n_samples)
+            prepare_task(p.model, 0)
+            optimizer = torch.optim.SGD(trainable(p.model), lr=0.01, momentum=0.9)
+            criterion = nn.CrossEntropyLoss()
+            fn = p.module.train
+            if list(inspect.signature(fn).parameters)[1] == 'epoch':
+                return lambda: fn(train_args(args), 1, 0, p.model, 'cpu', p.x, p.y, optimizer, criterion)
+            return lambda: fn(train_args(args), p.model, 'cpu', p.x, p.y, optimizer, criterion, 0)
+
+        @benchmark('epoch_projected.' + name)
+        def epoch_projected(args, name=name):
+            '''One training epoch of a later task (train_projected with knowledge transfer)'''
+            p = pipeline(name, args.n_samples)
+            t = N_TASKS - 1
+            prepare_task(p.model, t)
+            projectors, frozen = p.module.get_projectors(p.model, p.feature_mat, t)
+            optimizer = ProjectedSGD(trainable(p.model), lr=0.01, momentum=0.9,
+                                     projectors=projectors, frozen=frozen)
+            loss = transfer_loss(p)
+            return lambda: p.module.train_projected(
+                train_args(args), p.model, 'cpu', p.x, p.y, optimizer, nn.CrossEntropyLoss(), t, loss)
+
+
+def register_gpm(sizes):
+    for size in sizes:
+        dim, n = [int(v) for v in size.split('x')]
+
+        @benchmark('update_GPM.first.' + size)
+        def first(args, dim=dim, n=n):
+            '''SVD and rank selection of the first task'''
+            mat = np.random.randn(dim, n)
+            return lambda: update_GPM(0, None, [mat], [0.97], [], {0: {}}, {0: {}}, n_workers=1)
+
+        @benchmark('update_GPM.next.' + size)
+        def next_task(args, dim=dim, n=n):
+            '''Residual SVD of a later task against a basis of rank dim/4'''
+            mat = np.random.randn(dim, n)
+            basis = orthonormal(dim, max(1, dim // 4))
+            return lambda: update_GPM(1, None, [mat], [0.97], [basis.copy()],
+                                      {0: {0: basis}, 1: {}}, {1: {}}, n_workers=1)
+
+
+def register_similarity(sizes):
+    import main_cifar100
+    for size in sizes:
+        @benchmark('update_task_discrimination.{}'.format(size))
+        def similarity(args, size=size):
+            '''Wasserstein similarity of a task against the 4 tasks before it'''
+            # ReLU activations, stored as the scripts do
+            ori = [Distribution(np.maximum(np.random.randn(size), 0)) for _ in range(5)]
+            new = [Distribution(np.maximum(np.random.randn(size), 0)) for _ in range(5)]
+            return lambda: main_cifar100.update_task_discrimination(4, ori, new, threshold=0.8)
+
+
+def measure(fn, repeat, warmup):
+    with redirect_stdout(io.StringIO()):
+        for _ in range(warmup):
+            fn()
+        times = []
+        for _ in range(repeat):
+            clock0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - clock0)
+    times = np.array(times)
+    return {'median_s': float(np.median(times)), 'min_s': float(times.min()),
+            'mean_s': float(times.mean()), 'std_s': float(times.std()), 'repeat': repeat}
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        if subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT):
+            commit += '-dirty'
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'unknown'
+    return {'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'torch': torch.__version__, 'numpy': np.__version__,
+            'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'threads': torch.get_num_threads()}
+
+
+def compare(results, path, tolerance):
+    with open(path) as f:
+        base = json.load(f)
+    print('-' * 78)
+    print('Compared with {} ({})'.format(base['meta']['commit'], path))
+    print('-' * 78)
+    regressions = 0
+    for name, res in results.items():
+        if name not in base['results']:
+            continue
+        ratio = res['median_s'] / base['results'][name]['median_s']
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = ' slower'
+            regressions += 1
+        elif ratio < 1 - tolerance:
+            flag = ' faster'
+        print('{:45s} {:10.2f}ms -> {:10.2f}ms {:6.2f}x{}'.format(
+            name, 1000 * base['results'][name]['median_s'], 1000 * res['median_s'], ratio, flag))
+    print('-' * 78)
+    return regressions
+
+
+def contrast_cls(layers):
+    '''Knowledge transfer loss of the original contrast_cls loop of the scripts,
+    one n x n projector and one BCE per similar task'''
+    l2 = 0
+    for param, current, similar in layers:
+        sz = param.size(0)
+        current_base = torch.FloatTensor(np.asarray(current))
+        norm_project = torch.mm(current_base, current_base.transpose(1, 0))
+        current_proj_weight = torch.mm(param.reshape(sz, -1), norm_project)
+        loss = []
+        for base in similar:
+            tmp = torch.FloatTensor(np.asarray(base))
+            norm_project = torch.mm(tmp, tmp.transpose(1, 0))
+            sim_proj_weight = torch.mm(param.reshape(sz, -1), norm_project)
+            cos_sim = nn.functional.cosine_similarity(current_proj_weight, sim_proj_weight, dim=1)
+            cos_sim = (torch.mean(cos_sim) + 1.0) / 2.0
+            loss.append(nn.functional.binary_cross_entropy(cos_sim.view(1), torch.ones(1)))
+        if len(loss) != 0:
+            l2 += torch.mean(torch.stack(loss))
+    return l2
+
+
+def skewed(every_task_base, seed):
+    '''The bases mixed by random well-conditioned matrices, no longer orthonormal'''
+    rng = np.random.default_rng(seed)
+    return {t: {i: base.dot(np.eye(base.shape[1]) + 0.3 * rng.standard_normal((base.shape[1],) * 2))
+                for i, base in bases.items()}
+            for t, bases in every_task_base.items()}
+
+
+def check(args):
+    '''Compare the two forms of TransferLoss with the contrast_cls loop on the
+    bases of every model, orthonormal and not: loss and param gradients'''
+    print('{:10s} {:12s} {:12s} {:>12s} {:>12s}'.format('model', 'bases', 'form', 'loss error', 'grad error'))
+    print('-' * 78)
+    failures = 0
+    for name in args.models:
+        with redirect_stdout(io.StringIO()):
+            p = pipeline(name, args.n_samples)
+        prepare_task(p.model, N_TASKS - 1)
+        for kind, bases in (('orthonormal', p.every_task_base), ('skewed', skewed(p.every_task_base, args.seed))):
+            layers = p.module.transfer_layers(bases, p.sim_tasks, p.model, N_TASKS - 1)
+            params = [param for param, _, similar in layers if len(similar)]
+
+            def run(loss):
+                for param in params:
+                    param.grad = None
+                value = loss()
+                value.backward()
+                return value.item(), [param.grad.clone() for param in params]
+
+            ref_loss, ref_grads = run(lambda: contrast_cls(layers))
+            for form, closed_form in (('closed', True), ('projector', False)):
+                loss, grads = run(TransferLoss(layers, 'cpu', closed_form=closed_form))
+                loss_error = abs(loss - ref_loss) / max(abs(ref_loss), 1e-12)
+                grad_error = max(float((g - r).norm() / r.norm().clamp_min(1e-12))
+                                 for g, r in zip(grads, ref_grads))
+                failed = loss_error > args.check_tol or grad_error > args.check_tol
+                failures += failed
+                print('{:10s} {:12s} {:12s} {:12.2e} {:12.2e}{}'.format(
+                    name, kind, form, loss_error, grad_error, ' FAILED' if failed else ''))
+    print('-' * 78)
+    return failures
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.check:
+        sys.exit(1 if check(args) else 0)
+    register_models(args.models)
+    register_gpm(args.gpm_sizes)
+    register_similarity(args.similarity_sizes)
+    names = [n for n in BENCHMARKS if not args.filter or re.search(args.filter, n)]
+    if args.list:
+        for name in names:
+            print('{:45s} {}'.format(name, BENCHMARKS[name].__doc__))
+        return
+
+    print('{} benchmarks | threads: {} | repeat: {}'.format(len(names), torch.get_num_threads(), args.repeat))
+    print('-' * 78)
+    results = {}
+    for name in names:
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        with redirect_stdout(io.StringIO()):
+            fn = BENCHMARKS[name](args)
+        results[name] = measure(fn, args.repeat, args.warmup)
+        print('{:45s} {:10.2f}ms +- {:8.2f}ms'.format(
+            name, 1000 * results[name]['median_s'], 1000 * results[name]['std_s']))
+    print('-' * 78)
+
+    meta = metadata()
+    out = args.out or os.path.join(ROOT, 'results', 'bench', '{}.json'.format(meta['commit']))
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump({'meta': meta, 'args': vars(args), 'results': results}, f, indent=1)
+    print('Saved {}'.format(out))
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Timings of the STIL hot paths on synthetic data (CPU, no datasets)')
+    parser.add_argument('--filter', type=str, default='',
+                        help='regex selecting the benchmarks to run, e.g. "update_GPM|ResNet18"')
+    parser.add_argument('--list', action='store_true', default=False,
+                        help='list the benchmarks and exit')
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='check the knowledge transfer loss forms against the contrast_cls loop and exit')
+    parser.add_argument('--check_tol', type=float, default=1e-4,
+                        help='relative error of the loss and of the gradients allowed by --check (default: 1e-4)')
+    parser.add_argument('--models', nargs='*', default=list(SCRIPTS),
+                        help='models of the model benchmarks (default: AlexNet LeNet ResNet18 MLPNet)')
+    parser.add_argument('--gpm_sizes', nargs='*', default=GPM_SIZES,
+                        help='dim x samples of the update_GPM layers (default: the AlexNet layers)')
+    parser.add_argument('--similarity_sizes', type=int, nargs='*', default=[64000, 512000],
+                        help='sizes of the task distributions of update_task_discrimination (default: 64000 512000)')
+    parser.add_argument('--n_samples', type=int, default=512, metavar='N',
+                        help='synthetic samples of every task, one training epoch (default: 512)')
+    parser.add_argument('--batch_size', type=int, default=64, metavar='N',
+                        help='training batch size (default: 64)')
+    parser.add_argument('--repeat', type=int, default=5, metavar='R',
+                        help='timed runs of every benchmark (default: 5)')
+    parser.add_argument('--warmup', type=int, default=1, metavar='W',
+                        help='untimed runs (default: 1)')
+    parser.add_argument('--threads', type=int, default=0, metavar='N',
+                        help='torch threads, 0 to keep the default (default: 0)')
+    parser.add_argument('--seed', type=int, default=37, metavar='S',
+                        help='random seed (default: 37)')
+    parser.add_argument('--out', type=str, default=None,
+                        help='results JSON (default: results/bench/<commit>.json)')
+    parser.add_argument('--compare', type=str, default=None, metavar='JSON',
+                        help='results of an earlier run to compare the medians with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change reported as a regression/speedup (default: 0.1)')
+    parser.add_argument('--fail_on_regression', action='store_true', default=False,
+                        help='exit with status 1 if a benchmark regressed')
+    args = parser.parse_args()
+    main(args)
@@ -3,6 +3,7 @@ import numpy as np
 import torch
 from torchvision import datasets, transforms
 from sklearn.utils import shuffle
+from dataloader.utils import load_tensor
 from torchvision import datasets,transforms
 import json
 from torch.utils.data import Dataset
@@ -155,8 +156,8 @@ def read_celeba(seed=0,pc_valid=0.10,sim_ntasks=10, data_size='full'):
         data[i] = dict.fromkeys(['name','ncla','train','test'])
         for s in ['train','test']:
             data[i][s]={'x':[],'y':[]}
-            data[i][s]['x']=torch.load(os.path.join(os.path.expanduser('./data/'+data_type+'_binary_celeba/'+str(n_tasks)),'data'+str(ids[i])+s+'x.bin'))
-            data[i][s]['y']=torch.load(os.path.join(os.path.expanduser('./data/'+data_type+'_binary_celeba/'+str(n_tasks)),'data'+str(ids[i])+s+'y.bin'))
+            data[i][s]['x']=load_tensor(os.path.join(os.path.expanduser('./data/'+data_type+'_binary_celeba/'+str(n_tasks)),'data'+str(ids[i])+s+'x.bin'))
+            data[i][s]['y']=load_tensor(os.path.join(os.path.expanduser('./data/'+data_type+'_binary_celeba/'+str(n_tasks)),'data'+str(ids[i])+s+'y.bin'))
         data[i]['ncla']=len(np.unique(data[i]['train']['y'].numpy()))
         data[i]['name']='celeba-'+str(ids[i])
 
@@ -4,6 +4,7 @@ import torch
 # import utils
 from torchvision import datasets,transforms
 from sklearn.utils import shuffle
+from dataloader.utils import load_tensor
 
 cf100_dir = './data/'
 file_dir = './data/binary_cifar100'
@@ -56,8 +57,8 @@ def get(seed=0,pc_valid=0.10):
         data[i] = dict.fromkeys(['name','ncla','train','test'])
         for s in ['train','test']:
             data[i][s]={'x':[],'y':[]}
-            data[i][s]['x']=torch.load(os.path.join(os.path.expanduser(file_dir),'data'+str(ids[i])+s+'x.bin'))
-            data[i][s]['y']=torch.load(os.path.join(os.path.expanduser(file_dir),'data'+str(ids[i])+s+'y.bin'))
+            data[i][s]['x']=load_tensor(os.path.join(os.path.expanduser(file_dir),'data'+str(ids[i])+s+'x.bin'))
+            data[i][s]['y']=load_tensor(os.path.join(os.path.expanduser(file_dir),'data'+str(ids[i])+s+'y.bin'))
         data[i]['ncla']=len(np.unique(data[i]['train']['y'].numpy()))
         if data[i]['ncla']==2:
             data[i]['name']='cifar10-'+str(ids[i])
@@ -6,6 +6,7 @@ import torch
 import torch.utils.data
 from torchvision import datasets,transforms
 from sklearn.utils import shuffle
+from dataloader.utils import load_tensor
 import urllib.request
 from PIL import Image
 import pickle
@@ -219,8 +220,8 @@ def get(seed=1, fixed_order=False, pc_valid=0.05):
             # Load
             for s in ['train','test']:
                 data[n][s]={'x':[],'y':[]}
-                data[n][s]['x'] = torch.load(os.path.join(os.path.expanduser('./data/Five_data/binary_mixture_5_Data'),'data'+str(idx)+s+'x.bin'))
-                data[n][s]['y'] = torch.load(os.path.join(os.path.expanduser('./data/Five_data/binary_mixture_5_Data'),'data'+str(idx)+s+'y.bin'))
+                data[n][s]['x'] = load_tensor(os.path.join(os.path.expanduser('./data/Five_data/binary_mixture_5_Data'),'data'+str(idx)+s+'x.bin'))
+                data[n][s]['y'] = load_tensor(os.path.join(os.path.expanduser('./data/Five_data/binary_mixture_5_Data'),'data'+str(idx)+s+'y.bin'))
 
     # Validation
     for t in data.keys():
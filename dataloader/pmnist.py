@@ -3,6 +3,7 @@ import numpy as np
 import torch
 from torchvision import datasets, transforms
 from sklearn.utils import shuffle
+from dataloader.utils import load_tensor
 
 
 ########################################################################################################################
@@ -64,8 +65,8 @@ def get(seed=0, fixed_order=False, pc_valid=0.1):
             # Load
             for s in ['train', 'test']:
                 data[i][s] = {'x': [], 'y': []}
-                data[i][s]['x'] = torch.load(os.path.join(os.path.expanduser(pmnist_dir), 'data' + str(r) + s + 'x.bin'))
-                data[i][s]['y'] = torch.load(os.path.join(os.path.expanduser(pmnist_dir), 'data' + str(r) + s + 'y.bin'))
+                data[i][s]['x'] = load_tensor(os.path.join(os.path.expanduser(pmnist_dir), 'data' + str(r) + s + 'x.bin'))
+                data[i][s]['y'] = load_tensor(os.path.join(os.path.expanduser(pmnist_dir), 'data' + str(r) + s + 'y.bin'))
 
     # Validation
     for t in data.keys():
@@ -0,0 +1,151 @@
+import os
+import numpy as np
+import torch
+
+# (tasks, classes per task, input size, train and test examples per task) of
+# the datasets, the train examples before the validation split. The example
+# counts are those of the real tasks, rounded.
+DATASETS = {
+    'cifar100': (10, 10, [3, 32, 32], 5000, 1000),
+    'cifar100_superclass': (20, 5, [3, 32, 32], 2500, 500),
+    'five_datasets': (5, 10, [3, 32, 32], [50000, 60000, 73257, 60000, 16853],
+                      [10000, 10000, 26032, 10000, 1873]),
+    'miniimagenet': (20, 5, [3, 84, 84], 2500, 500),
+    'femnist10': (10, 62, [3, 32, 32], 300, 40),
+    'femnist35': (35, 62, [3, 32, 32], 300, 40),
+    'celeba': (10, 2, [3, 32, 32], 200, 50),
+    'mixceleba': (20, None, [3, 32, 32], None, None),
+    'mixemnist': (20, None, [1, 28, 28], None, None),
+    'pmnist': (10, 10, [1, 28, 28], 60000, 10000),
+}
+# the mixed datasets: (dissimilar tasks, similar tasks) as (name, classes, train, test)
+MIXED = {
+    'mixceleba': (('cifar100', 'classptask', 5000, 1000), ('celeba', 2, 200, 50), 'celeba'),
+    'mixemnist': (('emnist', 'classptask', 12000, 2000), ('fe-mnist', 'num_class_femnist', 300, 40), 'fe-mnist'),
+}
+
+
+def make_task(seed, task_id, ncla, size, n_train, n_test, pc_valid=0., name='synthetic'):
+    '''data[task_id] of a synthetic task: every class is a random prototype
+    image, its examples the prototype plus noise, so the task can be learned.
+    The task only depends on the seed and its arguments.'''
+    rng = np.random.default_rng([seed, task_id])
+    prototypes = rng.standard_normal((ncla, int(np.prod(size))), dtype=np.float32)
+    task = {'name': '{}-{}'.format(name, task_id), 'ncla': ncla}
+    for s, n in (('train', n_train), ('test', n_test)):
+        y = rng.permutation(np.arange(n) % ncla)
+        x = rng.standard_normal((n, prototypes.shape[1]), dtype=np.float32)
+        x += prototypes[y]
+        task[s] = {'x': torch.from_numpy(x).view(-1, *size), 'y': torch.from_numpy(y).long()}
+    # Validation
+    nvalid = int(pc_valid * n_train)
+    task['valid'] = {'x': task['train']['x'][:nvalid].clone(), 'y': task['train']['y'][:nvalid].clone()}
+    task['train'] = {'x': task['train']['x'][nvalid:].clone(), 'y': task['train']['y'][nvalid:].clone()}
+    return task
+
+
+def _counts(value, n_tasks):
+    return list(value) if isinstance(value, (list, tuple)) else [value] * n_tasks
+
+
+class Dataset(object):
+    '''Seeded synthetic tasks in place of a module of dataloader/, offline.
+
+    It has the entry points of the module the scripts call, with the same
+    arguments and the same data[t]['train'|'valid'|'test']['x'|'y'], taskcla
+    and size results: get() (DatasetGen(args).get(t) for miniimagenet,
+    cifar100_superclass_python() for cifar100_superclass). The tasks have the
+    input size, the classes and the number of tasks of the dataset, and
+    n_train training examples each (0: about as many as the real tasks, the
+    test examples in proportion), generated on the fly by make_task.
+    '''
+
+    def __init__(self, name, n_train=0):
+        self.name = name
+        self.n_train = n_train
+
+    def sizes(self, train, test):
+        if not self.n_train:
+            return train, test
+        return self.n_train, max(1, int(round(self.n_train * test / float(train))))
+
+    def tasks(self, seed, specs, size, pc_valid, names=None):
+        '''data, taskcla of the tasks of specs [(classes, train, test)]'''
+        data, taskcla = {}, []
+        for t, (ncla, n_train, n_test) in enumerate(specs):
+            n_train, n_test = self.sizes(n_train, n_test)
+            data[t] = make_task(seed, t, ncla, size, n_train, n_test, pc_valid,
+                                names[t] if names else self.name)
+            taskcla.append((t, ncla))
+        data['ncla'] = sum(ncla for t, ncla in taskcla)
+        return data, taskcla
+
+    def mixed(self, seed, pc_valid, args):
+        '''Dissimilar and similar tasks in the order of the task sequence file'''
+        dis, sim, key = MIXED[self.name]
+        n_dis, n_sim = args.dis_ntasks, args.sim_ntasks
+        f_name = '{}_random_{}'.format(self.name, n_dis + n_sim)
+        if os.path.exists(f_name):
+            with open(f_name, 'r') as f_random_seq:
+                similar = [key in name for name in f_random_seq.readlines()[args.idrandom].split()]
+        else:
+            similar = [False] * n_dis + [True] * n_sim
+        specs, names, dis_id = [], [], 0
+        for is_similar in similar[:n_dis + n_sim]:
+            name, ncla, n_train, n_test = sim if is_similar else dis
+            ncla = ncla if isinstance(ncla, int) else getattr(args, ncla)
+            if not is_similar:
+                if self.name == 'mixemnist' and dis_id == n_dis - 1:
+                    # the last emnist task takes the classes left of the 47
+                    ncla = 47 - ncla * dis_id
+                dis_id += 1
+            specs.append((ncla, n_train, n_test))
+            names.append(name)
+        return self.tasks(seed, specs, DATASETS[self.name][2], pc_valid, names)
+
+    def get(self, seed=0, fixed_order=False, pc_valid=0.1, sim_ntasks=None, args=None, **kwargs):
+        n_tasks, ncla, size, train, test = DATASETS[self.name]
+        if self.name in MIXED:
+            return self.mixed(seed, pc_valid, args) + (size,)
+        if sim_ntasks is not None:
+            n_tasks = sim_ntasks
+        specs = list(zip([ncla] * n_tasks, _counts(train, n_tasks), _counts(test, n_tasks)))
+        return self.tasks(seed, specs, size, pc_valid) + (size,)
+
+    def cifar100_superclass_python(self, task_order, group=5, validation=False, val_ratio=0.05,
+                                   flat=False, one_hot=True, seed=0):
+        n_tasks, ncla, size, train, test = DATASETS['cifar100_superclass']
+        # the same tasks for the train/valid and the test calls, keyed by task
+        data, taskcla = {}, []
+        for idx in task_order:
+            n_train, n_test = self.sizes(train, test)
+            task = make_task(seed, idx, group, size, n_train, n_test, val_ratio if validation else 0., 'cifar100')
+            data[idx] = {k: task[k] for k in ('name', 'ncla', 'train', 'valid')} if validation else \
+                {'name': task['name'], 'ncla': group, 'test': task['test']}
+            taskcla.append((idx, group))
+        data['ncla'] = group * len(taskcla)
+        return data, taskcla
+
+    def DatasetGen(self, args):
+        return _TaskGen(self, args)
+
+
+class _TaskGen(object):
+    '''DatasetGen of dataloader/miniimagenet: taskcla, inputsize and get(task_id), the
+    data of the tasks so far'''
+
+    def __init__(self, dataset, args):
+        n_tasks, ncla, size, self.train, self.test = DATASETS[dataset.name]
+        self.dataset = dataset
+        self.seed = args.seed
+        self.pc_valid = args.pc_valid
+        self.inputsize = size
+        self.taskcla = [[t, ncla] for t in range(n_tasks)]
+        self.dataloaders = {}
+
+    def get(self, task_id):
+        # the tasks so far, as dataloader/miniimagenet
+        n_train, n_test = self.dataset.sizes(self.train, self.test)
+        self.dataloaders[task_id] = make_task(self.seed, task_id, self.taskcla[task_id][1], self.inputsize,
+                                              n_train, n_test, self.pc_valid, 'miniimagenet')
+        return self.dataloaders
@@ -347,3 +347,12 @@ def read_image_file(path):
     assert(x.dtype == torch.uint8)
     assert(x.ndimension() == 3)
     return x
+
+
+def load_tensor(path):
+    """torch.load of a cached .bin tensor. With STIL_MMAP=1 in the environment
+    the file is memory-mapped, so the runs of a sweep share its pages.
+    """
+    if os.environ.get('STIL_MMAP', '0') == '1':
+        return torch.load(path, mmap=True)  # torch >= 2.1
+    return torch.load(path)
@@ -11,10 +11,7 @@ import os
 import os.path
 from collections import OrderedDict
 
-import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sn
-import pandas as pd
 import random
 import pdb
 import argparse
@@ -22,9 +19,23 @@ import time
 import math
 from copy import deepcopy
 
-from scipy.stats import wasserstein_distance
 from scipy.spatial.distance import euclidean
 
+from stil.gpm import update_GPM
+from stil.evaluation import evaluate_tasks, evaluation_mode
+from stil.optim import ProjectedSGD
+from stil.precision import autocast
+from stil.layers import TaskModuleList, compile_model, memory_format, prepare_task, recording, set_projections, trainable
+from stil.snapshot import BestModel
+from stil.results import Results
+from stil.profiler import Profiler, profiled, set_profiler, stage, step
+from stil.transfer import TransferLoss
+from stil.sampling import ClassSampler
+from stil.cache import InitCache, data_version, model_version
+from stil.prefix import PrefixCache
+from stil.store import BasisStore
+from stil.similarity import Distribution, wasserstein
+
 def compute_conv_output_size(Lin, kernel_size, stride=1, padding=0, dilation=1):
     return int(np.floor((Lin+2*padding-dilation*(kernel_size-1)-1)/float(stride)+1))
 
@@ -45,19 +56,22 @@ class Conv2d(nn.Conv2d):
                                      stride=stride,
                                      padding=padding,
                                      bias=bias)
-
-    def forward(self, input, task_id, p, epoch):
-        if p is not None:
-            if epoch == 1:
-                sz = self.weight.grad.data.size(0)
-                norm_project = torch.mm(p, p.transpose(1, 0))
-                proj_weight = torch.mm(self.weight.view(sz, -1),
-                                       norm_project).view(self.weight.size())
+        self.norm_project = None
+
+    def set_projection(self, p):
+        # the projection is folded into the weights of the next forward only
+        self.norm_project = None if p is None else torch.mm(p, p.transpose(1, 0))
+
+    def forward(self, input):
+        masked_weight = self.weight
+        if self.norm_project is not None:
+            # the weight projection stays in float32 under autocast
+            with torch.autocast(input.device.type, enabled=False):
+                sz = self.weight.size(0)
+                proj_weight = torch.mm(self.weight.reshape(sz, -1),
+                                       self.norm_project).view(self.weight.size())
                 masked_weight = self.weight - proj_weight
-            else:
-                masked_weight = self.weight
-        else:
-            masked_weight = self.weight
+                self.norm_project = None
         return F.conv2d(input, masked_weight, self.bias, self.stride,
                         self.padding, self.dilation, self.groups)
 
@@ -65,18 +79,20 @@ class Conv2d(nn.Conv2d):
 class Linear(nn.Linear):
     def __init__(self, in_features, out_features, bias=True):
         super(Linear, self).__init__(in_features, out_features, bias=bias)
-
-    def forward(self, input, task_id, p, epoch):
-        if p is not None:
-            if epoch == 1:
-                norm_project = torch.mm(p, p.transpose(1, 0))
-                proj_weight = torch.mm(self.weight, norm_project)
-
+        self.norm_project = None
+
+    def set_projection(self, p):
+        # the projection is folded into the weights of the next forward only
+        self.norm_project = None if p is None else torch.mm(p, p.transpose(1, 0))
+
+    def forward(self, input):
+        masked_weight = self.weight
+        if self.norm_project is not None:
+            # the weight projection stays in float32 under autocast
+            with torch.autocast(input.device.type, enabled=False):
+                proj_weight = torch.mm(self.weight, self.norm_project)
                 masked_weight = self.weight - proj_weight
-            else:
-                masked_weight = self.weight
-        else:
-            masked_weight = self.weight
+                self.norm_project = None
         return F.linear(input, masked_weight, self.bias)
 
 
@@ -84,6 +100,7 @@ class LeNet(nn.Module):
     def __init__(self, taskcla):
         super(LeNet, self).__init__()
         self.act = OrderedDict()
+        self.record = False
         self.map = []
         self.ksize = []
         self.in_channel = []
@@ -115,55 +132,35 @@ class LeNet(nn.Module):
         self.map.extend([800])
 
         self.taskcla = taskcla
-        self.fc3 = torch.nn.ModuleList()
-        for t, n in self.taskcla:
-            self.fc3.append(torch.nn.Linear(500, n, bias=False))
-
-    def forward(self, x, t, p, epoch):
-        if p is None:
-            bsz = deepcopy(x.size(0))
-            self.act['conv1'] = x
-            x = self.conv1(x, t, None, epoch)
-            x = self.maxpool(self.drop1(self.lrn(self.relu(x))))
+        self.fc3 = TaskModuleList(
+            lambda t: torch.nn.Linear(500, self.taskcla[t][1], bias=False), len(self.taskcla))
 
-            self.act['conv2'] = x
-            x = self.conv2(x, t, None, epoch)
-            x = self.maxpool(self.drop1(self.lrn(self.relu(x))))
-
-            x = x.reshape(bsz, -1)
-            self.act['fc1'] = x
-            x = self.fc1(x, t, None, epoch)
-            x = self.drop2(self.relu(x))
-
-            self.act['fc2'] = x
-            x = self.fc2(x, t, None, epoch)
-            x = self.drop2(self.relu(x))
-
-            y = []
-            for t, i in self.taskcla:
-                y.append(self.fc3[t](x))
-        else:
-            bsz = deepcopy(x.size(0))
+    def forward(self, x):
+        bsz = x.size(0)
+        if self.record:
             self.act['conv1'] = x
-            x = self.conv1(x, t, p[0], epoch)
-            x = self.maxpool(self.drop1(self.lrn(self.relu(x))))
+        x = self.conv1(x)
+        x = self.maxpool(self.drop1(self.lrn(self.relu(x))))
 
+        if self.record:
             self.act['conv2'] = x
-            x = self.conv2(x, t, p[1], epoch)
-            x = self.maxpool(self.drop1(self.lrn(self.relu(x))))
+        x = self.conv2(x)
+        x = self.maxpool(self.drop1(self.lrn(self.relu(x))))
 
-            x = x.reshape(bsz, -1)
+        x = x.reshape(bsz, -1)
+        if self.record:
             self.act['fc1'] = x
-            x = self.fc1(x, t, p[2], epoch)
-            x = self.drop2(self.relu(x))
+        x = self.fc1(x)
+        x = self.drop2(self.relu(x))
 
+        if self.record:
             self.act['fc2'] = x
-            x = self.fc2(x, t, p[3], epoch)
-            x = self.drop2(self.relu(x))
+        x = self.fc2(x)
+        x = self.drop2(self.relu(x))
 
-            y = []
-            for t, i in self.taskcla:
-                y.append(self.fc3[t](x))
+        y = []
+        for head in self.fc3:
+            y.append(head(x))
         return y
 
 
@@ -173,15 +170,6 @@ def init_weights(m):
             m.weight, mode='fan_in', nonlinearity='relu')
 
 
-def get_model(model):
-    return deepcopy(model.state_dict())
-
-
-def set_model_(model, state_dict):
-    model.load_state_dict(deepcopy(state_dict))
-    return
-
-
 def adjust_learning_rate(optimizer, epoch, args):
     for param_group in optimizer.param_groups:
         if (epoch == 1):
@@ -190,6 +178,7 @@ def adjust_learning_rate(optimizer, epoch, args):
             param_group['lr'] /= args.lr_factor
 
 
+@profiled('train')
 def train(args, epoch, task_id, model, device, x, y, optimizer, criterion):
     model.train()
     r = np.arange(x.size(0))
@@ -202,49 +191,47 @@ def train(args, epoch, task_id, model, device, x, y, optimizer, criterion):
         else:
             b = r[i:]
         data = x[b]
-        data, target = data.to(device), y[b].to(device)
+        data, target = data.to(device, memory_format=memory_format(args.channels_last)), y[b].to(device)
         optimizer.zero_grad()
-        output = model(data, task_id, None, -1)
-        loss = criterion(output[task_id], target)
+        with autocast(args.precision, device):
+            output = model(data)
+            loss = criterion(output[task_id], target)
         loss.backward()
         optimizer.step()
+        step()
 
 
-def contrast_cls(every_task_base, sim_tasks, model, task_id, device, criterion):
-    l2 = 0
+def transfer_layers(every_task_base, sim_tasks, model, task_id):
+    '''(param, current base, similar task bases) of the knowledge transfer layers'''
+    layers = []
     cnt = 0
-    list_keys = list(model.act.keys())
     for k, (m, params) in enumerate(model.named_parameters()):
-
         if k < 4 and len(params.size()) != 1:
-
-            sz = params.size(0)
-            current_base = torch.FloatTensor(every_task_base[task_id-1][cnt]).to(device)
-            norm_project = torch.mm(current_base, current_base.transpose(1, 0))
-            current_proj_weight = torch.mm(params.view(sz, -1),
-                                       norm_project).view(params.size())
-            loss = []
-            for tt in sim_tasks[cnt]:
-                tmp = torch.FloatTensor(every_task_base[tt][cnt]).to(device)
-                norm_project = torch.mm(tmp, tmp.transpose(1, 0))
-                sim_proj_weight = torch.mm(params.view(sz, -1),
-                                       norm_project).view(params.size())
-                cos_sim = torch.nn.functional.cosine_similarity(current_proj_weight.view(sz, -1),sim_proj_weight.view(sz, -1), dim=1)
-                cos_sim = (torch.mean(cos_sim) + 1.0) / 2.0 
-                label = torch.ones(1).to(device)
-
-                loss.append(torch.nn.functional.binary_cross_entropy(cos_sim.view(1), label))
-            if len(loss) != 0:
-                loss = torch.mean(torch.stack(loss))
-                l2 += loss
+            layers.append((params, every_task_base[task_id-1][cnt],
+                           [every_task_base[tt][cnt] for tt in sim_tasks[cnt]]))
             cnt += 1
+    return layers
 
-    return l2
 
+def get_projectors(model, feature_mat, task_id):
+    '''Pair the projected params with their projection matrices'''
+    projectors = []
+    frozen = []
+    kk = 0
+    for k, (m, params) in enumerate(model.named_parameters()):
+        if k < 4 and len(params.size()) != 1:
+            projectors.append((params, feature_mat[kk]))
+            kk += 1
+        elif (k < 4 and len(params.size()) == 1) and task_id != 0:
+            frozen.append(params)
+    return projectors, frozen
 
-def train_projected(args, p, model, device, x, y, optimizer, criterion, feature_mat, task_id, epoch, sim_tasks,  every_task_base):
+
+@profiled('train')
+def train_projected(args, model, device, x, y, optimizer, criterion, task_id, transfer):
     '''Train for one epoch on the training set'''
     model.train()
+    transfer.epoch()
     r = np.arange(x.size(0))
     np.random.shuffle(r)
     r = torch.LongTensor(r).to(device)
@@ -255,85 +242,61 @@ def train_projected(args, p, model, device, x, y, optimizer, criterion, feature_
         else:
             b = r[i:]
         data = x[b]
-        data, target = data.to(device), y[b].to(device)
+        data, target = data.to(device, memory_format=memory_format(args.channels_last)), y[b].to(device)
         optimizer.zero_grad()
-        output = model(data, task_id, p, i + epoch)
-        loss = criterion(output[task_id], target)
+        with autocast(args.precision, device):
+            output = model(data)
+            loss = criterion(output[task_id], target)
 
-        if len(sim_tasks) != 0:
-            l2 = contrast_cls(every_task_base, sim_tasks,
-                               model, task_id, device, criterion)
-            loss += l2
+        kt_loss = transfer.step()
+        if kt_loss is not None:
+            loss += kt_loss
 
         loss.backward()
-        # Gradient Projections
-        kk = 0
-        for k, (m, params) in enumerate(model.named_parameters()):
-            if k < 4 and len(params.size()) != 1:
-                sz = params.grad.data.size(0)
-                params.grad.data = params.grad.data - torch.mm(params.grad.data.view(sz, -1),
-                                                               feature_mat[kk]).view(params.size())
-                kk += 1
-            elif (k < 4 and len(params.size()) == 1) and task_id != 0:
-                params.grad.data.fill_(0)
-
+        # Gradient Projections are applied in the optimizer step
         optimizer.step()
+        step()
 
 
+@profiled('test')
 def test(args, model, device, x, y, criterion, task_id):
     '''Evaluate the model on the test set'''
     model.eval()
-    total_loss = 0
+    total_loss = torch.zeros((), device=device)
     total_num = 0
-    correct = 0
-    r = np.arange(x.size(0))
-    np.random.shuffle(r)
-    r = torch.LongTensor(r).to(device)
-    with torch.no_grad():
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    with evaluation_mode(args.inference_mode):
         # Loop batches
-        for i in range(0, len(r), args.batch_size_test):
-            if i+args.batch_size_test <= len(r):
-                b = r[i:i+args.batch_size_test]
-            else:
-                b = r[i:]
+        for i in range(0, x.size(0), args.batch_size_test):
+            b = slice(i, i + args.batch_size_test)
             data = x[b]
-            data, target = data.to(device), y[b].to(device)
-            output = model(data, task_id, None, -1)
+            data, target = data.to(device, memory_format=memory_format(args.channels_last)), y[b].to(device)
+            output = model(data)
             loss = criterion(output[task_id], target)
             pred = output[task_id].argmax(dim=1, keepdim=True)
 
-            correct += pred.eq(target.view_as(pred)).sum().item()
-            total_loss += loss.data.cpu().numpy().item()*len(b)
-            total_num += len(b)
+            correct += pred.eq(target.view_as(pred)).sum()
+            total_loss += loss * len(target)
+            total_num += len(target)
 
-    acc = 100. * correct / total_num
-    final_loss = total_loss / total_num
+    acc = 100. * correct.item() / total_num
+    final_loss = total_loss.item() / total_num
     return final_loss, acc
 
 
-def get_representation_matrix(task_id, net, device, x, y, old_task_distribution):
-    '''Get the representation matrix for the current task'''
+@profiled('representation')
+def get_representation_matrix(task_id, net, device, x, y, old_task_distribution, sampler, matrices=True):
+    '''Get the representation matrix for the current task
+
+    The distributions of the task are appended in any case; the im2col
+    matrices are only built (and returned) with matrices=True, for update_GPM.
+    '''
     net.eval()
-    example_data = []
-    r = np.arange(x.size(0))
-    np.random.shuffle(r)
-    r = torch.LongTensor(r).to(device)
-    un = torch.unique(y)
-    idx = 0
-    for _ in range(25):
-        b = []
-        for i in un:
-            while y[idx] != i:
-                idx += 1
-            b.append(idx)
-        assert len(b) == 5
-        tmp_data = x[b].to(device)
-        target = y[b]
-        example_data.append(tmp_data)
-
-    example_data = torch.cat(example_data, dim=0)
-    example_data = example_data.to(device)
-    example_out = net(example_data, task_id, None, -1)
+    # 25 examples of each class
+    b = sampler.sample(task_id, y, per_class=25)
+    example_data = x[b].to(device)
+    with recording(net):
+        example_out = net(example_data)
 
     batch_list = [2*12, 100, 125, 125]
     pad = 2
@@ -347,24 +310,27 @@ def get_representation_matrix(task_id, net, device, x, y, old_task_distribution)
         if i < 2:
             ksz = net.ksize[i]
             s = compute_conv_output_size(net.map[i], net.ksize[i], 1, pad)
-            mat = np.zeros((net.ksize[i]*net.ksize[i]
-                           * net.in_channel[i], s*s*bsz))
             act = F.pad(net.act[act_key[i]], p1d,
-                        "constant", 0).detach().cpu().numpy()
-
-            for kk in range(bsz):
-                for ii in range(s):
-                    for jj in range(s):
-                        mat[:, k] = act[kk, :, ii:ksz+ii,
-                                        jj:ksz+jj].reshape(-1)  # ?
-                        k += 1
-            mat_list.append(mat)
-            old_task_distribution[task_id][i].append(deepcopy(mat.flatten()))
+                        "constant", 0).detach().contiguous().cpu().numpy()
+
+            if matrices:
+                mat = np.zeros((net.ksize[i]*net.ksize[i]
+                               * net.in_channel[i], s*s*bsz))
+                for kk in range(bsz):
+                    for ii in range(s):
+                        for jj in range(s):
+                            mat[:, k] = act[kk, :, ii:ksz+ii,
+                                            jj:ksz+jj].reshape(-1)  # ?
+                            k += 1
+                mat_list.append(mat)
+            old_task_distribution[task_id][i].append(Distribution.im2col(act[0:bsz], ksz, 1, s))
         else:
             act = net.act[act_key[i]].detach().cpu().numpy()
             activation = act[0:bsz].transpose()
             mat_list.append(activation)
             old_task_distribution[task_id][i].append(deepcopy(activation.flatten()))
+    if not matrices:
+        return None
 
     print('-'*30)
     print('Representation Matrix')
@@ -375,85 +341,22 @@ def get_representation_matrix(task_id, net, device, x, y, old_task_distribution)
     return mat_list
 
 
-def update_GPM(task_id, model, mat_list, threshold, feature_list=[], proj=None, every_task_base=None):
-    '''Update the GPM'''
-    print('Threshold: ', threshold)
-    if not feature_list:
-        # After First Task
-        for i in range(len(mat_list)):
-            activation = mat_list[i]
-            U, S, Vh = np.linalg.svd(activation, full_matrices=False)
-            # criteria (Eq-5)
-            sval_total = (S**2).sum()
-            sval_ratio = (S**2)/sval_total
-            r = np.sum(np.cumsum(sval_ratio) < threshold[i])  # +1
-            feature_list.append(U[:, 0:r])
-            proj[task_id][i] = U[:, 0:r]
-            every_task_base[task_id][i] = U[:, 0:r]
-    else:
-        for i in range(len(mat_list)):
-            activation = mat_list[i]
-            U1, S1, Vh1 = np.linalg.svd(activation, full_matrices=False)
-            sval_total = (S1**2).sum()
-            sval_ratio = (S1**2)/sval_total
-            r = np.sum(np.cumsum(sval_ratio) < threshold[i])  # +1
-            every_task_base[task_id][i] = U1[:, 0:r]
-
-            act_hat = activation - \
-                np.dot(
-                    np.dot(feature_list[i], feature_list[i].transpose()), activation)
-            U, S, Vh = np.linalg.svd(act_hat, full_matrices=False)
-
-            sval_hat = (S**2).sum()
-            sval_ratio = (S**2)/sval_total
-            accumulated_sval = (sval_total-sval_hat)/sval_total
-
-            r = 0
-            for ii in range(sval_ratio.shape[0]):
-                if accumulated_sval < threshold[i]:
-                    accumulated_sval += sval_ratio[ii]
-                    r += 1
-                else:
-                    break
-            if r != 0:
-                print('Not Skip Updating GPM for layer: {}'.format(i + 1))
-
-                # update GPM
-                Ui = np.hstack((feature_list[i], U[:, 0:r]))
-                if Ui.shape[1] > Ui.shape[0]:
-                    feature_list[i] = Ui[:, 0:Ui.shape[0]]
-                else:
-                    feature_list[i] = Ui
-            if r == 0:
-                proj[task_id][i] = proj[task_id-1][i]
-            else:
-                proj[task_id][i] = U[:, 0:r]
-
-    print('-'*40)
-    print('Gradient Constraints Summary')
-    print('-'*40)
-    for i in range(len(feature_list)):
-        print('Layer {} : {}/{}'.format(i+1,
-              feature_list[i].shape[1], feature_list[i].shape[0]))
-    print('-'*40)
-    return feature_list
-
-
+@profiled('similarity')
 def update_task_discrimination(task_id, feature_list_ori, feature_list_new, threshold=0.7):
 
     #计算训练后的下一个任务和原任务的距离
     distance_ori = []
     for t in range(task_id):
         distance_ori.append(
-            wasserstein_distance(
-                feature_list_ori[task_id].flatten(), feature_list_ori[t].flatten()
+            wasserstein(
+                feature_list_ori[task_id], feature_list_ori[t]
             )
         )
     distance_new = []
     for t in range(task_id):
         distance_new.append(
-            wasserstein_distance(
-                feature_list_new[t].flatten(), feature_list_new[t].flatten()
+            wasserstein(
+                feature_list_new[t], feature_list_new[t]
             )
         )
 
@@ -524,9 +427,13 @@ def set_seed(seed=0):
 
 def main(args):
     tstart = time.time()
+    results = Results(args.results, args, args.results_format)
     # Device Setting
     device = torch.device("cuda:{}".format(args.cuda)
                           if torch.cuda.is_available() else "cpu")
+    profiler = Profiler(device, trace=args.trace, torch_steps=args.torch_profile,
+                        torch_trace=results.path + '_torch_trace.json')
+    set_profiler(profiler)
 
     set_seed(args.seed)
 
@@ -541,11 +448,17 @@ def main(args):
                   np.array([6, 14, 0, 11, 12, 17, 13, 4, 9, 1, 7, 19, 8, 10, 3, 15, 18, 5, 2, 16])]
 
     # Load CIFAR100_SUPERCLASS DATASET
-    from dataloader import cifar100_superclass as data_loader
-    data, taskcla = data_loader.cifar100_superclass_python(
-        task_order[args.t_order], group=5, validation=True)
-    test_data, _ = data_loader.cifar100_superclass_python(
-        task_order[args.t_order], group=5)
+    if args.synthetic:
+        from dataloader.synthetic import Dataset
+        data_loader = Dataset('cifar100_superclass', args.synthetic_train)
+    else:
+        from dataloader import cifar100_superclass as data_loader
+    with stage('data_load'):
+        data, taskcla = data_loader.cifar100_superclass_python(
+            task_order[args.t_order], group=5, validation=True)
+    with stage('data_load'):
+        test_data, _ = data_loader.cifar100_superclass_python(
+            task_order[args.t_order], group=5)
     print(taskcla)
     n_task = 20
     acc_matrix = np.zeros((20, 20))
@@ -554,35 +467,67 @@ def main(args):
     task_id = 0
     task_list = []
 
-    model = LeNet(taskcla).to(device)
+    model = LeNet(taskcla).to(device, memory_format=memory_format(args.channels_last))
     model.apply(init_weights)
     for k_t, (m, param) in enumerate(model.named_parameters()):
         print(k_t, m, param.shape)
     print('-'*40)
 
-    pre_task_distribution = [[[] for j in range(4)] for i in range(n_task)]
     old_task_distribution = [[[] for j in range(4)] for i in range(n_task)]
 
-    task_id = 0
+    # representation examples, the same ones at every step of a task
+    sampler = ClassSampler(args.seed)
     print("*" * 100)
     print("Get Init Distribution.")
-    for k, ncla in taskcla:
-        xtrain = data[k]['train']['x']
-        ytrain = data[k]['train']['y']
-        mat_list = get_representation_matrix(
-            task_id, model, device, xtrain, ytrain, pre_task_distribution)
-        task_id += 1
+    # the task modules are created in the task order, whether the pass runs or not
+    for task_id, (k, ncla) in enumerate(taskcla):
+        prepare_task(model, task_id, init_weights)
+
+    def init_distribution(task_id):
+        '''Distributions of a task in the initialized model, in a worker process
+
+        task_id is the position of the task in the order, as in training, and
+        taskcla[task_id][0] its superclass in data.
+        '''
+        distribution = [[[] for j in range(4)] for i in range(n_task)]
+        k = taskcla[task_id][0]
+        prepare_task(model, task_id)
+        get_representation_matrix(
+            task_id, model, device, data[k]['train']['x'], data[k]['train']['y'], distribution, sampler, matrices=False)
+        return distribution[task_id]
+
+    cache = InitCache(args.cache_dir, __file__, seed=args.seed, model=model_version(model),
+                      device=device.type, channels_last=args.channels_last,
+                      data=data_version([(data[k]['train']['x'], data[k]['train']['y']) for k, ncla in taskcla]))
+    with stage('init_distribution'):
+        pre_task_distribution = cache.get(init_distribution, list(range(len(taskcla))),
+                                          args.init_workers, device)
     print("*" * 100)
     del model
 
-    proj = {}
-    every_task_base = {}
+    # GPM bases of every task, the older tasks on disk with --basis_hot
+    proj = BasisStore('proj', args.basis_hot, args.basis_dtype, args.basis_dir)
+    every_task_base = BasisStore('every_task_base', args.basis_hot, args.basis_dtype, args.basis_dir)
     task_id = 0
     task_list = []
 
-    for k, ncla in taskcla:
+    # fork from the snapshot of the longest run of the first tasks with this configuration
+    prefix = PrefixCache(args.cache_dir if args.prefix_cache else None, __file__, args, init=cache.key)
+    start, snapshot = prefix.find(len(taskcla))
+    if snapshot is not None:
+        model = LeNet(taskcla).to(device, memory_format=memory_format(args.channels_last))
+        compile_model(model, args.compile)
+        for t in range(start):
+            prepare_task(model, t)
+        state = prefix.restore(snapshot, model, results)
+        feature_list, proj, every_task_base = state['feature_list'], state['proj'], state['every_task_base']
+        old_task_distribution, acc_matrix, task_list = (state['old_task_distribution'], state['acc_matrix'],
+                                                        state['task_list'])
+        task_id = start
+    for k, ncla in taskcla[start:]:
+        profiler.task_id = task_id
         # specify threshold hyperparameter
-        threshold = np.array([0.98] * 5) + task_id*np.array([0.001] * 5)
+        threshold = np.array([args.gpm_threshold] * 5) + task_id * np.array([args.gpm_threshold_step] * 5)
 
         print('*'*100)
         print('Task {:2d} ({:s})'.format(k, data[k]['name']))
@@ -606,17 +551,19 @@ def main(args):
 
         if task_id == 0:
             # Initialize model
-            model = LeNet(taskcla).to(device)
+            model = LeNet(taskcla).to(device, memory_format=memory_format(args.channels_last))
+            compile_model(model, args.compile)
             print('Model parameters ---')
             for k_t, (m, param) in enumerate(model.named_parameters()):
                 print(k_t, m, param.shape)
             print('-'*40)
             # Initialize model
             model.apply(init_weights)
+            prepare_task(model, task_id, init_weights)
 
-            best_model = get_model(model)
+            best_model = BestModel(model, task_id)
             feature_list = []
-            optimizer = optim.SGD(model.parameters(),
+            optimizer = optim.SGD(trainable(model),
                                   lr=lr, momentum=args.momentum)
 
             scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
@@ -629,18 +576,21 @@ def main(args):
                       xtrain, ytrain, optimizer, criterion)
                 clock1 = time.time()
                 tr_loss, tr_acc = test(args, model, device, xtrain, ytrain,
-                                       criterion, k)
+                                       criterion, task_id)
                 print('Epoch {:3d} | Train: loss={:.3f}, acc={:5.1f}% | time={:5.1f}ms |'.format(epoch,
                                                                                                  tr_loss, tr_acc, 1000*(clock1-clock0)), end='')
                 # Validate
                 valid_loss, valid_acc = test(args, model, device, xvalid,
-                                             yvalid, criterion, k)
+                                             yvalid, criterion, task_id)
                 print(' Valid: loss={:.3f}, acc={:5.1f}% |'.format(
                     valid_loss, valid_acc), end='')
+                results.epoch(task_id, epoch, train_loss=tr_loss, train_acc=tr_acc,
+                              valid_loss=valid_loss, valid_acc=valid_acc, lr=lr,
+                              time_ms=1000*(clock1-clock0))
                 # Adapt lr
                 if valid_loss < best_loss:
                     best_loss = valid_loss
-                    best_model = get_model(model)
+                    best_model.save()
                     patience = args.lr_patience
                     print(' *', end='')
                 scheduler.step()
@@ -649,20 +599,21 @@ def main(args):
             # Test
             print('-'*40)
             test_loss, test_acc = test(
-                args, model, device, xtest, ytest,  criterion, k)
+                args, model, device, xtest, ytest,  criterion, task_id)
             print('Test: loss={:.3f} , acc={:5.1f}%'.format(
                 test_loss, test_acc))
             # Memory Update
             mat_list = get_representation_matrix(
-                task_id, model, device, xtrain, ytrain, old_task_distribution)
+                task_id, model, device, xtrain, ytrain, old_task_distribution, sampler)
             feature_list = update_GPM(
                 task_id, model, mat_list, threshold, feature_list, proj, every_task_base)
 
         else:
+            prepare_task(model, task_id, init_weights)
             sim_tasks = [i for i in range(20)]
                 # Calculate the distribution of each layer of the current task
-            _ = get_representation_matrix(
-                task_id, model, device, xtrain, ytrain, old_task_distribution)
+            get_representation_matrix(
+                task_id, model, device, xtrain, ytrain, old_task_distribution, sampler, matrices=False)
                 # Calculate the distance between the current task and the previous task
             cnt = 0
             for kk, (m, params) in enumerate(model.named_parameters()):
@@ -673,7 +624,7 @@ def main(args):
                         for ttt in range(task_id+1):
                             pre_tmp.append(pre_task_distribution[ttt][cnt][0])
                             old_tmp.append(old_task_distribution[ttt][cnt][0])
-                        sim_tasks[cnt] = update_task_discrimination(task_id, pre_tmp, old_tmp, threshold=0.8)
+                        sim_tasks[cnt] = update_task_discrimination(task_id, pre_tmp, old_tmp, threshold=args.sim_threshold)
                     cnt += 1
 
             print("*" * 40)
@@ -686,12 +637,6 @@ def main(args):
                     cnt += 1
             print("*" * 40)
 
-            optimizer = optim.SGD(model.parameters(),
-                                  lr=lr, momentum=args.momentum)
-
-            scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
-                optimizer, T_max=args.n_epochs)
-
             feature_mat = []
             # Projection Matrix Precomputation
             for i in range(len(model.act)):
@@ -700,6 +645,14 @@ def main(args):
                 print('Layer {} - Projection Matrix shape: {}'.format(i+1, Uf.shape))
                 feature_mat.append(Uf)
             print('-'*40)
+            projectors, frozen = get_projectors(model, feature_mat, task_id)
+            optimizer = ProjectedSGD(trainable(model), lr=lr, momentum=args.momentum,
+                                     projectors=projectors, frozen=frozen,
+                                     tol=args.ortho_tol if args.precision == 'bf16' else None)
+            # the optimizer keeps the projectors stacked, drop the dense copies
+            del feature_mat, projectors, Uf
+            scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
+                optimizer, T_max=args.n_epochs)
 
             p = [None, None, None, None]
             if task_id >= 1:
@@ -707,25 +660,35 @@ def main(args):
                 for i in range(4):
                     p[i] = torch.FloatTensor(proj[task_id-1][i]).to(device)
 
+            # project the weights on the first batch of the task
+            set_projections(model, p)
+            best_model = BestModel(model, task_id)
+
+            # projectors of the knowledge transfer loss, built once per task
+            transfer = TransferLoss(transfer_layers(every_task_base, sim_tasks, model, task_id), device,
+                                    every=args.kt_every, epochs=args.kt_epochs, tol=args.kt_tol)
             for epoch in range(1, args.n_epochs+1):
                 # Train
                 clock0 = time.time()
-                train_projected(args, p, model, device, xtrain,
-                                ytrain, optimizer, criterion, feature_mat, k, epoch, sim_tasks,  every_task_base)
+                train_projected(args, model, device, xtrain,
+                                ytrain, optimizer, criterion, task_id, transfer)
                 clock1 = time.time()
                 tr_loss, tr_acc = test(
-                    args, model, device, xtrain, ytrain, criterion, k)
+                    args, model, device, xtrain, ytrain, criterion, task_id)
                 print('Epoch {:3d} | Train: loss={:.3f}, acc={:5.1f}% | time={:5.1f}ms |'.format(epoch,
                                                                                                  tr_loss, tr_acc, 1000*(clock1-clock0)), end='')
                 # Validate
                 valid_loss, valid_acc = test(
-                    args, model, device, xvalid, yvalid, criterion, k)
+                    args, model, device, xvalid, yvalid, criterion, task_id)
                 print(' Valid: loss={:.3f}, acc={:5.1f}% |'.format(
                     valid_loss, valid_acc), end='')
+                results.epoch(task_id, epoch, train_loss=tr_loss, train_acc=tr_acc,
+                              valid_loss=valid_loss, valid_acc=valid_acc, lr=lr,
+                              time_ms=1000*(clock1-clock0), kt_loss=transfer.value())
                 # Adapt lr
                 if valid_loss < best_loss:
                     best_loss = valid_loss
-                    best_model = get_model(model)
+                    best_model.save()
                     patience = args.lr_patience
                     print(' *', end='')
                 scheduler.step()
@@ -733,29 +696,34 @@ def main(args):
 
             # Test
             test_loss, test_acc = test(
-                args, model, device, xtest, ytest,  criterion, k)
+                args, model, device, xtest, ytest,  criterion, task_id)
             print('Test: loss={:.3f} , acc={:5.1f}%'.format(
                 test_loss, test_acc))
             # Memory Update
             mat_list = get_representation_matrix(
-                task_id, model, device, xtrain, ytrain, old_task_distribution)
+                task_id, model, device, xtrain, ytrain, old_task_distribution, sampler)
             feature_list = update_GPM(
                 task_id, model, mat_list, threshold, feature_list, proj, every_task_base)
 
         # save accuracy
-        jj = 0
-        for ii in task_order[args.t_order][0:task_id+1]:
-            xtest = test_data[ii]['test']['x']
-            ytest = test_data[ii]['test']['y']
-            _, acc_matrix[task_id, jj] = test(
-                args, model, device, xtest, ytest, criterion, ii)
-            jj += 1
+        sets = [(jj, test_data[ii]['test']['x'], test_data[ii]['test']['y'])
+                for jj, ii in enumerate(task_order[args.t_order][0:task_id + 1])]
+        acc_matrix[task_id, 0:task_id + 1] = evaluate_tasks(
+            model, device, sets, args.batch_size_test,
+            memory_format=memory_format(args.channels_last))
         print('Accuracies =')
         for i_a in range(task_id+1):
             print('\t', end='')
             for j_a in range(acc_matrix.shape[1]):
                 print('{:5.1f}% '.format(acc_matrix[i_a, j_a]), end='')
             print()
+        results.timings(profiler.table())
+        results.accuracy(acc_matrix[:task_id + 1], task_list)
+        results.save()
+        profiler.save()
+        prefix.save(task_id, model, results, feature_list=feature_list, proj=proj,
+                    every_task_base=every_task_base, old_task_distribution=old_task_distribution,
+                    acc_matrix=acc_matrix, task_list=task_list)
         # update task id
         task_id += 1
     print('-'*50)
@@ -766,15 +734,9 @@ def main(args):
     print('Backward transfer: {:5.2f}%'.format(bwt))
     print('[Elapsed time = {:.1f} ms]'.format((time.time()-tstart)*1000))
     print('-'*50)
-    # Plots
-    array = acc_matrix
-    df_cm = pd.DataFrame(array, index=[i for i in ["1", "2", "3", "4", "5", "6", "7",
-                                                   "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20"]],
-                         columns=[i for i in ["1", "2", "3", "4", "5", "6", "7",
-                                              "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20"]])
-    sn.set(font_scale=1.4)
-    sn.heatmap(df_cm, annot=True, annot_kws={"size": 10})
-    plt.show()
+    profiler.report()
+    results.summary(acc=acc_matrix[-1].mean(), bwt=bwt, elapsed_ms=(time.time() - tstart) * 1000)
+    results.save()
 
 
 if __name__ == "__main__":
@@ -783,6 +745,8 @@ if __name__ == "__main__":
                         help='input batch size for training (default: 64)')
     parser.add_argument('--batch_size_test', type=int, default=64, metavar='N',
                         help='input batch size for testing (default: 64)')
+    parser.add_argument('--inference_mode', action='store_true', default=False,
+                        help='run the test loops under torch.inference_mode')
     parser.add_argument('--n_epochs', type=int, default=200, metavar='N',
                         help='number of training epochs/task (default: 200)')
     parser.add_argument('--seed', type=int, default=1, metavar='S',
@@ -806,6 +770,74 @@ if __name__ == "__main__":
     parser.add_argument('--lr_factor', type=int, default=2, metavar='LRF',
                         help='lr decay factor (default: 2)')
 
+    # Results
+    parser.add_argument('--results', type=str, default=None, metavar='PATH',
+                        help='path prefix of the results files (default: ./results/<script>_seed<seed>)')
+    parser.add_argument('--results_format', type=str, nargs='*', default=['csv'], choices=['csv', 'parquet'],
+                        help='tables written next to the JSON results (default: csv)')
+
+    # Profiling
+    parser.add_argument('--trace', type=str, default=None, metavar='PATH',
+                        help='Chrome trace of the stages (data load, training, evaluation, GPM SVDs, ...) (default: none)')
+    parser.add_argument('--torch_profile', type=int, default=0, metavar='N',
+                        help='training steps recorded with torch.profiler, written to <results>_torch_trace.json (default: 0)')
+
+    # Synthetic data
+    parser.add_argument('--synthetic', action='store_true', default=False,
+                        help='seeded synthetic tasks of the dataset shapes instead of the data files, offline')
+    parser.add_argument('--synthetic_train', type=int, default=0, metavar='N',
+                        help='training examples per synthetic task, 0 for about as many as the real tasks (default: 0)')
+
+    # Knowledge transfer
+    parser.add_argument('--kt_every', type=int, default=1, metavar='K',
+                        help='evaluate the knowledge transfer loss every K steps, weighted by K (default: 1)')
+    parser.add_argument('--kt_epochs', type=int, default=0, metavar='N',
+                        help='use the knowledge transfer loss in the first N epochs of a task, 0 for all (default: 0)')
+    parser.add_argument('--kt_tol', type=float, default=0., metavar='TOL',
+                        help='drop the knowledge transfer loss of a task once its epoch mean is below TOL, 0 to keep it (default: 0)')
+
+    # Cache
+    parser.add_argument('--cache_dir', type=str, default='cache', metavar='DIR',
+                        help='cache of the initial distributions, shared by the runs, "" to disable (default: cache)')
+    parser.add_argument('--init_workers', type=int, default=0, metavar='N',
+                        help='processes of the initial distribution pass, 0 for one per task up to the CPUs (default: 0)')
+    parser.add_argument('--prefix_cache', action='store_true', default=False,
+                        help='snapshot the run after every task in the cache and start from the longest '
+                             'snapshot of the same configuration, for sweeps')
+
+    # GPM bases
+    parser.add_argument('--basis_hot', type=int, default=0, metavar='N',
+                        help='tasks whose GPM bases stay in memory, the older ones are memory-mapped from disk, '
+                             '0 to keep every task in memory (default: 0)')
+    parser.add_argument('--basis_dtype', type=str, default='float32', choices=['float64', 'float32', 'float16'],
+                        help='precision of the GPM bases on disk (default: float32)')
+    parser.add_argument('--basis_dir', type=str, default=None, metavar='DIR',
+                        help='directory of the GPM bases on disk, better on a disk than on a tmpfs '
+                             '(default: the temporary directory)')
+
+    # Thresholds
+    parser.add_argument('--gpm_threshold', type=float, default=0.98, metavar='TH',
+                        help='GPM energy threshold of the first task (default: 0.98)')
+    parser.add_argument('--gpm_threshold_step', type=float, default=0.001, metavar='TH',
+                        help='growth of the GPM energy threshold per task (default: 0.001)')
+    parser.add_argument('--sim_threshold', type=float, default=0.8, metavar='TH',
+                        help='similarity threshold of the knowledge transfer tasks (default: 0.8)')
+
+    # Precision
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='training precision, bf16 autocasts the forward pass and loss (default: fp32)')
+    parser.add_argument('--ortho_tol', type=float, default=1e-3, metavar='TOL',
+                        help='max relative residual of the projected gradients in bf16 mode (default: 1e-3)')
+
+    # Memory format
+    parser.add_argument('--channels_last', action='store_true', default=False,
+                        help='run the conv layers in channels-last memory format')
+
+    # Compilation
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='run the forward passes under torch.compile (torch >= 2.0), the first '
+                             'projected batch of a task and the representation passes eagerly')
+
     args = parser.parse_args()
     print('='*100)
     print('Arguments =')
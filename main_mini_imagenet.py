@@ -12,19 +12,29 @@ import os
 import os.path
 from collections import OrderedDict
 
-import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sn
-import pandas as pd
 import random
 import pdb
 import argparse
 import time
 import math
-from copy import deepcopy
-from scipy.stats import wasserstein_distance
 from scipy.spatial.distance import euclidean
 
+from stil.gpm import update_GPM
+from stil.evaluation import evaluate_tasks, evaluation_mode
+from stil.optim import ProjectedSGD
+from stil.precision import autocast
+from stil.layers import TaskModuleList, compile_model, memory_format, prepare_task, recording, set_projections, set_task, trainable
+from stil.snapshot import BestModel
+from stil.results import Results
+from stil.profiler import Profiler, profiled, set_profiler, stage, step
+from stil.transfer import TransferLoss
+from stil.sampling import ClassSampler
+from stil.cache import InitCache, file_version, model_version
+from stil.prefix import PrefixCache
+from stil.store import BasisStore
+from stil.similarity import Distribution, wasserstein
+
 class Sequential(nn.Sequential):
 
     def __init__(self, *args):
@@ -36,15 +46,11 @@ class Sequential(nn.Sequential):
             for idx, module in enumerate(args):
                 self.add_module(str(idx), module)
 
-    def forward(self, input, t, p, epoch):
-        for module in self:
-            input = module(input, t, p, epoch)
-        return input
-
 
 class Shortcut(nn.Module):
     def __init__(self, stride, in_planes, expansion, planes):
         super(Shortcut, self).__init__()
+        self.task = 0  # selects the task BN
         self.identity = True
         self.shortcut = Sequential()
 
@@ -52,17 +58,14 @@ class Shortcut(nn.Module):
             self.identity = False
             self.conv1 = nn.Conv2d(
                 in_planes, expansion*planes, kernel_size=1, stride=stride, bias=False)
-            self.bn1 = nn.ModuleList()
-            for _ in range(20):
-                self.bn1.append(nn.BatchNorm2d(
-                    expansion*planes))
+            self.bn1 = TaskModuleList(lambda t: nn.BatchNorm2d(expansion*planes), 20)
 
-    def forward(self, x, t, p, epoch):
+    def forward(self, x):
         if self.identity:
-            out = self.shortcut(x, t, p, epoch)
+            out = self.shortcut(x)
         else:
             out = self.conv1(x)
-            out = self.bn1[t](out)
+            out = self.bn1[self.task](out)
         return out
 
 
@@ -82,19 +85,22 @@ class Conv2d(nn.Conv2d):
                                      stride=stride,
                                      padding=padding,
                                      bias=bias)
-
-    def forward(self, input, task_id, p, epoch):
-        if p is not None:
-            if epoch == 1:
-                sz = self.weight.grad.data.size(0)
-                norm_project = torch.mm(p, p.transpose(1, 0))
-                proj_weight = torch.mm(self.weight.view(sz, -1),
-                                       norm_project).view(self.weight.size())
+        self.norm_project = None
+
+    def set_projection(self, p):
+        # the projection is folded into the weights of the next forward only
+        self.norm_project = None if p is None else torch.mm(p, p.transpose(1, 0))
+
+    def forward(self, input):
+        masked_weight = self.weight
+        if self.norm_project is not None:
+            # the weight projection stays in float32 under autocast
+            with torch.autocast(input.device.type, enabled=False):
+                sz = self.weight.size(0)
+                proj_weight = torch.mm(self.weight.reshape(sz, -1),
+                                       self.norm_project).view(self.weight.size())
                 masked_weight = self.weight - proj_weight
-            else:
-                masked_weight = self.weight
-        else:
-            masked_weight = self.weight
+                self.norm_project = None
         return F.conv2d(input, masked_weight, self.bias, self.stride,
                         self.padding, self.dilation, self.groups)
 
@@ -104,44 +110,27 @@ class BasicBlock(nn.Module):
 
     def __init__(self, in_planes, planes, stride=1):
         super(BasicBlock, self).__init__()
+        self.task = 0  # selects the task BN
         self.conv1 = conv3x3(in_planes, planes, stride)
-        self.bn1 = nn.ModuleList()
-        for i in range(20):
-            self.bn1.append(nn.BatchNorm2d(planes))
+        self.bn1 = TaskModuleList(lambda t: nn.BatchNorm2d(planes), 20)
         self.conv2 = conv3x3(planes, planes)
-        self.bn2 = nn.ModuleList()
-        for i in range(20):
-            self.bn2.append(nn.BatchNorm2d(planes))
+        self.bn2 = TaskModuleList(lambda t: nn.BatchNorm2d(planes), 20)
 
         self.shortcut = Sequential()
         self.shortcut = Shortcut(
             stride=stride, in_planes=in_planes, expansion=self.expansion, planes=planes)
         self.act = OrderedDict()
-        self.count = 0
-
-    def forward(self, x, t, p, epoch):
-        if p is None:
-            self.count = self.count % 2
-            self.act['conv_{}'.format(self.count)] = x
-            self.count += 1
-            out = relu(self.bn1[t](self.conv1(x, t, None, epoch)))
-            self.count = self.count % 2
-            self.act['conv_{}'.format(self.count)] = out
-            self.count += 1
-            out = self.bn2[t](self.conv2(out, t, None, epoch))
-            out += self.shortcut(x, t, None, epoch)
-            out = relu(out)
-        else:
-            self.count = self.count % 2
-            self.act['conv_{}'.format(self.count)] = x
-            self.count += 1
-            out = relu(self.bn1[t](self.conv1(x, t, p[0], epoch)))
-            self.count = self.count % 2
-            self.act['conv_{}'.format(self.count)] = out
-            self.count += 1
-            out = self.bn2[t](self.conv2(out, t, p[1], epoch))
-            out += self.shortcut(x, t, None, epoch)
-            out = relu(out)
+        self.record = False
+
+    def forward(self, x):
+        if self.record:
+            self.act['conv_0'] = x
+        out = relu(self.bn1[self.task](self.conv1(x)))
+        if self.record:
+            self.act['conv_1'] = out
+        out = self.bn2[self.task](self.conv2(out))
+        out = out + self.shortcut(x)
+        out = relu(out)
         return out
 
 def compute_conv_output_size(Lin, kernel_size, stride=1, padding=0, dilation=1):
@@ -161,22 +150,20 @@ def conv7x7(in_planes, out_planes, stride=1):
 class ResNet(nn.Module):
     def __init__(self, block, num_blocks, taskcla, nf):
         super(ResNet, self).__init__()
+        self.task = 0  # selects the task BN
         self.taskcla = taskcla
         self.in_planes = nf
         self.conv1 = conv3x3(3, nf * 1, 2)
-        self.bn1 = nn.ModuleList()
-        for t, n in self.taskcla:
-            self.bn1.append(nn.BatchNorm2d(nf * 1))
+        self.bn1 = TaskModuleList(lambda t: nn.BatchNorm2d(nf * 1), len(self.taskcla))
         self.layer1 = self._make_layer(block, nf * 1, num_blocks[0], stride=1)
         self.layer2 = self._make_layer(block, nf * 2, num_blocks[1], stride=2)
         self.layer3 = self._make_layer(block, nf * 4, num_blocks[2], stride=2)
         self.layer4 = self._make_layer(block, nf * 8, num_blocks[3], stride=2)
 
-        self.linear = torch.nn.ModuleList()
-        for t, n in self.taskcla:
-            self.linear.append(
-                nn.Linear(nf * 8 * block.expansion * 9, n, bias=False))
+        self.linear = TaskModuleList(
+            lambda t: nn.Linear(nf * 8 * block.expansion * 9, self.taskcla[t][1], bias=False), len(self.taskcla))
         self.act = OrderedDict()
+        self.record = False
 
     def _make_layer(self, block, planes, num_blocks, stride):
         strides = [stride] + [1] * (num_blocks - 1)
@@ -186,40 +173,21 @@ class ResNet(nn.Module):
             self.in_planes = planes * block.expansion
         return Sequential(*layers)
 
-    def forward(self, x, t, p, epoch):
-        if p is None:
-            bsz = x.size(0)
-            self.act['conv_in'] = x.view(bsz, 3, 84, 84)
-            out = relu(self.bn1[t](self.conv1(
-                x.view(bsz, 3, 84, 84), t, None, epoch)))
-            out = self.layer1(out, t, None, epoch)
-            out = self.layer2(out, t, None, epoch)
-            out = self.layer3(out, t, None, epoch)
-            out = self.layer4(out, t, None, epoch)
-            out = avg_pool2d(out, 2)
-            out = out.view(out.size(0), -1)
-            y = []
-            for t, i in self.taskcla:
-                y.append(self.linear[t](out))
-        else:
-            bsz = x.size(0)
-            self.act['conv_in'] = x.view(bsz, 3, 84, 84)
-            out = relu(
-                self.bn1[t](self.conv1(x.view(bsz, 3, 84, 84), t, p[0], epoch)))
-            out = self.layer1[0](out, t, p[1:3], epoch)
-            out = self.layer1[1](out, t, p[3:5], epoch)
-            out = self.layer2[0](out, t, p[5:8], epoch)
-            out = self.layer2[1](out, t, p[8:10], epoch)
-            out = self.layer3[0](out, t, p[10:13], epoch)
-            out = self.layer3[1](out, t, p[13:15], epoch)
-            out = self.layer4[0](out, t, p[15:18], epoch)
-            out = self.layer4[1](out, t, p[18:20], epoch)
-
-            out = avg_pool2d(out, 2)
-            out = out.view(out.size(0), -1)
-            y = []
-            for t, i in self.taskcla:
-                y.append(self.linear[t](out))
+    def forward(self, x):
+        bsz = x.size(0)
+        if self.record:
+            self.act['conv_in'] = x.reshape(bsz, 3, 84, 84)
+        out = relu(self.bn1[self.task](self.conv1(
+            x.reshape(bsz, 3, 84, 84))))
+        out = self.layer1(out)
+        out = self.layer2(out)
+        out = self.layer3(out)
+        out = self.layer4(out)
+        out = avg_pool2d(out, 2)
+        out = out.reshape(out.size(0), -1)
+        y = []
+        for head in self.linear:
+            y.append(head(out))
         return y
 
 
@@ -227,15 +195,6 @@ def ResNet18(taskcla, nf=32):
     return ResNet(BasicBlock, [2, 2, 2, 2], taskcla, nf)
 
 
-def get_model(model):
-    return deepcopy(model.state_dict())
-
-
-def set_model_(model, state_dict):
-    model.load_state_dict(deepcopy(state_dict))
-    return
-
-
 def adjust_learning_rate(optimizer, epoch, args):
     for param_group in optimizer.param_groups:
         if (epoch == 1):
@@ -244,8 +203,10 @@ def adjust_learning_rate(optimizer, epoch, args):
             param_group['lr'] /= args.lr_factor
 
 
+@profiled('train')
 def train(args, model, device, x, y, optimizer, criterion, task_id):
     model.train()
+    set_task(model, task_id)
     r = np.arange(x.size(0))
     np.random.shuffle(r)
     r = torch.LongTensor(r).to(device)
@@ -256,19 +217,20 @@ def train(args, model, device, x, y, optimizer, criterion, task_id):
         else:
             b = r[i:]
         data = x[b]
-        data, target = data.to(device), y[b].to(device)
+        data, target = data.to(device, memory_format=memory_format(args.channels_last)), y[b].to(device)
         optimizer.zero_grad()
-        output = model(data, task_id, None, -1)
-        loss = criterion(output[task_id], target)
+        with autocast(args.precision, device):
+            output = model(data)
+            loss = criterion(output[task_id], target)
         loss.backward()
         optimizer.step()
+        step()
 
 
-def contrast_cls(every_task_base, sim_tasks, model, task_id, device, criterion):
-    l2 = 0
+def transfer_layers(every_task_base, sim_tasks, model, task_id):
+    '''(param, current base, similar task bases) of the knowledge transfer layers'''
+    layers = []
     cnt = 0
-    stride_list = [1, 1, 1, 1, 1, 2, 1, 1, 1, 2, 1, 1, 1, 2, 1, 1, 1]
-
     ttt = 0
     for k, (m, params) in enumerate(model.named_parameters()):
         if "short" in m and "conv" in m:
@@ -277,31 +239,29 @@ def contrast_cls(every_task_base, sim_tasks, model, task_id, device, criterion):
             continue
 
         if "conv" in m and len(params.size()) == 4:
-            sz = params.size(0)
-            current_base = torch.FloatTensor(every_task_base[task_id-1][cnt]).to(device)
-            norm_project = torch.mm(current_base, current_base.transpose(1, 0))
-            current_proj_weight = torch.mm(params.view(sz, -1),
-                                       norm_project).view(params.size())
-            loss = []
-            for tt in sim_tasks[cnt-ttt]:
-                tmp = torch.FloatTensor(every_task_base[tt][cnt]).to(device)
-                norm_project = torch.mm(tmp, tmp.transpose(1, 0))
-                sim_proj_weight = torch.mm(params.view(sz, -1),
-                                       norm_project).view(params.size())
-                cos_sim = torch.nn.functional.cosine_similarity(current_proj_weight.view(sz, -1),sim_proj_weight.view(sz, -1), dim=1)
-                cos_sim = (torch.mean(cos_sim) + 1.0) / 2.0 
-                label = torch.ones(1).to(device)
-
-                loss.append(torch.nn.functional.binary_cross_entropy(cos_sim.view(1), label))
-            if len(loss) != 0:
-                loss = torch.mean(torch.stack(loss))
-                l2 += loss
+            layers.append((params, every_task_base[task_id-1][cnt],
+                           [every_task_base[tt][cnt] for tt in sim_tasks[cnt-ttt]]))
             cnt += 1
-    return l2
+    return layers
+
 
+def get_projectors(model, feature_mat, task_id):
+    '''Pair the projected params with their projection matrices'''
+    projectors = []
+    frozen = []
+    kk = 0
+    for k, (m, params) in enumerate(model.named_parameters()):
+        if len(params.size()) == 4:
+            projectors.append((params, feature_mat[kk]))
+            kk += 1
+    return projectors, frozen
 
-def train_projected(args, p, model, device, x, y, optimizer, criterion, feature_mat, task_id, epoch, sim_tasks,  every_task_base):
+
+@profiled('train')
+def train_projected(args, model, device, x, y, optimizer, criterion, task_id, transfer):
     model.train()
+    transfer.epoch()
+    set_task(model, task_id)
     r = np.arange(x.size(0))
     np.random.shuffle(r)
     r = torch.LongTensor(r).to(device)
@@ -312,69 +272,58 @@ def train_projected(args, p, model, device, x, y, optimizer, criterion, feature_
         else:
             b = r[i:]
         data = x[b]
-        data, target = data.to(device), y[b].to(device)
+        data, target = data.to(device, memory_format=memory_format(args.channels_last)), y[b].to(device)
         optimizer.zero_grad()
-        output = model(data, task_id, p, epoch + i)
-        loss = criterion(output[task_id], target)
+        with autocast(args.precision, device):
+            output = model(data)
+            loss = criterion(output[task_id], target)
 
-        if len(sim_tasks) != 0:
-            l2 = contrast_cls(every_task_base, sim_tasks,
-                               model, task_id, device, criterion)
-            loss += l2
+        kt_loss = transfer.step()
+        if kt_loss is not None:
+            loss += kt_loss
 
         loss.backward()
-        # Gradient Projections
-        kk = 0
-        for k, (m, params) in enumerate(model.named_parameters()):
-            if len(params.size()) == 4:
-                sz = params.grad.data.size(0)
-                params.grad.data = params.grad.data - torch.mm(params.grad.data.view(sz, -1),
-                                                               feature_mat[kk]).view(params.size())
-                kk += 1
-
+        # Gradient Projections are applied in the optimizer step
         optimizer.step()
+        step()
 
 
+@profiled('test')
 def test(args, model, device, x, y, criterion, task_id,):
     model.eval()
-    total_loss = 0
+    set_task(model, task_id)
+    total_loss = torch.zeros((), device=device)
     total_num = 0
-    correct = 0
-    r = np.arange(x.size(0))
-    np.random.shuffle(r)
-    r = torch.LongTensor(r).to(device)
-    with torch.no_grad():
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    with evaluation_mode(args.inference_mode):
         # Loop batches
-        for i in range(0, len(r), args.batch_size_test):
-            if i+args.batch_size_test <= len(r):
-                b = r[i:i+args.batch_size_test]
-            else:
-                b = r[i:]
+        for i in range(0, x.size(0), args.batch_size_test):
+            b = slice(i, i + args.batch_size_test)
             data = x[b]
-            data, target = data.to(device), y[b].to(device)
-            output = model(data, task_id, None, -1)
+            data, target = data.to(device, memory_format=memory_format(args.channels_last)), y[b].to(device)
+            output = model(data)
             loss = criterion(output[task_id], target)
             pred = output[task_id].argmax(dim=1, keepdim=True)
 
-            correct += pred.eq(target.view_as(pred)).sum().item()
-            total_loss += loss.data.cpu().numpy().item()*len(b)
-            total_num += len(b)
+            correct += pred.eq(target.view_as(pred)).sum()
+            total_loss += loss * len(target)
+            total_num += len(target)
 
-    acc = 100. * correct / total_num
-    final_loss = total_loss / total_num
+    acc = 100. * correct.item() / total_num
+    final_loss = total_loss.item() / total_num
     return final_loss, acc
 
 
-def get_representation_matrix(task_id, net, device, x, y, old_task_distribution):
+@profiled('representation')
+def get_representation_matrix(task_id, net, device, x, y, old_task_distribution, sampler, matrices=True):
     # Collect activations by forward pass
     net.eval()
-    r = np.arange(x.size(0))
-    np.random.shuffle(r)
-    r = torch.LongTensor(r).to(device)
-    b = r[0:100]
+    b = sampler.sample(task_id, y, n=100)
     example_data = x[b]
     example_data = example_data.to(device)
-    example_out = net(example_data, task_id, None, -1)
+    set_task(net, task_id)
+    with recording(net):
+        example_out = net(example_data)
 
     act_list = []
     act_list.extend([net.act['conv_in'],
@@ -398,6 +347,10 @@ def get_representation_matrix(task_id, net, device, x, y, old_task_distribution)
     mat_final = []  # list containing GPM Matrices
     mat_list = []
     mat_sc_list = []
+    # distributions of the im2col entries, from the activations; the matrices
+    # themselves are only built for update_GPM (matrices=True)
+    dist_list = []
+    dist_sc_list = []
     for i in range(len(stride_list)):
         if i == 0:
             ksz = 3
@@ -407,39 +360,49 @@ def get_representation_matrix(task_id, net, device, x, y, old_task_distribution)
         st = stride_list[i]
         k = 0
         s = compute_conv_output_size(map_list[i], ksz, stride_list[i], pad)
-        mat = np.zeros((ksz*ksz*in_channel[i], s*s*bsz))
-        act = F.pad(act_list[i], p1d, "constant", 0).detach().cpu().numpy()
-        for kk in range(bsz):
-            for ii in range(s):
-                for jj in range(s):
-                    mat[:, k] = act[kk, :, st*ii:ksz+st *
-                                    ii, st*jj:ksz+st*jj].reshape(-1)
-                    k += 1
-        mat_list.append(mat)
-        # For Shortcut Connection
-        if i in sc_list:
-            k = 0
-            s = compute_conv_output_size(map_list[i], 1, stride_list[i])
-            mat = np.zeros((1*1*in_channel[i], s*s*bsz))
-            act = act_list[i].detach().cpu().numpy()
+        act = F.pad(act_list[i], p1d, "constant", 0).detach().contiguous().cpu().numpy()
+        if matrices:
+            mat = np.zeros((ksz*ksz*in_channel[i], s*s*bsz))
             for kk in range(bsz):
                 for ii in range(s):
                     for jj in range(s):
-                        mat[:, k] = act[kk, :, st*ii:1+st *
-                                        ii, st*jj:1+st*jj].reshape(-1)
+                        mat[:, k] = act[kk, :, st*ii:ksz+st *
+                                        ii, st*jj:ksz+st*jj].reshape(-1)
                         k += 1
-            mat_sc_list.append(mat)
-
+            mat_list.append(mat)
+        dist_list.append(Distribution.im2col(act[0:bsz], ksz, st, s))
+        # For Shortcut Connection
+        if i in sc_list:
+            k = 0
+            s = compute_conv_output_size(map_list[i], 1, stride_list[i])
+            act = act_list[i].detach().contiguous().cpu().numpy()
+            if matrices:
+                mat = np.zeros((1*1*in_channel[i], s*s*bsz))
+                for kk in range(bsz):
+                    for ii in range(s):
+                        for jj in range(s):
+                            mat[:, k] = act[kk, :, st*ii:1+st *
+                                            ii, st*jj:1+st*jj].reshape(-1)
+                            k += 1
+                mat_sc_list.append(mat)
+            dist_sc_list.append(Distribution.im2col(act[0:bsz], 1, st, s))
+
+    dist_final = []
     ik = 0
-    for i in range(len(mat_list)):
-        mat_final.append(mat_list[i])
+    for i in range(len(dist_list)):
+        if matrices:
+            mat_final.append(mat_list[i])
+        dist_final.append(dist_list[i])
         if i in [6, 10, 14]:
-            mat_final.append(mat_sc_list[ik])
+            if matrices:
+                mat_final.append(mat_sc_list[ik])
+            dist_final.append(dist_sc_list[ik])
             ik += 1
 
-    for i in range(len(mat_final)):
-        old_task_distribution[task_id][i].append(
-            deepcopy(mat_final[i].flatten()))
+    for i in range(len(dist_final)):
+        old_task_distribution[task_id][i].append(dist_final[i])
+    if not matrices:
+        return None
 
     print('-'*30)
     print('Representation Matrix')
@@ -450,68 +413,6 @@ def get_representation_matrix(task_id, net, device, x, y, old_task_distribution)
     return mat_final
 
 
-def update_GPM(task_id, model, mat_list, threshold, feature_list=[], proj=None, every_task_base=None):
-    print('Threshold: ', threshold)
-    if not feature_list:
-        # After First Task
-        for i in range(len(mat_list)):
-            activation = mat_list[i]
-            U, S, Vh = np.linalg.svd(activation, full_matrices=False)
-
-            sval_total = (S**2).sum()
-            sval_ratio = (S**2)/sval_total
-            r = np.sum(np.cumsum(sval_ratio) < threshold[i])  
-            feature_list.append(U[:, 0:r])
-            proj[task_id][i] = U[:, 0:r]
-            every_task_base[task_id][i] = U[:, 0:r]
-    else:
-        for i in range(len(mat_list)):
-            activation = mat_list[i]
-            U1, S1, Vh1 = np.linalg.svd(activation, full_matrices=False)
-            sval_total = (S1**2).sum()
-            sval_ratio = (S1**2)/sval_total
-            r = np.sum(np.cumsum(sval_ratio) < threshold[i])  
-            every_task_base[task_id][i] = U1[:, 0:r]
-
-            act_hat = activation - \
-                np.dot(
-                    np.dot(feature_list[i], feature_list[i].transpose()), activation)
-            U, S, Vh = np.linalg.svd(act_hat, full_matrices=False)
-
-            sval_hat = (S**2).sum()
-            sval_ratio = (S**2)/sval_total
-            accumulated_sval = (sval_total-sval_hat)/sval_total
-
-            r = 0
-            for ii in range(sval_ratio.shape[0]):
-                if accumulated_sval < threshold[i]:
-                    accumulated_sval += sval_ratio[ii]
-                    r += 1
-                else:
-                    break
-            if r != 0:
-                print('Not Skip Updating GPM for layer: {}'.format(i+1))
-                # update GPM
-                Ui = np.hstack((feature_list[i], U[:, 0:r]))
-                if Ui.shape[1] > Ui.shape[0]:
-                    feature_list[i] = Ui[:, 0:Ui.shape[0]]
-                else:
-                    feature_list[i] = Ui
-            if r == 0:
-                proj[task_id][i] = proj[task_id-1][i]
-            else:
-                proj[task_id][i] = U[:, 0:r]
-
-    print('-'*40)
-    print('Gradient Constraints Summary')
-    print('-'*40)
-    for i in range(len(feature_list)):
-        print('Layer {} : {}/{}'.format(i+1,
-              feature_list[i].shape[1], feature_list[i].shape[0]))
-    print('-'*40)
-    return feature_list
-
-
 def init_weights(m):
     if type(m) == nn.Linear or type(m) == nn.Conv2d or type(m) == Conv2d:
         torch.nn.init.kaiming_uniform_(
@@ -521,21 +422,22 @@ def init_weights(m):
         nn.init.constant_(m.bias, 0)
 
 
+@profiled('similarity')
 def update_task_discrimination(task_id, feature_list_ori, feature_list_new, threshold=0.7):
 
     #计算训练后的下一个任务和原任务的距离
     distance_ori = []
     for t in range(task_id):
         distance_ori.append(
-            wasserstein_distance(
-                feature_list_ori[task_id].flatten(), feature_list_ori[t].flatten()
+            wasserstein(
+                feature_list_ori[task_id], feature_list_ori[t]
             )
         )
     distance_new = []
     for t in range(task_id):
         distance_new.append(
-            wasserstein_distance(
-                feature_list_new[t].flatten(), feature_list_new[t].flatten()
+            wasserstein(
+                feature_list_new[t], feature_list_new[t]
             )
         )
 
@@ -606,12 +508,20 @@ def set_seed(seed=0):
 
 def main(args):
     tstart = time.time()
+    results = Results(args.results, args, args.results_format)
     # Device Setting
     device = torch.device("cuda:{}".format(args.cuda)
                           if torch.cuda.is_available() else "cpu")
+    profiler = Profiler(device, trace=args.trace, torch_steps=args.torch_profile,
+                        torch_trace=results.path + '_torch_trace.json')
+    set_profiler(profiler)
     set_seed(args.seed)
 
-    from dataloader import miniimagenet as data_loader
+    if args.synthetic:
+        from dataloader.synthetic import Dataset
+        data_loader = Dataset('miniimagenet', args.synthetic_train)
+    else:
+        from dataloader import miniimagenet as data_loader
     dataloader = data_loader.DatasetGen(args)
     taskcla, inputsize = dataloader.taskcla, dataloader.inputsize
 
@@ -622,33 +532,63 @@ def main(args):
     task_id = 0
     task_list = []
 
-    pre_task_distribution = [[[] for j in range(20)] for i in range(n_task)]
     old_task_distribution = [[[] for j in range(20)] for i in range(n_task)]
 
-    task_id = 0
-    model = ResNet18(taskcla, 20).to(device)  # base filters: 20
-    model.apply(init_weights)
+    # representation examples, the same ones at every step of a task
+    sampler = ClassSampler(args.seed)
     print("*" * 100)
+    model = ResNet18(taskcla, 20).to(device, memory_format=memory_format(args.channels_last))  # base filters: 20
+    model.apply(init_weights)
     print("Get Init Distribution.")
+    # the task modules are created in the task order, whether the pass runs or not
     for k, ncla in taskcla:
-        data = dataloader.get(k)
-        x = data[k]['train']['x']
-        y = data[k]['train']['y']
-        _ = get_representation_matrix(
-            task_id, model, device, x, y, pre_task_distribution)
-        task_id += 1
+        prepare_task(model, k, init_weights)
+
+    def init_distribution(task_id):
+        '''Distributions of a task in the initialized model, in a worker process'''
+        distribution = [[[] for j in range(20)] for i in range(n_task)]
+        data = dataloader.get(task_id)
+        prepare_task(model, task_id)
+        get_representation_matrix(
+            task_id, model, device, data[task_id]['train']['x'], data[task_id]['train']['y'], distribution, sampler, matrices=False)
+        return distribution[task_id]
+
+    cache = InitCache(args.cache_dir, __file__, seed=args.seed, model=model_version(model),
+                      device=device.type, channels_last=args.channels_last,
+                      data=('synthetic', args.synthetic_train) if args.synthetic else
+                      file_version(*[os.path.join(dataloader.root, 'miniimagenet', f) for f in ('train.pkl', 'test.pkl')]),
+                      pc_valid=args.pc_valid)
+    with stage('init_distribution'):
+        pre_task_distribution = cache.get(init_distribution, [k for k, ncla in taskcla],
+                                          args.init_workers, device)
     print("*" * 100)
     del model
 
-    proj = {}
-    every_task_base = {}
+    # GPM bases of every task, the older tasks on disk with --basis_hot
+    proj = BasisStore('proj', args.basis_hot, args.basis_dtype, args.basis_dir)
+    every_task_base = BasisStore('every_task_base', args.basis_hot, args.basis_dtype, args.basis_dir)
     task_id = 0
     task_list = []
 
-    for k, ncla in taskcla:
+    # fork from the snapshot of the longest run of the first tasks with this configuration
+    prefix = PrefixCache(args.cache_dir if args.prefix_cache else None, __file__, args, init=cache.key)
+    start, snapshot = prefix.find(len(taskcla))
+    if snapshot is not None:
+        model = ResNet18(taskcla, 20).to(device, memory_format=memory_format(args.channels_last))
+        compile_model(model, args.compile)
+        for t in range(start):
+            prepare_task(model, t)
+        state = prefix.restore(snapshot, model, results)
+        feature_list, proj, every_task_base = state['feature_list'], state['proj'], state['every_task_base']
+        old_task_distribution, acc_matrix, task_list = (state['old_task_distribution'], state['acc_matrix'],
+                                                        state['task_list'])
+        task_id = start
+    for k, ncla in taskcla[start:]:
+        profiler.task_id = task_id
         # specify threshold hyperparameter
-        data = dataloader.get(k)
-        threshold = np.array([0.985] * 20)
+        with stage('data_load'):
+            data = dataloader.get(k)
+        threshold = np.array([args.gpm_threshold] * 20)
         print('*'*100)
         print('Task {:2d} ({:s})'.format(k, data[k]['name']))
         print('*'*100)
@@ -662,19 +602,21 @@ def main(args):
 
         lr = args.lr
         best_loss = np.inf
-        print('-'*40, log)
-        print('Task ID :{} | Learning Rate : {}'.format(task_id, lr), log)
-        print('-'*40, log)
+        print('-'*40)
+        print('Task ID :{} | Learning Rate : {}'.format(task_id, lr))
+        print('-'*40)
 
         proj[task_id] = {}
         every_task_base[task_id] = {}
 
         if task_id == 0:
-            model = ResNet18(taskcla, 20).to(device)  # base filters: 20
+            model = ResNet18(taskcla, 20).to(device, memory_format=memory_format(args.channels_last))  # base filters: 20
+            compile_model(model, args.compile)
             model.apply(init_weights)
-            best_model = get_model(model)
+            prepare_task(model, task_id, init_weights)
+            best_model = BestModel(model, task_id)
             feature_list = []
-            optimizer = optim.SGD(model.parameters(),
+            optimizer = optim.SGD(trainable(model),
                                   lr=lr, momentum=args.momentum)
             scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
                 optimizer, T_max=args.n_epochs)
@@ -694,10 +636,13 @@ def main(args):
                     args, model, device, xvalid, yvalid,  criterion, k)
                 print(' Valid: loss={:.3f}, acc={:5.1f}% |'.format(
                     valid_loss, valid_acc), end='')
+                results.epoch(task_id, epoch, train_loss=tr_loss, train_acc=tr_acc,
+                              valid_loss=valid_loss, valid_acc=valid_acc, lr=lr,
+                              time_ms=1000*(clock1-clock0))
                 # Adapt lr
                 if valid_loss < best_loss:
                     best_loss = valid_loss
-                    best_model = get_model(model)
+                    best_model.save()
                     patience = args.lr_patience
                     print(' *', end='')
                 # scheduler.step()
@@ -721,14 +666,15 @@ def main(args):
                 test_loss, test_acc))
             # Memory Update
             mat_list = get_representation_matrix(
-                task_id, model, device, xtrain, ytrain, old_task_distribution)
+                task_id, model, device, xtrain, ytrain, old_task_distribution, sampler)
             feature_list = update_GPM(
                 task_id, model, mat_list, threshold, feature_list, proj, every_task_base)
 
         else:
+            prepare_task(model, task_id, init_weights)
             sim_tasks = [i for i in range(20)]
-            _ = get_representation_matrix(
-                task_id, model, device, xtrain, ytrain, old_task_distribution)
+            get_representation_matrix(
+                task_id, model, device, xtrain, ytrain, old_task_distribution, sampler, matrices=False)
             cnt = 0
             for kk, (m, params) in enumerate(model.named_parameters()):
                 if len(params.size()) == 4:
@@ -737,7 +683,7 @@ def main(args):
                     for ttt in range(task_id+1):
                         pre_tmp.append(pre_task_distribution[ttt][cnt][0])
                         old_tmp.append(old_task_distribution[ttt][cnt][0])
-                    sim_tasks[cnt] = update_task_discrimination(task_id, pre_tmp, old_tmp, threshold=0.8)
+                    sim_tasks[cnt] = update_task_discrimination(task_id, pre_tmp, old_tmp, threshold=args.sim_threshold)
                     cnt += 1
                 print("*" * 40)
             print("Task {} has sim Tasks".format(task_id), end="")
@@ -749,10 +695,6 @@ def main(args):
                     cnt += 1
             print("*" * 40)
 
-            optimizer = optim.SGD(model.parameters(),
-                                  lr=lr, momentum=args.momentum)
-            scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
-                optimizer, T_max=args.n_epochs)
             feature_mat = []
             # Projection Matrix Precomputation
             for i in range(len(feature_list)):
@@ -761,6 +703,14 @@ def main(args):
                 print('Layer {} - Projection Matrix shape: {}'.format(i+1, Uf.shape))
                 feature_mat.append(Uf)
             print('-'*40)
+            projectors, frozen = get_projectors(model, feature_mat, task_id)
+            optimizer = ProjectedSGD(trainable(model), lr=lr, momentum=args.momentum,
+                                     projectors=projectors, frozen=frozen,
+                                     tol=args.ortho_tol if args.precision == 'bf16' else None)
+            # the optimizer keeps the projectors stacked, drop the dense copies
+            del feature_mat, projectors, Uf
+            scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
+                optimizer, T_max=args.n_epochs)
 
             p = [None for i in range(20)]
             if task_id >= 1:
@@ -768,11 +718,18 @@ def main(args):
                 for i in range(20):
                     p[i] = torch.FloatTensor(proj[task_id-1][i]).to(device)
 
+            # project the weights on the first batch of the task
+            set_projections(model, p)
+            best_model = BestModel(model, task_id)
+
+            # projectors of the knowledge transfer loss, built once per task
+            transfer = TransferLoss(transfer_layers(every_task_base, sim_tasks, model, k), device,
+                                    every=args.kt_every, epochs=args.kt_epochs, tol=args.kt_tol)
             for epoch in range(1, args.n_epochs+1):
                 # Train
                 clock0 = time.time()
-                train_projected(args, p, model, device, xtrain,
-                                ytrain, optimizer, criterion, feature_mat, k, epoch, sim_tasks,  every_task_base)
+                train_projected(args, model, device, xtrain,
+                                ytrain, optimizer, criterion, k, transfer)
                 clock1 = time.time()
                 tr_loss, tr_acc = test(
                     args, model, device, xtrain, ytrain, criterion, k)
@@ -783,10 +740,13 @@ def main(args):
                     args, model, device, xvalid, yvalid, criterion, k)
                 print(' Valid: loss={:.3f}, acc={:5.1f}% |'.format(
                     valid_loss, valid_acc), end='')
+                results.epoch(task_id, epoch, train_loss=tr_loss, train_acc=tr_acc,
+                              valid_loss=valid_loss, valid_acc=valid_acc, lr=lr,
+                              time_ms=1000*(clock1-clock0), kt_loss=transfer.value())
                 # Adapt lr
                 if valid_loss < best_loss:
                     best_loss = valid_loss
-                    best_model = get_model(model)
+                    best_model.save()
                     patience = args.lr_patience
                     print(' *', end='')
                 # scheduler.step()
@@ -809,44 +769,43 @@ def main(args):
                 test_loss, test_acc))
             # Memory Update
             mat_list = get_representation_matrix(
-                task_id, model, device, xtrain, ytrain, old_task_distribution)
+                task_id, model, device, xtrain, ytrain, old_task_distribution, sampler)
             feature_list = update_GPM(
                 task_id, model, mat_list, threshold, feature_list, proj, every_task_base)
 
         # save accuracy
-        jj = 0
-        for ii in np.array(task_list)[0:task_id+1]:
-            xtest = data[ii]['test']['x']
-            ytest = data[ii]['test']['y']
-            _, acc_matrix[task_id, jj] = test(
-                args, model, device, xtest, ytest, criterion, ii)
-            jj += 1
+        sets = [(ii, data[ii]['test']['x'], data[ii]['test']['y'])
+                for ii in np.array(task_list)[0:task_id + 1]]
+        acc_matrix[task_id, 0:task_id + 1] = evaluate_tasks(
+            model, device, sets, args.batch_size_test,
+            memory_format=memory_format(args.channels_last))
         print('Accuracies =')
         for i_a in range(task_id+1):
             print('\t', end='')
             for j_a in range(acc_matrix.shape[1]):
                 print('{:5.1f}% '.format(acc_matrix[i_a, j_a]), end='')
             print()
+        results.timings(profiler.table())
+        results.accuracy(acc_matrix[:task_id + 1], task_list)
+        results.save()
+        profiler.save()
+        prefix.save(task_id, model, results, feature_list=feature_list, proj=proj,
+                    every_task_base=every_task_base, old_task_distribution=old_task_distribution,
+                    acc_matrix=acc_matrix, task_list=task_list)
         # update task id
         task_id += 1
 
-    print('-'*50, log)
+    print('-'*50)
     # Simulation Results
-    print('Task Order : {}'.format(np.array(task_list)), log)
-    print('Final Avg Accuracy: {:5.2f}%'.format(acc_matrix[-1].mean()), log)
+    print('Task Order : {}'.format(np.array(task_list)))
+    print('Final Avg Accuracy: {:5.2f}%'.format(acc_matrix[-1].mean()))
     bwt = np.mean((acc_matrix[-1]-np.diag(acc_matrix))[:-1])
-    print('Backward transfer: {:5.2f}%'.format(bwt), log)
-    print('[Elapsed time = {:.1f} ms]'.format((time.time()-tstart)*1000), log)
-    print('-'*50, log)
-    # Plots
-    array = acc_matrix
-    df_cm = pd.DataFrame(array, index=[i for i in ["1", "2", "3", "4", "5", "6", "7",
-                                                   "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20"]],
-                         columns=[i for i in ["1", "2", "3", "4", "5", "6", "7",
-                                              "8", "9", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20"]])
-    sn.set(font_scale=1.4)
-    sn.heatmap(df_cm, annot=True, annot_kws={"size": 10})
-    plt.show()
+    print('Backward transfer: {:5.2f}%'.format(bwt))
+    print('[Elapsed time = {:.1f} ms]'.format((time.time()-tstart)*1000))
+    print('-'*50)
+    profiler.report()
+    results.summary(acc=acc_matrix[-1].mean(), bwt=bwt, elapsed_ms=(time.time() - tstart) * 1000)
+    results.save()
 
 
 if __name__ == "__main__":
@@ -856,6 +815,8 @@ if __name__ == "__main__":
                         help='input batch size for training (default: 64)')
     parser.add_argument('--batch_size_test', type=int, default=64, metavar='N',
                         help='input batch size for testing (default: 64)')
+    parser.add_argument('--inference_mode', action='store_true', default=False,
+                        help='run the test loops under torch.inference_mode')
     parser.add_argument('--n_epochs', type=int, default=100, metavar='N',
                         help='number of training epochs/task (default: 200)')
     parser.add_argument('--seed', type=int, default=1, metavar='S',
@@ -876,19 +837,78 @@ if __name__ == "__main__":
                         help='hold before decaying lr (default: 6)')
     parser.add_argument('--lr_factor', type=int, default=3, metavar='LRF',
                         help='lr decay factor (default: 2)')
-    parser.add_argument('--savename', type=str, default='./model/',
-                        help='save path')
+
+    # Results
+    parser.add_argument('--results', type=str, default=None, metavar='PATH',
+                        help='path prefix of the results files (default: ./results/<script>_seed<seed>)')
+    parser.add_argument('--results_format', type=str, nargs='*', default=['csv'], choices=['csv', 'parquet'],
+                        help='tables written next to the JSON results (default: csv)')
+
+    # Profiling
+    parser.add_argument('--trace', type=str, default=None, metavar='PATH',
+                        help='Chrome trace of the stages (data load, training, evaluation, GPM SVDs, ...) (default: none)')
+    parser.add_argument('--torch_profile', type=int, default=0, metavar='N',
+                        help='training steps recorded with torch.profiler, written to <results>_torch_trace.json (default: 0)')
+
+    # Synthetic data
+    parser.add_argument('--synthetic', action='store_true', default=False,
+                        help='seeded synthetic tasks of the dataset shapes instead of the data files, offline')
+    parser.add_argument('--synthetic_train', type=int, default=0, metavar='N',
+                        help='training examples per synthetic task, 0 for about as many as the real tasks (default: 0)')
+
+    # Knowledge transfer
+    parser.add_argument('--kt_every', type=int, default=1, metavar='K',
+                        help='evaluate the knowledge transfer loss every K steps, weighted by K (default: 1)')
+    parser.add_argument('--kt_epochs', type=int, default=0, metavar='N',
+                        help='use the knowledge transfer loss in the first N epochs of a task, 0 for all (default: 0)')
+    parser.add_argument('--kt_tol', type=float, default=0., metavar='TOL',
+                        help='drop the knowledge transfer loss of a task once its epoch mean is below TOL, 0 to keep it (default: 0)')
+
+    # Cache
+    parser.add_argument('--cache_dir', type=str, default='cache', metavar='DIR',
+                        help='cache of the initial distributions, shared by the runs, "" to disable (default: cache)')
+    parser.add_argument('--init_workers', type=int, default=0, metavar='N',
+                        help='processes of the initial distribution pass, 0 for one per task up to the CPUs (default: 0)')
+    parser.add_argument('--prefix_cache', action='store_true', default=False,
+                        help='snapshot the run after every task in the cache and start from the longest '
+                             'snapshot of the same configuration, for sweeps')
+
+    # GPM bases
+    parser.add_argument('--basis_hot', type=int, default=0, metavar='N',
+                        help='tasks whose GPM bases stay in memory, the older ones are memory-mapped from disk, '
+                             '0 to keep every task in memory (default: 0)')
+    parser.add_argument('--basis_dtype', type=str, default='float32', choices=['float64', 'float32', 'float16'],
+                        help='precision of the GPM bases on disk (default: float32)')
+    parser.add_argument('--basis_dir', type=str, default=None, metavar='DIR',
+                        help='directory of the GPM bases on disk, better on a disk than on a tmpfs '
+                             '(default: the temporary directory)')
+
+    # Thresholds
+    parser.add_argument('--gpm_threshold', type=float, default=0.985, metavar='TH',
+                        help='GPM energy threshold of the layers (default: 0.985)')
+    parser.add_argument('--sim_threshold', type=float, default=0.8, metavar='TH',
+                        help='similarity threshold of the knowledge transfer tasks (default: 0.8)')
+
+    # Precision
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='training precision, bf16 autocasts the forward pass and loss (default: fp32)')
+    parser.add_argument('--ortho_tol', type=float, default=1e-3, metavar='TOL',
+                        help='max relative residual of the projected gradients in bf16 mode (default: 1e-3)')
+
+    # Memory format
+    parser.add_argument('--channels_last', action='store_true', default=False,
+                        help='run the conv layers in channels-last memory format')
+
+    # Compilation
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='run the forward passes under torch.compile (torch >= 2.0), the first '
+                             'projected batch of a task and the representation passes eagerly')
 
     args = parser.parse_args()
-    if not os.path.exists(args.savename):
-        os.makedirs(args.savename)
-    log = open(os.path.join(args.savename,
-                            'log_seed_{}.txt'.format(args.seed)), 'w')
-    print('='*100, log)
-    print('Arguments =', log)
+    print('='*100)
+    print('Arguments =')
     for arg in vars(args):
-        print('\t'+arg+': {}'.format(getattr(args, arg)), log)
-    print('='*100, log)
+        print('\t'+arg+':', getattr(args, arg))
+    print('='*100)
 
-    print('save path : {}'.format(args.savename), log)
-    main(args)
\ No newline at end of file
+    main(args)
@@ -5,18 +5,28 @@ import torch.nn.functional as F
 
 from collections import OrderedDict
 
-import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sn
-import pandas as pd
 import argparse
 import time
 import random
 from copy import deepcopy
 
-from scipy.stats import wasserstein_distance
 from scipy.spatial.distance import euclidean
 
+from stil.gpm import update_GPM
+from stil.evaluation import evaluate_tasks, evaluation_mode
+from stil.optim import ProjectedSGD
+from stil.precision import autocast
+from stil.layers import TaskModuleList, prepare_task, recording, set_projections, set_task, trainable
+from stil.results import Results
+from stil.profiler import Profiler, profiled, set_profiler, stage, step
+from stil.transfer import TransferLoss
+from stil.sampling import ClassSampler
+from stil.cache import InitCache, data_version, model_version
+from stil.prefix import PrefixCache
+from stil.store import BasisStore
+from stil.similarity import wasserstein
+
 import os
 os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
 
@@ -37,92 +47,66 @@ def adjust_learning_rate(optimizer, epoch, args):
 class Linear(nn.Linear):
     def __init__(self, in_features, out_features, norm_feature, bias=True):
         super(Linear, self).__init__(in_features, out_features, bias=bias)
-
-    def forward(self, input, task_id, p, epoch):
-
-        if p is not None:
-            if epoch == 1:
-                norm_project = torch.mm(p, p.transpose(1, 0))
-                proj_weight = torch.mm(self.weight, norm_project)
-
+        self.norm_project = None
+
+    def set_projection(self, p):
+        # the projection is folded into the weights of the next forward only
+        self.norm_project = None if p is None else torch.mm(p, p.transpose(1, 0))
+
+    def forward(self, input):
+        masked_weight = self.weight
+        if self.norm_project is not None:
+            # the weight projection stays in float32 under autocast
+            with torch.autocast(input.device.type, enabled=False):
+                proj_weight = torch.mm(self.weight, self.norm_project)
                 masked_weight = self.weight - proj_weight
-            else:
-                masked_weight = self.weight
-        else:
-            masked_weight = self.weight
-        x = F.linear(input, masked_weight, self.bias)
-        return x
+                self.norm_project = None
+        return F.linear(input, masked_weight, self.bias)
 
 
 # Define MLP model
 class MLPNet(nn.Module):
     def __init__(self, n_hidden=100, n_outputs=10, taskcla=None):
         super(MLPNet, self).__init__()
+        self.task = 0  # selects the task head
         self.act = OrderedDict()
+        self.record = False
         self.lin1 = Linear(3*32*32, n_hidden, n_hidden, bias=False)
         self.lin2 = Linear(n_hidden, n_hidden, n_hidden, bias=False)
-        self.fc1 = torch.nn.ModuleList()
         self.taskcla = taskcla
-        for t, n in self.taskcla:
-            self.fc1.append(nn.Linear(n_hidden, n))
+        self.fc1 = TaskModuleList(
+            lambda t: nn.Linear(n_hidden, self.taskcla[t][1]), len(self.taskcla))
 
-    def forward(self, x, t, p, epoch):
-        if p is None:
+    def forward(self, x):
+        if self.record:
             self.act['Lin1'] = x
-            x = self.lin1(x, t, None, epoch)
-            x = F.relu(x)
+        x = self.lin1(x)
+        x = F.relu(x)
+        if self.record:
             self.act['Lin2'] = x
-            x = self.lin2(x, t, None, epoch)
-            x = F.relu(x)
+        x = self.lin2(x)
+        x = F.relu(x)
+        if self.record:
             self.act['fc1'] = x
-        else:
-            self.act['Lin1'] = x
-            x = self.lin1(x, t, p[0], epoch)
-            x = F.relu(x)
-            self.act['Lin2'] = x
-            x = self.lin2(x, t, p[1], epoch)
-            x = F.relu(x)
-            self.act['fc1'] = x
-        return self.fc1[t](x)
+        return self.fc1[self.task](x)
 
 
-def contrast_cls(every_task_base, sim_tasks, model, task_id, device):
-    l2 = 0
+def transfer_layers(every_task_base, sim_tasks, model, task_id):
+    '''(param, current base, similar task bases) of the knowledge transfer layers'''
+    layers = []
     cnt = 0
-    stride_list = [1, 1, 1, 1, 1, 2, 1, 1, 1, 2, 1, 1, 1, 2, 1, 1, 1]
-
-    ttt = 0
     for k, (m, params) in enumerate(model.named_parameters()):
         if 'fc' not in m:
-            sz = params.size(0)
-            current_base = torch.FloatTensor(every_task_base[task_id-1][cnt]).to(device)
-            norm_project = torch.mm(current_base, current_base.transpose(1, 0))
-            current_proj_weight = torch.mm(params.view(sz, -1),
-                                        norm_project).view(params.size())
-            loss = []
-            for tt in sim_tasks[cnt-ttt]:
-                tmp = torch.FloatTensor(every_task_base[tt][cnt]).to(device)
-                norm_project = torch.mm(tmp, tmp.transpose(1, 0))
-                sim_proj_weight = torch.mm(params.view(sz, -1),
-                                        norm_project).view(params.size())
-                
-                if current_proj_weight.view(sz, -1).shape[0] != sim_proj_weight.view(sz, -1).shape[0] \
-                    or current_proj_weight.view(sz, -1).shape[1] != sim_proj_weight.view(sz, -1).shape[1]:
-                    continue
-
-                cos_sim = torch.nn.functional.cosine_similarity(current_proj_weight.view(sz, -1),sim_proj_weight.view(sz, -1), dim=1)
-                cos_sim = (torch.mean(cos_sim) + 1.0) / 2.0 
-                label = torch.ones(1).to(device)
-                loss.append(torch.nn.functional.binary_cross_entropy(cos_sim.view(1), label))
-            if len(loss) != 0:
-                loss = torch.mean(torch.stack(loss))
-                l2 += loss
+            layers.append((params, every_task_base[task_id-1][cnt],
+                           [every_task_base[tt][cnt] for tt in sim_tasks[cnt]]))
         cnt += 1
-    return l2
+    return layers
 
 
+@profiled('train')
 def train(args, epoch, task_id, model, device, x, y, optimizer, criterion):
     model.train()
+    set_task(model, task_id)
     r = np.arange(x.size(0))
     np.random.shuffle(r)
     r = torch.LongTensor(r).to(device)
@@ -136,14 +120,33 @@ def train(args, epoch, task_id, model, device, x, y, optimizer, criterion):
         data = x[b].view(-1, 3*32*32)
         data, target = data.to(device), y[b].to(device)
         optimizer.zero_grad()
-        output = model(data, task_id, None, -1)
-        loss = criterion(output, target)
+        with autocast(args.precision, device):
+            output = model(data)
+            loss = criterion(output, target)
         loss.backward()
         optimizer.step()
+        step()
 
 
-def train_projected(args, p, model, device, x, y, optimizer, criterion, feature_mat, task_id, epoch, sim_tasks,  every_task_base):
+def get_projectors(model, feature_mat, task_id):
+    '''Pair the projected params with their projection matrices'''
+    projectors = []
+    frozen = []
+    kk = 0
+    for k, (m, params) in enumerate(model.named_parameters()):
+        if k < 2 and len(params.size()) != 1:
+            projectors.append((params, feature_mat[kk]))
+            kk += 1
+        elif (k < 2 and len(params.size()) == 1) and task_id != 0:
+            frozen.append(params)
+    return projectors, frozen
+
+
+@profiled('train')
+def train_projected(args, model, device, x, y, optimizer, criterion, task_id, transfer):
     model.train()
+    transfer.epoch()
+    set_task(model, task_id)
     r = np.arange(x.size(0))
     np.random.shuffle(r)
     r = torch.LongTensor(r).to(device)
@@ -157,70 +160,50 @@ def train_projected(args, p, model, device, x, y, optimizer, criterion, feature_
         data = x[b].view(-1, 3*32*32)
         data, target = data.to(device), y[b].to(device)
         optimizer.zero_grad()
-        output = model(data, task_id, p, epoch=epoch + i)
-        loss = criterion(output, target)
+        with autocast(args.precision, device):
+            output = model(data)
+            loss = criterion(output, target)
 
-        if len(sim_tasks) != 0:
-            l2 = contrast_cls(every_task_base, sim_tasks,
-                               model, task_id, device)
-            loss += l2
+        kt_loss = transfer.step()
+        if kt_loss is not None:
+            loss += kt_loss
 
         loss.backward()
-        # Gradient Projections
-        kk = 0
-        for k, (m, params) in enumerate(model.named_parameters()):
-            if k < 2 and len(params.size()) != 1:
-                sz = params.size(0)
-                params.grad.data = params.grad.data - torch.mm(params.grad.data.view(sz, -1),
-                                                               feature_mat[kk]).view(params.size())
-                kk += 1
-            elif (k < 2 and len(params.size()) == 1) and task_id != 0:
-                params.grad.data.fill_(0)
-
+        # Gradient Projections are applied in the optimizer step
         optimizer.step()
+        step()
 
 
+@profiled('test')
 def test(args, model, device, x, y, criterion, id=None):
     model.eval()
-    total_loss = 0
+    set_task(model, id)
+    total_loss = torch.zeros((), device=device)
     total_num = 0
-    correct = 0
-    r = np.arange(x.size(0))
-    np.random.shuffle(r)
-    r = torch.LongTensor(r).to(device)
-    with torch.no_grad():
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    with evaluation_mode(args.inference_mode):
         # Loop batches
-        for i in range(0, len(r), args.batch_size_test):
-            if i + args.batch_size_test <= len(r):
-                b = r[i:i + args.batch_size_test]
-            else:
-                b = r[i:]
-            b = b.to(x.device)
+        for i in range(0, x.size(0), args.batch_size_test):
+            b = slice(i, i + args.batch_size_test)
             data = x[b].view(-1, 3*32*32)
             data, target = data.to(device), y[b].to(device)
-            output = model(data, id, None, -1)
+            output = model(data)
             loss = criterion(output, target)
             pred = output.argmax(dim=1, keepdim=True)
 
-            correct += pred.eq(target.view_as(pred)).sum().item()
-            total_loss += loss.data.cpu().numpy().item() * len(b)
-            total_num += len(b)
+            correct += pred.eq(target.view_as(pred)).sum()
+            total_loss += loss * len(target)
+            total_num += len(target)
 
-    acc = 100. * correct / total_num
-    final_loss = total_loss / total_num
+    acc = 100. * correct.item() / total_num
+    final_loss = total_loss.item() / total_num
     return final_loss, acc
 
 
-def get_representation_matrix(task_id, net, device, x, y, old_task_distribution):
+@profiled('representation')
+def get_representation_matrix(task_id, net, device, x, y, old_task_distribution, sampler, matrices=True):
     example_data = []
-    r = np.arange(x.size(0))
-    np.random.shuffle(r)
-    r = torch.LongTensor(r).to(device)
-    size = x.size(0)
-    if size > 300:
-        b = np.random.choice(size, 300, replace=False)
-    else:
-        b = np.random.choice(size, 300, replace=True)
+    b = sampler.sample(task_id, y, n=300)
     
     print(x[b].shape)
     tmp_data = x[b].view(-1, 3*32*32).to(device)
@@ -230,7 +213,9 @@ def get_representation_matrix(task_id, net, device, x, y, old_task_distribution)
     example_data = torch.cat(example_data, dim=0).squeeze(1)
     example_data = example_data.view(-1, 3*32*32)
     net.eval()
-    example_out = net(example_data, task_id, None, -1)
+    set_task(net, task_id)
+    with recording(net):
+        example_out = net(example_data)
 
     batch_list = [300, 300, 300]
     mat_list = []  # list contains representation matrix of each layer
@@ -243,6 +228,8 @@ def get_representation_matrix(task_id, net, device, x, y, old_task_distribution)
         mat_list.append(activation)
         old_task_distribution[task_id][i].append(
             deepcopy(activation.flatten()))
+    if not matrices:
+        return None
 
     print('-'*30)
     print('Representation Matrix')
@@ -252,86 +239,23 @@ def get_representation_matrix(task_id, net, device, x, y, old_task_distribution)
     print('-'*30)
     return mat_list
 
-def update_GPM(task_id, model, mat_list, threshold, feature_list=[], proj=None, every_task_base=None):
-    print('Threshold: ', threshold)
-    if not feature_list:
-        # After First Task
-        for i in range(len(mat_list)):
-            activation = mat_list[i]
-            U, S, Vh = np.linalg.svd(activation, full_matrices=False)
-
-            sval_total = (S**2).sum()
-            sval_ratio = (S**2) / sval_total
-            r = np.sum(np.cumsum(sval_ratio) < threshold[i])  # +1
-            feature_list.append(U[:, 0:r])
-            proj[task_id][i] = U[:, 0:r]
-            every_task_base[task_id][i] = U[:, 0:r]
-    else:
-        for i in range(len(mat_list)):
-            activation = mat_list[i]
-            U1, S1, Vh1 = np.linalg.svd(activation, full_matrices=False)
-            sval_total = (S1**2).sum()
-            sval_ratio = (S1**2)/sval_total
-            r = np.sum(np.cumsum(sval_ratio) < threshold[i])  # +1
-            every_task_base[task_id][i] = U1[:, 0:r]
-
-            act_hat = activation - np.dot(
-                np.dot(feature_list[i], feature_list[i].transpose()),
-                activation)
-            U, S, Vh = np.linalg.svd(act_hat, full_matrices=False)
-
-            sval_hat = (S**2).sum()
-            sval_ratio = (S**2) / sval_total
-            accumulated_sval = (sval_total - sval_hat) / sval_total
-
-            r = 0
-            for ii in range(sval_ratio.shape[0]):
-                if accumulated_sval < threshold[i]:
-                    accumulated_sval += sval_ratio[ii]
-                    r += 1
-                else:
-                    break
-            if r != 0:
-                print('Skip Updating GPM for layer: {}'.format(i + 1))
-                Ui = np.hstack((feature_list[i], U[:, 0:r]))
-                if Ui.shape[1] > Ui.shape[0]:
-                    print('-' * 40)
-                    print('Base Matrix has OOM')
-                    print('-' * 40)
-                    feature_list[i] = Ui[:, 0:Ui.shape[0]]
-                else:
-                    feature_list[i] = Ui
-            if r == 0:
-                proj[task_id][i] = proj[task_id-1][i]
-            else:
-                proj[task_id][i] = U[:, 0:r]
-
-    print('-' * 40)
-    print('Gradient Constraints Summary')
-    print('-' * 40)
-    for i in range(len(feature_list)):
-        print('Layer {} : {}/{}'.format(i + 1, feature_list[i].shape[1],
-                                        feature_list[i].shape[0]))
-    print('-' * 40)
-    return feature_list
-
-
 
+@profiled('similarity')
 def update_task_discrimination(task_id, feature_list_ori, feature_list_new, threshold=0.7):
 
     #计算训练后的下一个任务和原任务的距离
     distance_ori = []
     for t in range(task_id):
         distance_ori.append(
-            wasserstein_distance(
-                feature_list_ori[task_id].flatten(), feature_list_ori[t].flatten()
+            wasserstein(
+                feature_list_ori[task_id], feature_list_ori[t]
             )
         )
     distance_new = []
     for t in range(task_id):
         distance_new.append(
-            wasserstein_distance(
-                feature_list_new[t].flatten(), feature_list_new[t].flatten()
+            wasserstein(
+                feature_list_new[t], feature_list_new[t]
             )
         )
 
@@ -400,14 +324,23 @@ def set_seed(seed=0):
 
 def main(args):
     tstart = time.time()
+    results = Results(args.results, args, args.results_format)
     # Device Setting
     device = torch.device("cuda:{}".format(args.cuda)
                           if torch.cuda.is_available() else "cpu")
+    profiler = Profiler(device, trace=args.trace, torch_steps=args.torch_profile,
+                        torch_trace=results.path + '_torch_trace.json')
+    set_profiler(profiler)
 
     set_seed(args.seed)
-    from dataloader import mixceleba as mes
+    if args.synthetic:
+        from dataloader.synthetic import Dataset
+        mes = Dataset('mixceleba', args.synthetic_train)
+    else:
+        from dataloader import mixceleba as mes
 
-    data,taskcla,inputsize=mes.get(seed=args.seed, args=args )
+    with stage('data_load'):
+        data,taskcla,inputsize=mes.get(seed=args.seed, args=args )
 
     n_task = args.dis_ntasks + args.sim_ntasks
     acc_matrix = np.zeros((n_task, n_task))
@@ -422,28 +355,55 @@ def main(args):
     for k_t, (m, param) in enumerate(model.named_parameters()):
         print(k_t, m, param.shape)
     print('-' * 40)
-    pre_task_distribution = [[[] for j in range(3)] for i in range(n_task)]
     old_task_distribution = [[[] for j in range(3)] for i in range(n_task)]
 
-    task_id = 0
+    # representation examples, the same ones at every step of a task
+    sampler = ClassSampler(args.seed)
     print("*" * 100)
     print("Get Init Distribution.")
+    # the task modules are created in the task order, whether the pass runs or not
     for k, ncla in taskcla:
-        xtrain = data[k]['train']['x']
-        ytrain = data[k]['train']['y']
-        _ = get_representation_matrix(task_id, model, device, xtrain, ytrain, pre_task_distribution)
-        task_id += 1
+        prepare_task(model, k)
+
+    def init_distribution(task_id):
+        '''Distributions of a task in the initialized model, in a worker process'''
+        distribution = [[[] for j in range(3)] for i in range(n_task)]
+        prepare_task(model, task_id)
+        get_representation_matrix(
+            task_id, model, device, data[task_id]['train']['x'], data[task_id]['train']['y'], distribution, sampler, matrices=False)
+        return distribution[task_id]
+
+    cache = InitCache(args.cache_dir, __file__, seed=args.seed, model=model_version(model),
+                      device=device.type,
+                      data=data_version([(data[k]['train']['x'], data[k]['train']['y']) for k, ncla in taskcla]))
+    with stage('init_distribution'):
+        pre_task_distribution = cache.get(init_distribution, [k for k, ncla in taskcla],
+                                          args.init_workers, device)
     print("*" * 100)
     del model
 
-    proj = {}
-    every_task_base = {}
+    # GPM bases of every task, the older tasks on disk with --basis_hot
+    proj = BasisStore('proj', args.basis_hot, args.basis_dtype, args.basis_dir)
+    every_task_base = BasisStore('every_task_base', args.basis_hot, args.basis_dtype, args.basis_dir)
     task_id = 0
     task_list = []
 
-    for k, ncla in taskcla:
+    # fork from the snapshot of the longest run of the first tasks with this configuration
+    prefix = PrefixCache(args.cache_dir if args.prefix_cache else None, __file__, args, init=cache.key)
+    start, snapshot = prefix.find(len(taskcla))
+    if snapshot is not None:
+        model = MLPNet(args.n_hidden, args.n_outputs, taskcla).to(device)
+        for t in range(start):
+            prepare_task(model, t)
+        state = prefix.restore(snapshot, model, results)
+        feature_list, proj, every_task_base = state['feature_list'], state['proj'], state['every_task_base']
+        old_task_distribution, acc_matrix, task_list = (state['old_task_distribution'], state['acc_matrix'],
+                                                        state['task_list'])
+        task_id = start
+    for k, ncla in taskcla[start:]:
+        profiler.task_id = task_id
         # specify threshold hyperparameter
-        threshold = np.array([0.99, 0.99, 0.99])
+        threshold = np.array(args.gpm_threshold)
 
         print('*' * 100)
         print('Task {:2d} ({:s})'.format(k, data[k]['name']))
@@ -468,8 +428,9 @@ def main(args):
         if task_id == 0:
             model = MLPNet(args.n_hidden, args.n_outputs, taskcla).to(device)
             # model.apply(init_weights)
+            prepare_task(model, task_id)
             feature_list = []
-            optimizer = optim.SGD(model.parameters(),
+            optimizer = optim.SGD(trainable(model),
                                   lr=lr, momentum=args.momentum)
             # scheduler = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.95)
             for epoch in range(1, args.n_epochs + 1):
@@ -487,6 +448,9 @@ def main(args):
                 print(' Valid: loss={:.3f}, acc={:5.1f}% |'.format(
                     valid_loss, valid_acc),
                     end='')
+                results.epoch(task_id, epoch, train_loss=tr_loss, train_acc=tr_acc,
+                              valid_loss=valid_loss, valid_acc=valid_acc, lr=lr,
+                              time_ms=1000*(clock1-clock0))
                 if valid_loss < best_loss:
                     best_loss = valid_loss
                     patience = args.lr_patience
@@ -511,15 +475,16 @@ def main(args):
 
             # Memory Update
             mat_list = get_representation_matrix(
-                task_id, model, device, xtrain, ytrain, old_task_distribution)
+                task_id, model, device, xtrain, ytrain, old_task_distribution, sampler)
             feature_list = update_GPM(
                 task_id, model, mat_list, threshold, feature_list, proj, every_task_base)
 
         else:
+            prepare_task(model, task_id)
 
             sim_tasks = [[] for i in range(3)]
-            _ = get_representation_matrix(
-                task_id, model, device, xtrain, ytrain, old_task_distribution)
+            get_representation_matrix(
+                task_id, model, device, xtrain, ytrain, old_task_distribution, sampler, matrices=False)
             cnt = 0
             for kk, (m, params) in enumerate(model.named_parameters()):
                 if len(params.size()) != 1 and 'fc' not in m:
@@ -528,7 +493,7 @@ def main(args):
                     for ttt in range(task_id+1):
                         pre_tmp.append(pre_task_distribution[ttt][cnt][0])
                         old_tmp.append(old_task_distribution[ttt][cnt][0])
-                    sim_tasks[cnt] = update_task_discrimination(task_id, pre_tmp, old_tmp, threshold=0.7)
+                    sim_tasks[cnt] = update_task_discrimination(task_id, pre_tmp, old_tmp, threshold=args.sim_threshold)
                     cnt += 1
 
             print("*" * 40)
@@ -541,9 +506,6 @@ def main(args):
                     cnt += 1
             print("*" * 40)
 
-            optimizer = optim.SGD(model.parameters(),
-                                  lr=args.lr, momentum=args.momentum)
-            scheduler = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.9)
             feature_mat = []
             # Projection Matrix Precomputation
             for i in range(len(model.act)):
@@ -554,17 +516,30 @@ def main(args):
                     i + 1, Uf.shape))
                 feature_mat.append(Uf)
             print('-' * 40)
+            projectors, frozen = get_projectors(model, feature_mat, task_id)
+            optimizer = ProjectedSGD(trainable(model), lr=args.lr, momentum=args.momentum,
+                                     projectors=projectors, frozen=frozen,
+                                     tol=args.ortho_tol if args.precision == 'bf16' else None)
+            # the optimizer keeps the projectors stacked, drop the dense copies
+            del feature_mat, projectors, Uf
+            scheduler = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.9)
 
             p = [None, None, None]
             if task_id >= 1:
                 for i in range(3):
                     p[i] = torch.Tensor(proj[task_id-1][i]).to(device)
 
+            # project the weights on the first batch of the task
+            set_projections(model, p)
+
+            # projectors of the knowledge transfer loss, built once per task
+            transfer = TransferLoss(transfer_layers(every_task_base, sim_tasks, model, k), device,
+                                    every=args.kt_every, epochs=args.kt_epochs, tol=args.kt_tol)
             for epoch in range(1, args.n_epochs + 1):
 
                 clock0 = time.time()
-                train_projected(args, p, model, device, xtrain,
-                                ytrain, optimizer, criterion, feature_mat, k, epoch, sim_tasks,  every_task_base)
+                train_projected(args, model, device, xtrain,
+                                ytrain, optimizer, criterion, k, transfer)
                 clock1 = time.time()
                 tr_loss, tr_acc = test(args, model, device, xtrain, ytrain,
                                        criterion, task_id)
@@ -576,6 +551,9 @@ def main(args):
                 print(' Valid: loss={:.3f}, acc={:5.1f}% |'.format(
                     valid_loss, valid_acc),
                     end='')
+                results.epoch(task_id, epoch, train_loss=tr_loss, train_acc=tr_acc,
+                              valid_loss=valid_loss, valid_acc=valid_acc, lr=lr,
+                              time_ms=1000*(clock1-clock0), kt_loss=transfer.value())
                 if valid_loss < best_loss:
                     best_loss = valid_loss
                     patience = args.lr_patience
@@ -591,24 +569,28 @@ def main(args):
                 test_loss, test_acc))
             # Memory Update
             mat_list = get_representation_matrix(
-                task_id, model, device, xtrain, ytrain, old_task_distribution)
+                task_id, model, device, xtrain, ytrain, old_task_distribution, sampler)
             feature_list = update_GPM(
                 task_id, model, mat_list, threshold, feature_list, proj, every_task_base)
 
         # save accuracy
-        jj = 0
-        for ii in np.array(task_list)[0:task_id + 1]:
-            xtest = data[ii]['test']['x']
-            ytest = data[ii]['test']['y']
-            _, acc_matrix[task_id, jj] = test(args, model, device, xtest,
-                                              ytest, criterion,ii)
-            jj += 1
+        sets = [(ii, data[ii]['test']['x'], data[ii]['test']['y'])
+                for ii in np.array(task_list)[0:task_id + 1]]
+        acc_matrix[task_id, 0:task_id + 1] = evaluate_tasks(
+            model, device, sets, args.batch_size_test, input_shape=(3*32*32,))
         print('Accuracies =')
         for i_a in range(task_id + 1):
             print('\t', end='')
             for j_a in range(acc_matrix.shape[1]):
                 print('{:5.2f}% '.format(acc_matrix[i_a, j_a]), end='')
             print()
+        results.timings(profiler.table())
+        results.accuracy(acc_matrix[:task_id + 1], task_list)
+        results.save()
+        profiler.save()
+        prefix.save(task_id, model, results, feature_list=feature_list, proj=proj,
+                    every_task_base=every_task_base, old_task_distribution=old_task_distribution,
+                    acc_matrix=acc_matrix, task_list=task_list)
         # update task id
         task_id += 1
     print('-' * 50)
@@ -619,6 +601,9 @@ def main(args):
     print('Backward transfer: {:5.2f}%'.format(bwt))
     print('[Elapsed time = {:.1f} ms]'.format((time.time() - tstart) * 1000))
     print('-' * 50)
+    profiler.report()
+    results.summary(acc=acc_matrix[-1].mean(), bwt=bwt, elapsed_ms=(time.time() - tstart) * 1000)
+    results.save()
 
 
 
@@ -637,6 +622,8 @@ if __name__ == "__main__":
                         default=64,
                         metavar='N',
                         help='input batch size for testing (default: 64)')
+    parser.add_argument('--inference_mode', action='store_true', default=False,
+                        help='run the test loops under torch.inference_mode')
     parser.add_argument('--n_epochs',
                         type=int,
                         default=50,
@@ -699,6 +686,63 @@ if __name__ == "__main__":
     parser.add_argument('--idrandom',default=3,type=int,required=False,help='(default=%(default)d)')
     parser.add_argument('--data_size',default='small',type=str,required=False,help='(default=%(default)s)')
     parser.add_argument("--num_class_femnist",default=62,type=int,required=False,help='(default=%(default)d)')
+    # Results
+    parser.add_argument('--results', type=str, default=None, metavar='PATH',
+                        help='path prefix of the results files (default: ./results/<script>_seed<seed>)')
+    parser.add_argument('--results_format', type=str, nargs='*', default=['csv'], choices=['csv', 'parquet'],
+                        help='tables written next to the JSON results (default: csv)')
+
+    # Profiling
+    parser.add_argument('--trace', type=str, default=None, metavar='PATH',
+                        help='Chrome trace of the stages (data load, training, evaluation, GPM SVDs, ...) (default: none)')
+    parser.add_argument('--torch_profile', type=int, default=0, metavar='N',
+                        help='training steps recorded with torch.profiler, written to <results>_torch_trace.json (default: 0)')
+
+    # Synthetic data
+    parser.add_argument('--synthetic', action='store_true', default=False,
+                        help='seeded synthetic tasks of the dataset shapes instead of the data files, offline')
+    parser.add_argument('--synthetic_train', type=int, default=0, metavar='N',
+                        help='training examples per synthetic task, 0 for about as many as the real tasks (default: 0)')
+
+    # Knowledge transfer
+    parser.add_argument('--kt_every', type=int, default=1, metavar='K',
+                        help='evaluate the knowledge transfer loss every K steps, weighted by K (default: 1)')
+    parser.add_argument('--kt_epochs', type=int, default=0, metavar='N',
+                        help='use the knowledge transfer loss in the first N epochs of a task, 0 for all (default: 0)')
+    parser.add_argument('--kt_tol', type=float, default=0., metavar='TOL',
+                        help='drop the knowledge transfer loss of a task once its epoch mean is below TOL, 0 to keep it (default: 0)')
+
+    # Cache
+    parser.add_argument('--cache_dir', type=str, default='cache', metavar='DIR',
+                        help='cache of the initial distributions, shared by the runs, "" to disable (default: cache)')
+    parser.add_argument('--init_workers', type=int, default=0, metavar='N',
+                        help='processes of the initial distribution pass, 0 for one per task up to the CPUs (default: 0)')
+    parser.add_argument('--prefix_cache', action='store_true', default=False,
+                        help='snapshot the run after every task in the cache and start from the longest '
+                             'snapshot of the same configuration, for sweeps')
+
+    # GPM bases
+    parser.add_argument('--basis_hot', type=int, default=0, metavar='N',
+                        help='tasks whose GPM bases stay in memory, the older ones are memory-mapped from disk, '
+                             '0 to keep every task in memory (default: 0)')
+    parser.add_argument('--basis_dtype', type=str, default='float32', choices=['float64', 'float32', 'float16'],
+                        help='precision of the GPM bases on disk (default: float32)')
+    parser.add_argument('--basis_dir', type=str, default=None, metavar='DIR',
+                        help='directory of the GPM bases on disk, better on a disk than on a tmpfs '
+                             '(default: the temporary directory)')
+
+    # Thresholds
+    parser.add_argument('--gpm_threshold', type=float, nargs=3, default=[0.99, 0.99, 0.99], metavar='TH',
+                        help='GPM energy thresholds of the three layers (default: 0.99 0.99 0.99)')
+    parser.add_argument('--sim_threshold', type=float, default=0.7, metavar='TH',
+                        help='similarity threshold of the knowledge transfer tasks (default: 0.7)')
+
+    # Precision
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='training precision, bf16 autocasts the forward pass and loss (default: fp32)')
+    parser.add_argument('--ortho_tol', type=float, default=1e-3, metavar='TOL',
+                        help='max relative residual of the projected gradients in bf16 mode (default: 1e-3)')
+
     args = parser.parse_args()
     print('=' * 100)
     print('Arguments =')
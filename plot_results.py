@@ -0,0 +1,72 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+
+def main(args):
+    # imported here so that the training scripts never pay for matplotlib
+    import matplotlib
+    if not args.show:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    for path in args.results:
+        with open(path) as f:
+            data = json.load(f)
+        acc = np.array(data['acc_matrix'])
+        n = acc.shape[1] if acc.ndim == 2 else 0
+        fig, (ax_acc, ax_epochs) = plt.subplots(1, 2, figsize=(6 + 0.5 * n, 5))
+
+        # accuracy matrix: row i is the test accuracy on every task after training task i
+        ax_acc.imshow(acc, cmap='viridis', vmin=0, vmax=100)
+        for i in range(acc.shape[0]):
+            for j in range(i + 1):
+                ax_acc.text(j, i, '{:.1f}'.format(acc[i, j]), ha='center', va='center',
+                            fontsize=max(5, 10 - n // 4), color='w')
+        labels = ['T{}'.format(j + 1) for j in range(n)]
+        ax_acc.set_xticks(range(n))
+        ax_acc.set_xticklabels(labels)
+        ax_acc.set_yticks(range(acc.shape[0]))
+        ax_acc.set_yticklabels(labels[:acc.shape[0]])
+        ax_acc.set_xlabel('tested on')
+        ax_acc.set_ylabel('trained up to')
+        summary = data['summary']
+        if 'acc' in summary:
+            ax_acc.set_title('ACC {:.2f}% | BWT {:.2f}%'.format(summary['acc'], summary['bwt']))
+
+        # validation accuracy of every epoch, task after task
+        epochs = data['epochs']
+        for t in sorted(set(e['task'] for e in epochs)):
+            rows = [(i, e[args.metric]) for i, e in enumerate(epochs) if e['task'] == t]
+            ax_epochs.plot(*zip(*rows), label='T{}'.format(t + 1))
+        ax_epochs.set_xlabel('epoch (all tasks)')
+        ax_epochs.set_ylabel(args.metric)
+        if n <= 10:
+            ax_epochs.legend(fontsize=8)
+
+        fig.tight_layout()
+        if args.show:
+            plt.show()
+        else:
+            out = os.path.splitext(path)[0] + '.png'
+            fig.savefig(out, dpi=args.dpi)
+            print('Saved {}'.format(out))
+        plt.close(fig)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Plot the accuracy matrix and the training curves of main_*.py results')
+    parser.add_argument('results', type=str, nargs='+',
+                        help='results JSON files written by the training scripts')
+    parser.add_argument('--metric', type=str, default='valid_acc',
+                        choices=['train_loss', 'train_acc', 'valid_loss', 'valid_acc', 'lr', 'time_ms'],
+                        help='per-epoch metric of the curves (default: valid_acc)')
+    parser.add_argument('--show', action='store_true', default=False,
+                        help='open a window instead of saving <results>.png')
+    parser.add_argument('--dpi', type=int, default=150,
+                        help='resolution of the saved figures (default: 150)')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,154 @@
+import os
+import pickle
+import hashlib
+import multiprocessing
+
+import numpy as np
+import torch
+
+import stil.sampling
+import stil.similarity
+
+
+def _update(h, part):
+    if torch.is_tensor(part):
+        part = part.detach().cpu().numpy()
+    if isinstance(part, np.ndarray):
+        h.update(repr((part.dtype.str, part.shape)).encode())
+        h.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(part, (list, tuple)):
+        h.update(b'[')
+        for p in part:
+            _update(h, p)
+        h.update(b']')
+    elif isinstance(part, dict):
+        _update(h, sorted(part.items()))
+    else:
+        h.update(repr(part).encode())
+
+
+def digest(*parts):
+    '''sha1 of parts, the tensors and arrays by content'''
+    h = hashlib.sha1()
+    _update(h, parts)
+    return h.hexdigest()
+
+
+def model_version(model):
+    '''Architecture and weights of a model'''
+    return digest(str(model), list(model.state_dict().values()))
+
+
+def data_version(tasks, stride=1009):
+    '''Fingerprint of the (x, y) datasets of the tasks: their shapes, their
+    labels and every stride-th input value'''
+    return digest([(tuple(x.shape), y, x.reshape(-1)[::stride]) for x, y in tasks])
+
+
+def file_version(*paths):
+    '''Fingerprint of data files by name, size and modification time'''
+    stats = []
+    for path in paths:
+        st = os.stat(path) if os.path.exists(path) else None
+        stats.append((os.path.basename(path), st and st.st_size, st and st.st_mtime_ns))
+    return digest(stats)
+
+
+def source_version(*paths):
+    '''Fingerprint of source files by content'''
+    sources = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            sources.append(f.read())
+    return hashlib.sha1(b'\0'.join(sources)).hexdigest()
+
+
+def dump(path, value):
+    '''Pickle value to path atomically, through a temporary file of the process'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+_task_fn = None
+
+
+def _call(task):
+    return _task_fn(task)
+
+
+def cpus():
+    '''CPUs the process may use, its affinity mask (pinned sweep runs)'''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def map_tasks(fn, tasks, n_workers=None, device=None):
+    '''[fn(t) for t in tasks], in n_workers forked processes (default: one per
+    task, up to the CPUs the process may use).
+
+    fn is inherited by the workers, not pickled, so it can be a closure over
+    the model and the data; its results are sent back pickled. The CUDA
+    context cannot be forked, and there is no fork on Windows: the tasks then
+    run one after the other.
+    '''
+    if n_workers is None or n_workers <= 0:
+        n_workers = min(len(tasks), cpus())
+    if n_workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods() \
+            or (device is not None and torch.device(device).type == 'cuda'):
+        return [fn(t) for t in tasks]
+    global _task_fn
+    _task_fn = fn
+    # share the intra-op threads of the process between the workers
+    threads = max(1, torch.get_num_threads() // n_workers)
+    try:
+        with multiprocessing.get_context('fork').Pool(n_workers, initializer=torch.set_num_threads,
+                                                      initargs=(threads,)) as pool:
+            return pool.map(_call, tasks, chunksize=1)
+    finally:
+        _task_fn = None
+
+
+class InitCache(object):
+    '''On-disk cache of the initial task distributions of a script.
+
+    The entry of a run is keyed by the script and the code of the
+    representation step (by content), and by the key arguments: the seed, the
+    model (model_version), the dataset (data_version or file_version) and
+    whatever else changes the distributions. get() returns the cached
+    distributions, or computes them with map_tasks and stores them. The
+    entries are written atomically, so concurrent runs of a sweep can share a
+    directory. directory None or '' disables the cache.
+    '''
+
+    def __init__(self, directory, script, **key):
+        script = os.path.abspath(script)
+        key['script'] = os.path.basename(script)
+        key['code'] = source_version(script, stil.sampling.__file__, stil.similarity.__file__)
+        self.key = key
+        self.path = None
+        if directory:
+            self.path = os.path.join(directory, 'init_distribution', digest(key) + '.pkl')
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, value):
+        if self.path is None:
+            return
+        dump(self.path, value)
+
+    def get(self, fn, tasks, n_workers=None, device=None):
+        value = self.load()
+        if value is not None:
+            print('Init distribution loaded from {}'.format(self.path))
+            return value
+        value = map_tasks(fn, tasks, n_workers, device)
+        self.save(value)
+        return value
@@ -0,0 +1,70 @@
+import numpy as np
+import torch
+
+from stil.layers import set_task
+from stil.profiler import profiled
+
+
+def evaluation_mode(inference_mode=False):
+    '''Grad-free context of the test loops, torch.inference_mode if asked'''
+    return torch.inference_mode() if inference_mode else torch.no_grad()
+
+
+def _batches(sets, batch_size):
+    '''Pack the sets back to back into batches of batch_size samples
+
+    Yields (x, y, spans) where spans lists the (set index, start, end) rows
+    of every set in the batch.
+    '''
+    xs, ys, spans, n = [], [], [], 0
+    for j, (t, x, y) in enumerate(sets):
+        i = 0
+        while i < x.size(0):
+            m = min(batch_size - n, x.size(0) - i)
+            xs.append(x[i:i + m])
+            ys.append(y[i:i + m])
+            spans.append((j, n, n + m))
+            n += m
+            i += m
+            if n == batch_size:
+                yield torch.cat(xs), torch.cat(ys), spans
+                xs, ys, spans, n = [], [], [], 0
+    if n > 0:
+        yield torch.cat(xs), torch.cat(ys), spans
+
+
+@profiled('evaluate')
+def evaluate_tasks(model, device, sets, batch_size, input_shape=None,
+                   memory_format=torch.contiguous_format):
+    '''Test accuracy (%) of model on every (task, x, y) of sets in one sweep
+
+    Models with a shared trunk see the test sets of all the tasks packed into
+    the same batches, and the rows of every task are scored with the head of
+    that task. Models that select their BNs or head with set_task, or that
+    normalize with the statistics of the batch, are run one task after the
+    other. The correct counts stay on the device and are read back once at
+    the end.
+    '''
+    model.eval()
+    correct = torch.zeros(len(sets), dtype=torch.long, device=device)
+    routed = any(hasattr(m, 'task') or getattr(m, 'track_running_stats', True) is False
+                 for m in model.modules())
+    groups = [[s] for s in sets] if routed else [sets]
+    offset = 0
+    with torch.inference_mode():
+        for group in groups:
+            if routed:
+                set_task(model, int(group[0][0]))
+            for x, y, spans in _batches(group, batch_size):
+                if input_shape is not None:
+                    x = x.reshape(-1, *input_shape)
+                x = x.to(device, memory_format=memory_format)
+                y = y.to(device)
+                output = model(x)
+                for j, lo, hi in spans:
+                    t = int(group[j][0])
+                    out = output[t] if isinstance(output, list) else output
+                    correct[offset + j] += out[lo:hi].argmax(dim=1).eq(y[lo:hi]).sum()
+            offset += len(group)
+    total = np.array([x.size(0) for t, x, y in sets])
+    return 100. * correct.cpu().numpy() / total
@@ -0,0 +1,212 @@
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from stil.cache import cpus
+from stil.profiler import profiled, stage
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+def svd_cost(activation):
+    # flops of a thin SVD, used to schedule the largest layers first
+    m, n = activation.shape
+    return m * n * min(m, n)
+
+
+def _first_task_layer(activation, threshold):
+    U, S, Vh = np.linalg.svd(activation, full_matrices=False)
+    # criteria (Eq-5)
+    sval_total = (S**2).sum()
+    sval_ratio = (S**2)/sval_total
+    r = np.sum(np.cumsum(sval_ratio) < threshold)  # +1
+    return U[:, 0:r], sval_ratio[0:r]
+
+
+def _next_task_layer(activation, threshold, feature):
+    U1, S1, Vh1 = np.linalg.svd(activation, full_matrices=False)
+    sval_total = (S1**2).sum()
+    sval_ratio = (S1**2)/sval_total
+    r = np.sum(np.cumsum(sval_ratio) < threshold)  # +1
+    base = U1[:, 0:r]
+
+    act_hat = activation - np.dot(np.dot(feature, feature.transpose()), activation)
+    U, S, Vh = np.linalg.svd(act_hat, full_matrices=False)
+
+    sval_hat = (S**2).sum()
+    sval_ratio = (S**2)/sval_total
+    accumulated_sval = (sval_total-sval_hat)/sval_total
+
+    r = 0
+    for ii in range(sval_ratio.shape[0]):
+        if accumulated_sval < threshold:
+            accumulated_sval += sval_ratio[ii]
+            r += 1
+        else:
+            break
+    return base, U[:, 0:r], sval_ratio[0:r]
+
+
+def run_layers(fn, jobs, costs, n_workers=None):
+    '''Run fn(*job) for every layer, largest first, and return results in layer order'''
+    if n_workers is None:
+        n_workers = cpus()
+    n_workers = max(1, min(n_workers, len(jobs)))
+
+    def layer(i):
+        with stage('svd', layer=i):
+            return fn(*jobs[i])
+
+    if n_workers == 1:
+        return [layer(i) for i in range(len(jobs))]
+
+    order = sorted(range(len(jobs)), key=lambda i: costs[i], reverse=True)
+    # numpy releases the GIL inside LAPACK, so threads overlap the SVDs. BLAS
+    # threads are split between workers to avoid oversubscribing the cores
+    # the process is pinned to.
+    blas_threads = max(1, cpus() // n_workers)
+    if threadpool_limits is None:
+        warnings.warn('threadpoolctl is not installed, the BLAS threads of the {} layer '
+                      'workers are not limited'.format(n_workers))
+        limits = None
+    else:
+        limits = threadpool_limits(limits=blas_threads, user_api='blas')
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = {i: pool.submit(layer, i) for i in order}
+            return [futures[i].result() for i in range(len(jobs))]
+    finally:
+        if limits is not None:
+            limits.restore_original_limits()
+
+
+class BasisBudget(object):
+    '''Per-layer rank budget for the GPM bases in feature_list.
+
+    Every column of feature_list[i] carries an importance score (its share of
+    the activation energy when it was added). When a layer goes over its
+    budget, or every `compact_every` tasks, the union basis is re-orthogonalized
+    and compacted with a weighted SVD of the stacked columns, keeping the
+    directions that carry the most energy.
+    '''
+
+    def __init__(self, budget=1.0, compact_every=0, tol=1e-10):
+        self.budget = budget  # fraction of the layer dimension
+        self.compact_every = compact_every
+        self.tol = tol
+        self.scores = {}
+        self.n_updates = 0
+
+    def limit(self, dim):
+        return max(1, min(dim, int(round(self.budget * dim))))
+
+    def add(self, i, scores):
+        if i not in self.scores:
+            self.scores[i] = np.zeros(0)
+        self.scores[i] = np.concatenate((self.scores[i], scores))
+
+    def compact(self, i, basis):
+        '''Weighted SVD of the stacked basis, truncated to the layer budget'''
+        weights = np.sqrt(np.maximum(self.scores[i], self.tol))
+        U, S, Vh = np.linalg.svd(basis * weights, full_matrices=False)
+        r = min(self.limit(basis.shape[0]), int(np.sum(S > self.tol)))
+        self.scores[i] = S[0:r]**2
+        return U[:, 0:r]
+
+    def update(self, i, basis, new_basis, scores):
+        self.add(i, scores)
+        basis = np.hstack((basis, new_basis))
+        if basis.shape[1] > self.limit(basis.shape[0]):
+            print('Compacting GPM for layer: {}'.format(i + 1))
+            basis = self.compact(i, basis)
+        return basis
+
+    def fit(self, feature_list):
+        '''Compact the layers over their budget'''
+        for i in range(len(feature_list)):
+            if feature_list[i].shape[1] > self.limit(feature_list[i].shape[0]):
+                print('Compacting GPM for layer: {}'.format(i + 1))
+                feature_list[i] = self.compact(i, feature_list[i])
+
+    def step(self, feature_list):
+        '''Called once per task, compacts every layer periodically and the
+        layers over their budget otherwise'''
+        self.n_updates += 1
+        if self.compact_every and self.n_updates % self.compact_every == 0:
+            print('Compacting GPM bases')
+            for i in range(len(feature_list)):
+                feature_list[i] = self.compact(i, feature_list[i])
+        else:
+            self.fit(feature_list)
+
+    def report(self, feature_list):
+        print('-'*40)
+        print('Basis Capacity Used')
+        print('-'*40)
+        for i in range(len(feature_list)):
+            used, dim = feature_list[i].shape[1], feature_list[i].shape[0]
+            print('Layer {} : {}/{} ({:5.1f}%)'.format(
+                i+1, used, self.limit(dim), 100. * used / self.limit(dim)))
+        print('-'*40)
+
+
+@profiled('update_GPM')
+def update_GPM(task_id, model, mat_list, threshold, feature_list=[], proj=None, every_task_base=None, n_workers=None, budget=None):
+    '''Update the GPM, decomposing the layers of mat_list in parallel'''
+    print('Threshold: ', threshold)
+    costs = [svd_cost(activation) for activation in mat_list]
+    if not feature_list:
+        # After First Task
+        jobs = [(mat_list[i], threshold[i]) for i in range(len(mat_list))]
+        bases = run_layers(_first_task_layer, jobs, costs, n_workers)
+        for i in range(len(mat_list)):
+            base, scores = bases[i]
+            feature_list.append(base)
+            proj[task_id][i] = base
+            every_task_base[task_id][i] = base
+            if budget is not None:
+                budget.add(i, scores)
+        if budget is not None:
+            budget.fit(feature_list)
+    else:
+        jobs = [(mat_list[i], threshold[i], feature_list[i])
+                for i in range(len(mat_list))]
+        results = run_layers(_next_task_layer, jobs, costs, n_workers)
+        for i in range(len(mat_list)):
+            base, U, scores = results[i]
+            every_task_base[task_id][i] = base
+            r = U.shape[1]
+            if r != 0:
+                print('Not Skip Updating GPM for layer: {}'.format(i + 1))
+                # update GPM
+                if budget is not None:
+                    feature_list[i] = budget.update(i, feature_list[i], U, scores)
+                else:
+                    Ui = np.hstack((feature_list[i], U))
+                    if Ui.shape[1] > Ui.shape[0]:
+                        print('Base Matrix has OOM')
+                        feature_list[i] = Ui[:, 0:Ui.shape[0]]
+                    else:
+                        feature_list[i] = Ui
+            if r == 0:
+                proj[task_id][i] = proj[task_id-1][i]
+            else:
+                proj[task_id][i] = U
+        if budget is not None:
+            budget.step(feature_list)
+
+    print('-'*40)
+    print('Gradient Constraints Summary')
+    print('-'*40)
+    for i in range(len(feature_list)):
+        print('Layer {} : {}/{}'.format(i+1,
+              feature_list[i].shape[1], feature_list[i].shape[0]))
+    print('-'*40)
+    if budget is not None:
+        assert all(f.shape[1] <= budget.limit(f.shape[0]) for f in feature_list), 'GPM bases over budget'
+        budget.report(feature_list)
+    return feature_list
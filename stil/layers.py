@@ -0,0 +1,117 @@
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+
+def set_projections(model, p):
+    '''Hand p[i] to the i-th Conv2d/Linear of model for its next forward
+
+    Layers are counted in registration order, the order of the GPM
+    feature_list, so the ResNet shortcut convs keep their slot in p even
+    though they are never projected.
+    '''
+    layers = [m for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+    for layer, basis in zip(layers, p):
+        if hasattr(layer, 'set_projection'):
+            layer.set_projection(basis)
+
+
+def set_task(model, t):
+    '''Select task t on every module of model with per-task BNs or heads'''
+    for m in model.modules():
+        if hasattr(m, 'task'):
+            m.task = t
+
+
+class TaskModuleList(nn.ModuleList):
+    '''ModuleList of per-task modules (task BNs and heads), built on demand
+
+    Entry t is created with factory(t) when task t is prepared, so the modules
+    of the future tasks do not exist yet and stay out of the state_dict and of
+    the optimizers.
+    '''
+
+    def __init__(self, factory, n_tasks):
+        super(TaskModuleList, self).__init__()
+        self.factory = factory
+        self.n_tasks = n_tasks
+
+    def materialize(self, t):
+        if t >= self.n_tasks:
+            raise IndexError('task {} out of range for {} tasks'.format(t, self.n_tasks))
+        created = []
+        while len(self) <= t:
+            created.append(self.factory(len(self)))
+            self.append(created[-1])
+        return created
+
+
+def prepare_task(model, t, init=None):
+    '''Create the task t modules of model, freeze the other tasks and select t
+
+    The new modules are moved to the device of model and initialized with
+    init, as model.apply(init) would have done at construction.
+    '''
+    device = next(model.parameters()).device
+    for m in [m for m in model.modules() if isinstance(m, TaskModuleList)]:
+        for new in m.materialize(t):
+            new.to(device)
+            if init is not None:
+                new.apply(init)
+        for i, task_module in enumerate(m):
+            task_module.requires_grad_(bool(i == t))
+    set_task(model, t)
+
+
+def trainable(model):
+    '''Parameters handed to the optimizer, the frozen task modules are left out'''
+    return [p for p in model.parameters() if p.requires_grad]
+
+
+@contextmanager
+def recording(model):
+    '''Record the layer inputs into the act dicts of model inside the block'''
+    modules = [m for m in model.modules() if hasattr(m, 'record')]
+    for m in modules:
+        m.record = True
+    try:
+        yield model
+    finally:
+        for m in modules:
+            m.record = False
+
+
+def compile_model(model, enabled=True, backend='inductor'):
+    '''Run the forward of model under torch.compile (torch >= 2.0), in place
+
+    The forward is replaced on the instance, so the state_dict, the
+    parameters and the attributes of model stay the same. The forwards that
+    branch on a side state run eagerly: the first one after set_projections
+    (the weight projection of a task boundary) and the recorded ones of the
+    representation matrices. The compiled graphs then only change with the
+    task modules and the train/eval mode, once per task and mode.
+    '''
+    if not enabled:
+        return model
+    if not hasattr(torch, 'compile'):
+        raise RuntimeError('--compile needs torch >= 2.0 (found {})'.format(torch.__version__))
+    import torch._dynamo as dynamo
+    # a graph per task and mode, more than the default limit of 8
+    dynamo.config.cache_size_limit = max(dynamo.config.cache_size_limit, 128)
+    eager = model.forward
+    compiled = torch.compile(eager, backend=backend)
+    projected = [m for m in model.modules() if hasattr(m, 'norm_project')]
+    recorded = [m for m in model.modules() if hasattr(m, 'record')]
+
+    def forward(*args, **kwargs):
+        if any(m.norm_project is not None for m in projected) or any(m.record for m in recorded):
+            return eager(*args, **kwargs)
+        return compiled(*args, **kwargs)
+    model.forward = forward
+    return model
+
+
+def memory_format(channels_last):
+    '''Memory format of the conv models and of their input batches'''
+    return torch.channels_last if channels_last else torch.contiguous_format
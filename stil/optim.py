@@ -0,0 +1,101 @@
+import torch
+from torch.optim import Optimizer
+
+
+class ProjectedSGD(Optimizer):
+    '''SGD with momentum on gradients projected out of the GPM subspace.
+
+    projectors is a list of (param, matrix) pairs. With factored=False the
+    matrix is the dense projection P = U U^T of the layer, otherwise it is the
+    basis U and the projection is applied as (g U) U^T. Before the update the
+    gradient g of every projected param is replaced by g - g P. Params in
+    frozen are left untouched, as if their gradients were zeroed.
+
+    With tol set, every step also checks that the projected gradients are
+    orthogonal to the bases, ||g' P|| <= tol ||g||, and keeps the largest
+    relative residual seen in self.residual.
+    '''
+
+    def __init__(self, params, lr, momentum=0, projectors=(), frozen=(), factored=False, tol=None):
+        if lr < 0.0:
+            raise ValueError('Invalid learning rate: {}'.format(lr))
+        if momentum < 0.0:
+            raise ValueError('Invalid momentum value: {}'.format(momentum))
+        defaults = dict(lr=lr, momentum=momentum)
+        super(ProjectedSGD, self).__init__(params, defaults)
+        self.factored = factored
+        self.frozen = set(id(p) for p in frozen)
+        self.projectors = self._stack(projectors)
+        self.tol = tol
+        self.residual = 0.
+
+    @staticmethod
+    def _stack(projectors):
+        # projectors sharing a shape are stacked once, so that each group is
+        # projected with a single bmm instead of one mm per param. The stack
+        # copies the matrices: the callers drop theirs once the optimizer is
+        # built. A group of one is a view.
+        groups = {}
+        for param, mat in projectors:
+            key = (tuple(param.shape), tuple(mat.shape))
+            groups.setdefault(key, ([], []))
+            groups[key][0].append(param)
+            groups[key][1].append(mat)
+        return [(params, mats[0].unsqueeze(0) if len(mats) == 1 else torch.stack(mats))
+                for params, mats in groups.values()]
+
+    @torch.no_grad()
+    def project(self):
+        for params, mats in self.projectors:
+            grads = [p.grad for p in params]
+            g = torch.stack([grad.reshape(grad.size(0), -1) for grad in grads])
+            if self.factored:
+                delta = torch.bmm(torch.bmm(g, mats), mats.transpose(1, 2))
+            else:
+                delta = torch.bmm(g, mats)
+            torch._foreach_sub_(grads, [d.view_as(grad) for d, grad in zip(delta.unbind(0), grads)])
+            if self.tol is not None:
+                self.check(g - delta, g, mats)
+
+    def check(self, projected, g, mats):
+        # g U for the factored bases has the norm of g U U^T
+        residual = torch.bmm(projected, mats).flatten(1).norm(dim=1) / \
+            g.flatten(1).norm(dim=1).clamp_min(1e-12)
+        residual = residual.max().item()
+        self.residual = max(self.residual, residual)
+        if residual > self.tol:
+            raise RuntimeError('Projected gradient is not orthogonal to the GPM bases: '
+                               'residual {:.2e} > tol {:.2e}'.format(residual, self.tol))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        self.project()
+        for group in self.param_groups:
+            params = [p for p in group['params']
+                      if p.grad is not None and id(p) not in self.frozen]
+            if len(params) == 0:
+                continue
+            grads = [p.grad for p in params]
+            if group['momentum'] != 0:
+                bufs, old_bufs, old_grads = [], [], []
+                for p in params:
+                    state = self.state[p]
+                    if 'momentum_buffer' not in state:
+                        # first step: the buffer starts from the gradient
+                        state['momentum_buffer'] = torch.clone(p.grad).detach()
+                    else:
+                        old_bufs.append(state['momentum_buffer'])
+                        old_grads.append(p.grad)
+                    bufs.append(state['momentum_buffer'])
+                if old_bufs:
+                    torch._foreach_mul_(old_bufs, group['momentum'])
+                    torch._foreach_add_(old_bufs, old_grads)
+                grads = bufs
+            torch._foreach_add_(params, grads, alpha=-group['lr'])
+
+        return loss
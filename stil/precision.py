@@ -0,0 +1,11 @@
+import torch
+
+
+def autocast(precision, device):
+    '''Autocast context for the forward pass and loss of the training loops
+
+    With precision 'bf16' the matmuls and convolutions run in bfloat16;
+    parameters, gradients and the GPM projections stay in float32.
+    '''
+    return torch.autocast(torch.device(device).type, dtype=torch.bfloat16,
+                          enabled=precision == 'bf16')
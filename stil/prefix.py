@@ -0,0 +1,99 @@
+import os
+import glob
+import pickle
+import random
+
+import numpy as np
+import torch
+
+from stil.cache import digest, dump, source_version
+
+# arguments that do not change what a run computes
+OUTPUT_ARGS = ('results', 'results_format', 'trace', 'torch_profile', 'cache_dir',
+               'init_workers', 'prefix_cache', 'cuda', 'basis_dir')
+# arguments only used from the second task on (projected training, similarity)
+LATER_ARGS = ('sim_threshold', 'gpm_threshold_step', 'kt_every', 'kt_epochs', 'kt_tol',
+              'ortho_tol', 'basis_hot', 'basis_dtype')
+
+
+def rng_state():
+    '''States of the python, numpy and torch generators'''
+    state = dict(python=random.getstate(), numpy=np.random.get_state(),
+                 torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class PrefixCache(object):
+    '''Snapshots of a run at its task boundaries, for the runs of a sweep to
+    fork from.
+
+    The snapshot after task t holds the model, the GPM state and the
+    distributions the scripts pass in, the results so far and the random
+    generators, so a run restored from it goes on exactly as the run that
+    saved it. It is keyed by what the first t + 1 tasks depend on: the script
+    and the code of stil (by content), the key of the initial distributions
+    (init, the InitCache key: seed, model, dataset, device) and the arguments
+    but OUTPUT_ARGS, leaving out the arguments of `later` for the first task.
+    Runs that only differ in those share the first task only: the snapshots
+    of the later tasks are keyed by all of them, whichever task they are
+    first used in. Runs that differ in any other argument share nothing.
+
+    directory None or '' disables the snapshots.
+    '''
+
+    def __init__(self, directory, script, args, init=None, later=LATER_ARGS):
+        script = os.path.abspath(script)
+        stil = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py')))
+        values = {k: v for k, v in vars(args).items() if k not in OUTPUT_ARGS}
+        self.key = dict(script=os.path.basename(script), code=source_version(script, *stil),
+                        init=init, args={k: v for k, v in values.items() if k not in later})
+        self.later = {k: v for k, v in values.items() if k in later}
+        self.directory = os.path.join(directory, 'prefix') if directory else None
+
+    def path(self, task_id):
+        '''Snapshot file after task task_id'''
+        later = self.later if task_id > 0 else {}
+        return os.path.join(self.directory, digest(self.key, later, task_id) + '.pkl')
+
+    def find(self, n_tasks):
+        '''(number of tasks, snapshot) of the longest cached prefix, (0, None) if none'''
+        if self.directory is None:
+            return 0, None
+        for task_id in reversed(range(n_tasks)):
+            path = self.path(task_id)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    snapshot = pickle.load(f)
+                print('Resuming after task {} from {}'.format(task_id, path))
+                return task_id + 1, snapshot
+        return 0, None
+
+    def restore(self, snapshot, model, results=None):
+        '''Load the model, the results and the random generators of a snapshot
+        into a model with the modules of its tasks, return the saved state'''
+        model.load_state_dict(snapshot['model'])
+        if results is not None:
+            results.data.update(snapshot['results'])
+            results.summary(prefix_tasks=snapshot['task_id'] + 1)
+        set_rng_state(snapshot['rng'])
+        return snapshot['state']
+
+    def save(self, task_id, model, results=None, **state):
+        '''Snapshot after task task_id, of the model and of the keyword arguments'''
+        if self.directory is None:
+            return
+        saved = {}
+        if results is not None:
+            saved = {k: results.data[k] for k in ('epochs', 'acc_matrix', 'task_order')}
+        dump(self.path(task_id), dict(task_id=task_id, model=model.state_dict(), results=saved,
+                                      rng=rng_state(), state=state))
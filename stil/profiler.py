@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import functools
+import threading
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_profiler = None
+
+
+def set_profiler(profiler):
+    '''Make profiler the target of stage(), profiled() and step(), None to disable'''
+    global _profiler
+    _profiler = profiler
+
+
+def stage(name, task_id=None, **info):
+    '''Time the enclosed block as a stage of the active profiler, if any'''
+    if _profiler is None:
+        return _nothing()
+    return _profiler.stage(name, task_id, **info)
+
+
+def profiled(name):
+    '''Decorator recording every call of a function as the stage `name`'''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def step():
+    '''Mark the end of a training step, for the torch.profiler capture'''
+    if _profiler is not None:
+        _profiler.step()
+
+
+@contextmanager
+def _nothing():
+    yield
+
+
+def _makedirs(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+
+def peak_rss_mb():
+    '''Peak resident set size of the process so far (MB)'''
+    if resource is None:
+        return float('nan')
+    # kB on Linux, bytes on macOS
+    scale = 1. / 1024**2 if os.uname().sysname == 'Darwin' else 1. / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class Profiler(object):
+    '''Wall time, CPU time and peak memory of the stages of a run.
+
+    Stages are opened with stage() (or the profiled() decorator) and can be
+    nested; a stage without a task_id belongs to the current task, set with
+    `profiler.task_id = t`. The CPU time is the process time, so it includes
+    the intra-op and BLAS threads (and the overlapping stages of other Python
+    threads). The memory is the peak RSS of the process at the end of the
+    stage, and on CUDA the peak allocated device memory since the outermost
+    stage began. The events can be exported as a Chrome trace (chrome://tracing
+    or Perfetto) or summed per task and stage with table().
+
+    With torch_steps > 0, torch.profiler records the first torch_steps
+    training steps (after one warmup step) and writes its own Chrome trace to
+    torch_trace.
+    '''
+
+    def __init__(self, device=None, trace=None, torch_steps=0, torch_trace=None):
+        self.cuda = device is not None and torch.device(device).type == 'cuda' \
+            and torch.cuda.is_available()
+        self.trace = trace
+        self.torch_steps = torch_steps
+        self.torch_trace = torch_trace
+        self.task_id = None
+        self.events = []
+        self.t0 = time.perf_counter()
+        self.local = threading.local()
+        self.tids = {}
+        self.torch_profile = None
+        self.n_steps = 0
+
+    @contextmanager
+    def stage(self, name, task_id=None, **info):
+        depth = getattr(self.local, 'depth', 0)
+        if self.cuda and depth == 0:
+            torch.cuda.reset_peak_memory_stats()
+        self.local.depth = depth + 1
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            if self.cuda:
+                torch.cuda.synchronize()
+            wall1, cpu1 = time.perf_counter(), time.process_time()
+            self.local.depth = depth
+            event = {'stage': name,
+                     'task': self.task_id if task_id is None else task_id,
+                     'start': wall0 - self.t0, 'wall': wall1 - wall0, 'cpu': cpu1 - cpu0,
+                     'peak_rss_mb': peak_rss_mb(), 'depth': depth,
+                     'tid': threading.get_ident(), 'info': info}
+            if self.cuda:
+                event['device_peak_mb'] = torch.cuda.max_memory_allocated() / 1024**2
+            self.events.append(event)
+
+    def step(self):
+        if self.n_steps == 0 and self.torch_steps > 0:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profile = torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True,
+                schedule=torch.profiler.schedule(wait=0, warmup=1, active=self.torch_steps, repeat=1),
+                on_trace_ready=lambda p: p.export_chrome_trace(self.torch_trace))
+            _makedirs(self.torch_trace)
+            self.torch_profile.start()
+        elif self.torch_profile is not None:
+            self.torch_profile.step()
+            if self.n_steps == self.torch_steps + 1:  # warmup + active steps done
+                self.torch_profile.stop()
+                self.torch_profile = None
+                print('torch.profiler trace of {} steps: {}'.format(self.torch_steps, self.torch_trace))
+        self.n_steps += 1
+
+    def table(self):
+        '''Totals per (task, stage), in order of first appearance'''
+        rows = {}
+        for e in self.events:
+            key = (e['task'], e['stage'])
+            if key not in rows:
+                rows[key] = {'task': e['task'], 'stage': e['stage'], 'calls': 0,
+                             'wall_s': 0., 'cpu_s': 0., 'peak_rss_mb': 0.}
+            row = rows[key]
+            row['calls'] += 1
+            row['wall_s'] += e['wall']
+            row['cpu_s'] += e['cpu']
+            row['peak_rss_mb'] = max(row['peak_rss_mb'], e['peak_rss_mb'])
+            if 'device_peak_mb' in e:
+                row['device_peak_mb'] = max(row.get('device_peak_mb', 0.), e['device_peak_mb'])
+        return list(rows.values())
+
+    def report(self):
+        print('-' * 78)
+        print('{:>4s} {:20s} {:>6s} {:>10s} {:>10s} {:>11s}'.format(
+            'task', 'stage', 'calls', 'wall (s)', 'cpu (s)', 'peak (MB)'))
+        print('-' * 78)
+        for row in self.table():
+            peak = row.get('device_peak_mb', row['peak_rss_mb'])
+            print('{:>4s} {:20s} {:6d} {:10.2f} {:10.2f} {:11.1f}'.format(
+                '-' if row['task'] is None else str(row['task']), row['stage'],
+                row['calls'], row['wall_s'], row['cpu_s'], peak))
+        print('-' * 78)
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        events = []
+        for e in self.events:
+            tid = self.tids.setdefault(e['tid'], len(self.tids))
+            args = {'task': e['task'], 'cpu_ms': 1000 * e['cpu'], 'peak_rss_mb': e['peak_rss_mb']}
+            if 'device_peak_mb' in e:
+                args['device_peak_mb'] = e['device_peak_mb']
+            args.update(e['info'])
+            events.append({'name': e['stage'], 'cat': 'stage', 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': 1e6 * e['start'], 'dur': 1e6 * e['wall'], 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self):
+        '''Write the Chrome trace of the stages, if a trace path was given'''
+        if self.trace is None:
+            return
+        _makedirs(self.trace)
+        with open(self.trace, 'w') as f:
+            json.dump(self.chrome_trace(), f)
@@ -0,0 +1,90 @@
+import os
+import sys
+import csv
+import json
+
+import numpy as np
+
+
+def _plain(value):
+    '''JSON-friendly copy of numpy scalars/arrays and other argparse values'''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def _fields(rows):
+    fields = []
+    for row in rows:
+        fields += [k for k in row if k not in fields]
+    return fields
+
+
+class Results(object):
+    '''Structured results of one run: accuracy matrix, per-epoch metrics and
+    per-stage timings.
+
+    Everything is written under the path prefix `path` (default
+    ./results/<script>_seed<seed>): `<path>.json` always, plus the
+    `<path>_acc`, `<path>_epochs` and `<path>_timings` tables in every format
+    of `formats` ('csv', 'parquet'). save() rewrites the files, so the scripts
+    call it after every task and an interrupted run keeps what it finished.
+    Parquet needs pandas with pyarrow or fastparquet, imported only then.
+    '''
+
+    def __init__(self, path, args, formats=('json',)):
+        if path is None:
+            script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+            path = os.path.join('results', '{}_seed{}'.format(script, args.seed))
+        self.path = path
+        self.formats = set(formats)
+        self.data = {'args': _plain(vars(args)), 'task_order': [],
+                     'acc_matrix': [], 'summary': {}, 'epochs': [], 'timings': []}
+
+    def epoch(self, task_id, epoch, **metrics):
+        row = {'task': task_id, 'epoch': epoch}
+        row.update(metrics)
+        self.data['epochs'].append(_plain(row))
+
+    def timings(self, rows):
+        '''Per task and stage totals, from Profiler.table()'''
+        self.data['timings'] = _plain(rows)
+
+    def accuracy(self, acc_matrix, task_order):
+        self.data['acc_matrix'] = _plain(acc_matrix)
+        self.data['task_order'] = _plain(task_order)
+
+    def summary(self, **values):
+        self.data['summary'].update(_plain(values))
+
+    def tables(self):
+        '''(name, fields, rows) of the tabular outputs'''
+        acc = [dict([('task', i)] + [('T{}'.format(j + 1), a) for j, a in enumerate(row)])
+               for i, row in enumerate(self.data['acc_matrix'])]
+        return [('acc', list(acc[0]) if acc else ['task'], acc),
+                ('epochs', _fields(self.data['epochs']), self.data['epochs']),
+                ('timings', _fields(self.data['timings']), self.data['timings'])]
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.data, f, indent=1)
+        for name, fields, rows in self.tables():
+            if 'csv' in self.formats:
+                with open('{}_{}.csv'.format(self.path, name), 'w', newline='') as f:
+                    writer = csv.DictWriter(f, fieldnames=fields)
+                    writer.writeheader()
+                    writer.writerows(rows)
+            if 'parquet' in self.formats:
+                import pandas as pd
+                pd.DataFrame(rows, columns=fields).to_parquet('{}_{}.parquet'.format(self.path, name))
@@ -0,0 +1,62 @@
+import hashlib
+
+import numpy as np
+import torch
+
+
+class ClassSampler(object):
+    '''Class-balanced, seeded representation examples of the tasks.
+
+    The first call for a task builds its index table (the training indices
+    grouped by class, from one sort of the labels); a sample then only draws
+    the requested indices, O(n) whatever the size of the task. The samples of
+    a task depend on the seed and the task id only, so every representation
+    step of a task (initial distribution, similarity, GPM update) sees the
+    same examples. They are interleaved by class, so any prefix of a sample
+    (the batch_list of the representation matrices) stays balanced.
+
+    A class with fewer examples than its share is sampled with replacement.
+    The table of a task is checked against the labels of every call, so the
+    labels of another task under the same id raise ValueError.
+    '''
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.tables = {}
+
+    def table(self, task_id, y):
+        '''(indices sorted by class, start and count of every class) of a task'''
+        labels = y.cpu().numpy() if torch.is_tensor(y) else np.asarray(y)
+        key = (len(labels), hashlib.blake2b(np.ascontiguousarray(labels).tobytes(), digest_size=8).hexdigest())
+        if task_id not in self.tables:
+            order = np.argsort(labels, kind='stable')
+            _, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+            self.tables[task_id] = (key, (order, starts, counts))
+        if self.tables[task_id][0] != key:
+            raise ValueError('ClassSampler: task {} was sampled with other labels before, '
+                             'a task id must always stand for the same task'.format(task_id))
+        return self.tables[task_id][1]
+
+    def sample(self, task_id, y, n=None, per_class=None):
+        '''Indices of n examples (or per_class examples of every class) of a task
+
+        The n examples are shared out evenly between the classes, the remainder
+        going to classes drawn at random.
+        '''
+        order, starts, counts = self.table(task_id, y)
+        rng = np.random.default_rng([self.seed, task_id])
+        n_classes = len(counts)
+        if per_class is not None:
+            quotas = np.full(n_classes, per_class)
+        else:
+            quotas = np.full(n_classes, n // n_classes)
+            quotas[rng.choice(n_classes, n % n_classes, replace=False)] += 1
+        index, rank = [], []
+        for c in range(n_classes):
+            offsets = rng.choice(counts[c], quotas[c], replace=quotas[c] > counts[c])
+            index.append(order[starts[c] + offsets])
+            rank.append(np.arange(quotas[c]))
+        index, rank = np.concatenate(index), np.concatenate(rank)
+        # round robin over the classes
+        index = index[np.argsort(rank, kind='stable')]
+        return torch.as_tensor(index, device=y.device if torch.is_tensor(y) else None)
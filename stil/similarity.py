@@ -0,0 +1,60 @@
+import numpy as np
+
+
+def patch_multiplicity(size, ksz, stride=1, s=None):
+    '''Number of the s patches (ksz wide, stride apart) covering every position
+    of a map dimension of length size, already padded'''
+    if s is None:
+        s = (size - ksz) // stride + 1
+    counts = np.zeros(size, dtype=np.int64)
+    for ii in range(s):
+        counts[stride * ii:stride * ii + ksz] += 1
+    return counts
+
+
+class Distribution(object):
+    '''Empirical distribution of the activations of a layer, for wasserstein().
+
+    It is kept as the sorted distinct values and their cumulative weights, so
+    the values are sorted once instead of at every distance, and repeated
+    values (the zeros of the ReLUs, the padding) are stored once.
+    '''
+
+    def __init__(self, values, weights=None):
+        values = np.asarray(values).ravel()
+        weights = np.ones(values.size, dtype=np.int64) if weights is None \
+            else np.asarray(weights).ravel()
+        keep = weights > 0
+        values, weights = values[keep], weights[keep]
+        order = np.argsort(values, kind='stable')
+        values, weights = values[order], weights[order]
+        self.values, starts = np.unique(values, return_index=True)
+        self.cumweights = np.concatenate(([0], np.cumsum(np.add.reduceat(weights, starts))))
+
+    @classmethod
+    def im2col(cls, act, ksz, stride=1, s=None):
+        '''Distribution of the entries of the im2col matrix of act (bsz, C, H, W)
+        with s x s patches, from act and the patch multiplicity of its entries,
+        without building the matrix'''
+        weights = np.outer(patch_multiplicity(act.shape[2], ksz, stride, s),
+                           patch_multiplicity(act.shape[3], ksz, stride, s))
+        return cls(act, np.broadcast_to(weights, act.shape))
+
+    def __len__(self):
+        return len(self.values)
+
+    def cdf(self, x):
+        return self.cumweights[self.values.searchsorted(x, 'right')] / self.cumweights[-1]
+
+
+def wasserstein(u, v):
+    '''scipy.stats.wasserstein_distance of two Distributions (or value arrays)'''
+    if u is v:
+        return 0.
+    u = u if isinstance(u, Distribution) else Distribution(u)
+    v = v if isinstance(v, Distribution) else Distribution(v)
+    # both are sorted, the merge sort only merges the two runs
+    all_values = np.concatenate((u.values, v.values)).astype(np.float64)
+    all_values.sort(kind='mergesort')
+    deltas = np.diff(all_values)
+    return float(np.dot(np.abs(u.cdf(all_values[:-1]) - v.cdf(all_values[:-1])), deltas))
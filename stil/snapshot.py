@@ -0,0 +1,44 @@
+import torch
+import torch.nn as nn
+
+
+def task_state(model, task_id):
+    '''Names of the state_dict entries that can change while training task_id.
+
+    Every nn.ModuleList of the STIL models holds one module per task (the task
+    BNs and heads), so the entries of the other tasks are left out.
+    '''
+    others = []
+    for name, m in model.named_modules():
+        if isinstance(m, nn.ModuleList):
+            others += ['{}.{}.'.format(name, t) for t in range(len(m)) if t != task_id]
+    return [n for n in model.state_dict() if not n.startswith(tuple(others))]
+
+
+class BestModel(object):
+    '''Best-model tracker with one preallocated shadow tensor per state entry.
+
+    save() and restore() copy in place between the model and the shadow
+    tensors, instead of deep copying the state_dict every time the validation
+    loss improves. With task_id set, only the entries that can change while
+    training that task are tracked (the shared weights, the task BN and the
+    task head). The tracker is created after the model is on its device and
+    in its memory format, and starts from the current state of the model.
+    '''
+
+    def __init__(self, model, task_id=None):
+        # state_dict tensors share their storage with the model
+        state = model.state_dict()
+        names = list(state) if task_id is None else task_state(model, task_id)
+        self.state = [state[n] for n in names]
+        self.shadow = [t.clone() for t in self.state]
+
+    @torch.no_grad()
+    def save(self):
+        for shadow, t in zip(self.shadow, self.state):
+            shadow.copy_(t)
+
+    @torch.no_grad()
+    def restore(self):
+        for shadow, t in zip(self.shadow, self.state):
+            t.copy_(shadow)
@@ -0,0 +1,100 @@
+import os
+import shutil
+import weakref
+import tempfile
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+
+
+class _ColdTask(Mapping):
+    '''{layer: basis} of a task on disk, memory-mapped when a layer is read'''
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def __getitem__(self, layer):
+        # copy on write: the pages stay on disk, the array is writable for torch
+        base = np.load(self.paths[layer], mmap_mode='c')
+        return base.astype(np.float32) if base.dtype == np.float16 else base
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class BasisStore(MutableMapping):
+    '''GPM bases of every task (proj, every_task_base), the older tasks on disk.
+
+    store[t] is the {layer: basis} dict of task t, filled by update_GPM. The
+    `hot` most recent filled tasks stay in memory as they are; when a new task
+    is added, the filled tasks before them are written to disk in `dtype`
+    and their dicts are replaced by memory-mapped views, read layer by layer
+    when a basis is used (float16 ones as float32). train_projected only reads the
+    previous task and the knowledge transfer loss a few similar tasks, so the
+    resident memory stays flat however long the task sequence. The largest
+    relative rounding error of every task moved to disk is printed and kept in
+    `errors`.
+
+    The files go to a temporary directory of the run under `directory`
+    (default: the system one, which may be a tmpfs held in memory), removed
+    with the store. hot 0 keeps every task in memory.
+    '''
+
+    def __init__(self, name, hot=0, dtype='float32', directory=None):
+        self.name = name
+        self.hot = hot
+        self.dtype = np.dtype(dtype)
+        self.directory = directory
+        self.tasks = {}
+        self.errors = {}
+        self.path = None
+
+    def __getitem__(self, task_id):
+        return self.tasks[task_id]
+
+    def __setitem__(self, task_id, bases):
+        self.tasks[task_id] = bases
+        if self.hot > 0:
+            # the empty dict of the new task, filled by update_GPM after its
+            # training, does not count: the previous tasks are still read
+            warm = sorted(t for t, b in self.tasks.items() if b and not isinstance(b, _ColdTask))
+            for t in warm[:-self.hot]:
+                self.evict(t)
+
+    def __delitem__(self, task_id):
+        del self.tasks[task_id]
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def evict(self, task_id):
+        '''Move the bases of a task to disk'''
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='stil_{}_'.format(self.name), dir=self.directory)
+            weakref.finalize(self, shutil.rmtree, self.path, True)
+        paths, error = {}, 0.
+        for layer, base in self.tasks[task_id].items():
+            base = np.asarray(base)
+            stored = base.astype(self.dtype)
+            scale = np.abs(base).max() if base.size else 0.
+            if scale > 0:
+                error = max(error, float(np.abs(stored - base).max() / scale))
+            paths[layer] = os.path.join(self.path, '{}_{}.npy'.format(task_id, layer))
+            np.save(paths[layer], stored)
+        self.tasks[task_id] = _ColdTask(paths)
+        self.errors[task_id] = error
+        print('{} of task {} moved to disk as {}, max relative error {:.1e}'.format(
+            self.name, task_id, self.dtype, error))
+
+    def __getstate__(self):
+        # the bases themselves, the files go with the store
+        state = dict(self.__dict__, path=None)
+        state['tasks'] = {t: {layer: np.array(base) for layer, base in bases.items()}
+                          for t, bases in self.tasks.items()}
+        return state
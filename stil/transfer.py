@@ -0,0 +1,156 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# eps of F.cosine_similarity
+_EPS = 1e-8
+
+
+def _tensor(base, device):
+    return torch.as_tensor(np.asarray(base), dtype=torch.float32, device=device)
+
+
+def _gram(base, tol=1e-5):
+    '''B^T B, or None when the columns of B are orthonormal (the SVD bases)'''
+    gram = torch.mm(base.t(), base)
+    eye = torch.eye(gram.size(0), dtype=gram.dtype, device=gram.device)
+    return None if torch.allclose(gram, eye, atol=tol) else gram
+
+
+def _projected_cos(w, current, similar, k):
+    # rows of W P_cur against the rows of W P_j, with the n x n projectors
+    w_cur = torch.mm(w, current)
+    w_sim = torch.mm(w, similar).view(w.size(0), k, w.size(1))
+    return F.cosine_similarity(w_cur.unsqueeze(1), w_sim, dim=2).mean(dim=0)
+
+
+def _closed_form_cos(w, current, similar, cross, gram_cur, gram_sim, segments):
+    # with u = w B_cur and v_j = w B_j, the rows a = w P_cur and b_j = w P_j give
+    #   a.b_j = u (B_cur^T B_j) v_j^T,  |a|^2 = u G_cur u^T,  |b_j|^2 = v_j G_j v_j^T
+    u = torch.mm(w, current)
+    v = torch.mm(w, similar)
+    dots = torch.mm(torch.mm(u, cross) * v, segments)
+    norm_cur = (u * u if gram_cur is None else torch.mm(u, gram_cur) * u).sum(dim=1)
+    norm_sim = torch.mm(v * v if gram_sim is None else torch.mm(v, gram_sim) * v, segments)
+    norms = (norm_cur.unsqueeze(1) * norm_sim).clamp_min(_EPS * _EPS).sqrt()
+    return (dots / norms).mean(dim=0)
+
+
+class TransferLoss(object):
+    '''Knowledge transfer regularizer of train_projected, batched per layer.
+
+    layers lists (param, current base, [similar task bases]) for every
+    projected layer, as collected by the transfer_layers of the scripts. The
+    loss pulls the projections of the weights on the current base and on the
+    bases of the similar tasks together: for every layer,
+
+        mean_j BCE((mean_rows cos(W P_cur, W P_j) + 1) / 2, 1)
+
+    with P = B B^T, summed over the layers. Everything that only depends on
+    the bases is built once per task and a single BCE covers all the
+    (layer, similar task) pairs.
+
+    A layer is evaluated in one of two equivalent ways, whichever needs fewer
+    flops per row of W (or as forced by closed_form):
+
+    - with the n x n projectors, concatenated over the similar tasks so a
+      step costs one matmul;
+    - in closed form from the n x r products W B, with the small cross-Grams
+      B_cur^T B_j precomputed: much cheaper while the bases have low rank.
+
+    The training loop applies the schedule with epoch() and step(): the loss
+    is evaluated every `every` steps, weighted by `every` to keep its average
+    gradient, only in the first `epochs` epochs of the task (0: all), and not
+    any more once its mean over an epoch falls below `tol` (0: never).
+    '''
+
+    def __init__(self, layers, device, closed_form=None, every=1, epochs=0, tol=0.):
+        self.every = every
+        self.epochs = epochs
+        self.tol = tol
+        self.active = True
+        self.n_epochs = 0
+        self.n_steps = 0
+        self.n_evals = 0
+        self.total = torch.zeros((), device=device)
+        self.groups = []
+        for param, current, similar in layers:
+            if len(similar) == 0:
+                continue
+            current = _tensor(current, device)
+            similar = [_tensor(s, device) for s in similar]
+            n, k = current.size(0), len(similar)
+            rank, ranks = current.size(1), sum(s.size(1) for s in similar)
+            gram_cur = _gram(current)
+            grams = [_gram(s) for s in similar]
+            # flops per row of W of the two forms
+            projected = n * n * (k + 1)
+            closed = n * (rank + ranks) + rank * ranks
+            closed += 0 if gram_cur is None else rank * rank
+            closed += 0 if all(g is None for g in grams) else ranks * ranks
+            if closed_form or (closed_form is None and closed < projected):
+                self.groups.append((param, k, _closed_form_cos,
+                                    self.closed_form(current, similar, gram_cur, grams)))
+            else:
+                # (n, k*n) projectors of the k similar tasks side by side, one GEMM
+                stacked = torch.cat([torch.mm(s, s.t()) for s in similar], dim=1)
+                self.groups.append((param, k, _projected_cos,
+                                    (torch.mm(current, current.t()), stacked, k)))
+        if self.groups:
+            # weight 1/k of every pair, the mean over the similar tasks of a layer
+            self.weights = torch.cat([torch.full((k,), 1. / k, device=device)
+                                      for _, k, _, _ in self.groups])
+
+    @staticmethod
+    def closed_form(current, similar, gram_cur, grams):
+        '''Cross-Grams, Grams and segment sums of the closed form of a layer'''
+        ranks = [s.size(1) for s in similar]
+        gram_sim = None
+        if any(g is not None for g in grams):
+            gram_sim = torch.block_diag(*[torch.mm(s.t(), s) if g is None else g
+                                          for s, g in zip(similar, grams)])
+        # (R, k) indicator summing the columns of every similar base
+        segments = torch.block_diag(*[torch.ones(r, 1, device=current.device) for r in ranks])
+        similar = torch.cat(similar, dim=1)
+        return (current, similar, torch.mm(current.t(), similar), gram_cur, gram_sim, segments)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def value(self):
+        '''Mean loss over the evaluations of the current epoch (nan if none)'''
+        return (self.total / self.n_evals).item() if self.n_evals else float('nan')
+
+    def epoch(self):
+        '''Start a training epoch, applying the epoch limit and the tolerance'''
+        if self.active and self.tol > 0 and self.n_evals and self.value() < self.tol:
+            self.active = False
+            print('Knowledge transfer loss below {:g} after {} epochs, disabled'.format(
+                self.tol, self.n_epochs))
+        self.n_epochs += 1
+        if self.epochs and self.n_epochs > self.epochs:
+            self.active = False
+        self.total.zero_()
+        self.n_evals = 0
+
+    def step(self):
+        '''Scheduled loss of a training step, None when it is skipped'''
+        if not self.groups or not self.active:
+            return None
+        self.n_steps += 1
+        if (self.n_steps - 1) % self.every != 0:
+            return None
+        loss = self()
+        self.total += loss.detach()
+        self.n_evals += 1
+        return loss * self.every if self.every != 1 else loss
+
+    def __call__(self):
+        if not self.groups:
+            return 0
+        cos = []
+        for param, _, fn, tensors in self.groups:
+            cos.append(fn(param.reshape(param.size(0), -1), *tensors))
+        sim = (torch.cat(cos) + 1.0) / 2.0
+        loss = F.binary_cross_entropy(sim, torch.ones_like(sim), reduction='none')
+        return (loss * self.weights).sum()
@@ -0,0 +1,196 @@
+import os
+import re
+import sys
+import csv
+import json
+import time
+import queue
+import argparse
+import itertools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+PATTERNS = {
+    'acc': re.compile(r'Final Avg Accuracy:\s*([-\d.]+)%'),
+    'bwt': re.compile(r'Backward transfer:\s*([-\d.]+)%'),
+    'time_ms': re.compile(r'\[Elapsed time = ([\d.]+) ms\]'),
+}
+
+
+def parse_grid(items):
+    '''["lr=0.01,0.05", "gpm_threshold=0.97"] -> [{"lr": "0.01", ...}, ...]'''
+    keys, values = [], []
+    for item in items:
+        key, vals = item.split('=', 1)
+        keys.append(key)
+        values.append(vals.split(','))
+    return [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+
+
+def available_cores():
+    '''Cores the sweep may use, its affinity mask (cpuset of a container)'''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def core_sets(n_workers, threads):
+    '''Disjoint sets of `threads` cores, one per worker'''
+    cores = available_cores()
+    if n_workers * threads > len(cores):
+        print('Warning: {} workers x {} threads > {} cores, cores are shared'.format(
+            n_workers, threads, len(cores)))
+    return [[cores[(w * threads + i) % len(cores)] for i in range(threads)]
+            for w in range(n_workers)]
+
+
+def run(args, job, cores):
+    seed, params = job
+    name = '_'.join(['seed{}'.format(seed)] + ['{}{}'.format(k, v.replace(' ', '-')) for k, v in params.items()])
+    cmd = [sys.executable, os.path.abspath(args.script), '--seed', str(seed)]
+    for k, v in params.items():
+        cmd += ['--' + k] + v.split()
+    results = os.path.join(os.path.abspath(args.out), name)
+    cmd += ['--results', results] + args.extra
+    if args.prefix:
+        cmd += ['--prefix_cache']
+    if os.path.exists(results + '.json'):
+        os.remove(results + '.json')  # left by an earlier sweep
+    env = dict(os.environ)
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        env[var] = str(len(cores))
+    if args.mmap:
+        env['STIL_MMAP'] = '1'
+
+    def pin():
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+
+    log = os.path.join(args.out, name + '.log')
+    clock0 = time.time()
+    with open(log, 'w') as f:
+        status = subprocess.call(cmd, stdout=f, stderr=subprocess.STDOUT, env=env,
+                                 preexec_fn=pin, cwd=os.path.dirname(os.path.abspath(args.script)))
+    wall = time.time() - clock0
+    with open(log) as f:
+        text = f.read()
+    row = dict(seed=seed, **params)
+    for key, pattern in PATTERNS.items():
+        found = pattern.findall(text)
+        row[key] = float(found[-1]) if found else float('nan')
+    row['train_s'] = float('nan')
+    row['prefix_tasks'] = 0
+    if os.path.exists(results + '.json'):
+        with open(results + '.json') as f:
+            data = json.load(f)
+        for key, value in (('acc', 'acc'), ('bwt', 'bwt'), ('time_ms', 'elapsed_ms')):
+            if value in data['summary']:
+                row[key] = data['summary'][value]
+        # time in the training epochs only, the part the KT schedule changes
+        train = [t['wall_s'] for t in data['timings'] if t['stage'] == 'train']
+        if train:
+            row['train_s'] = sum(train)
+        # first tasks restored from the snapshot of an earlier run
+        row['prefix_tasks'] = data['summary'].get('prefix_tasks', 0)
+    row['wall_s'] = wall
+    row['status'] = status
+    print('[{}] {} | acc={:.2f} bwt={:.2f} | {:.1f}s | {} tasks restored | cores {}'.format(
+        'ok' if status == 0 else 'failed', name, row['acc'], row['bwt'], wall, row['prefix_tasks'], cores))
+    return row
+
+
+def summarize(rows, keys):
+    '''mean and std of ACC/BWT/times over the seeds of every configuration'''
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row[k] for k in keys), []).append(row)
+    summary = []
+    for config, runs in groups.items():
+        line = dict(zip(keys, config))
+        line['n_seeds'] = len(runs)
+        for key in ('acc', 'bwt', 'wall_s', 'train_s'):
+            vals = np.array([r[key] for r in runs], dtype=float)
+            line[key + '_mean'] = np.nanmean(vals) if np.isfinite(vals).any() else float('nan')
+            line[key + '_std'] = np.nanstd(vals) if np.isfinite(vals).any() else float('nan')
+        summary.append(line)
+    return summary
+
+
+def write_csv(path, rows):
+    fields = list(rows[0].keys())
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(args):
+    os.makedirs(args.out, exist_ok=True)
+    grid = parse_grid(args.grid)
+    jobs = [(seed, params) for params in grid for seed in args.seeds]
+    threads = args.threads or max(1, len(available_cores()) // args.workers)
+    pool_cores = queue.Queue()
+    for cores in core_sets(args.workers, threads):
+        pool_cores.put(cores)
+
+    def worker(job):
+        cores = pool_cores.get()
+        try:
+            return run(args, job, cores)
+        finally:
+            pool_cores.put(cores)
+
+    print('{} runs of {} on {} workers x {} threads'.format(
+        len(jobs), args.script, args.workers, threads))
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        rows = list(pool.map(worker, jobs))
+
+    keys = list(grid[0].keys())
+    summary = summarize(rows, keys)
+    write_csv(os.path.join(args.out, 'runs.csv'), rows)
+    write_csv(os.path.join(args.out, 'summary.csv'), summary)
+
+    print('-' * 78)
+    for line in summary:
+        config = ' '.join('{}={}'.format(k, line[k]) for k in keys) or args.script
+        print('{:40s} | ACC {:6.2f} +- {:5.2f} | BWT {:6.2f} +- {:5.2f} | {:7.1f}s (train {:7.1f}s) | n={}'.format(
+            config, line['acc_mean'], line['acc_std'], line['bwt_mean'], line['bwt_std'],
+            line['wall_s_mean'], line['train_s_mean'], line['n_seeds']))
+    print('-' * 78)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run a main_*.py script over a grid of seeds and hyperparameters')
+    parser.add_argument('script', type=str,
+                        help='training script, e.g. main_cifar100.py')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[1, 2, 3],
+                        help='random seeds (default: 1 2 3)')
+    parser.add_argument('--grid', type=str, nargs='*', default=[],
+                        help='hyperparameter grid as name=v1,v2 (e.g. lr=0.01,0.05 sim_threshold=0.7,0.8), '
+                             'space separated values for list arguments')
+    parser.add_argument('--workers', type=int, default=2, metavar='N',
+                        help='runs in parallel (default: 2)')
+    parser.add_argument('--threads', type=int, default=0, metavar='N',
+                        help='cores and torch/BLAS threads pinned to each run, 0 to split the cores (default: 0)')
+    parser.add_argument('--mmap', action='store_true', default=False,
+                        help='memory-map the cached datasets, shared by the runs')
+    parser.add_argument('--no_prefix', dest='prefix', action='store_false', default=True,
+                        help='do not fork the runs from the task snapshots of the runs before them '
+                             '(the --prefix_cache of the scripts)')
+    parser.add_argument('--out', type=str, default='./results/sweep',
+                        help='directory of the logs and the results tables (default: ./results/sweep)')
+    # arguments after -- are passed to every run
+    argv, extra = sys.argv[1:], []
+    if '--' in argv:
+        argv, extra = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+    if args.mmap:
+        import inspect
+        import torch
+        if 'mmap' not in inspect.signature(torch.load).parameters:
+            parser.error('--mmap needs torch.load(mmap=True), torch >= 2.1 (found {})'.format(torch.__version__))
+    args.extra = extra
+    main(args)